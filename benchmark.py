@@ -7,6 +7,7 @@ import ast
 import torch.cuda
 import socket
 import sys
+import time
 import argparse
 from rl.config import str2bool
 from rl.utils import Color
@@ -270,23 +271,210 @@ def run_benchmark(description: str, job_counts: list, **kwargs):
         print(f"{jobs}-job: {round(ips):,} {ratio:.1f}x")
 
 
-def run_regressions():
+def _make_transport_env():
+    import gym
+    return gym.make("CartPole-v1")
+
+
+def run_transport_benchmark(worker_counts=(1, 8, 32), envs_per_worker=1, steps=2000):
+    """
+    Microbenchmark for the env worker transport, i.e. pipes vs shared memory actions.
+    Uses a very cheap environment so that the time is dominated by communication with the workers.
+    """
+    from rl import hybridVecEnv
+
+    print(f"{'workers':<10}{'pipe':>12}{'shared':>12}{'ratio':>8}")
+
+    for workers in worker_counts:
+        n_envs = workers * envs_per_worker
+        results = {}
+        for shared_actions in [False, True]:
+            env = hybridVecEnv.HybridAsyncVectorEnv(
+                [_make_transport_env] * n_envs,
+                max_cpus=workers,
+                copy=False,
+                compact_infos=True,
+                shared_actions=shared_actions,
+            )
+            env.reset()
+            actions = np.zeros([n_envs], dtype=np.int64)
+            # warmup
+            for _ in range(100):
+                env.step(actions)
+            start_time = time.time()
+            for _ in range(steps):
+                env.step(actions)
+            results[shared_actions] = steps * n_envs / (time.time() - start_time)
+            env.close()
+        print(f"{workers:<10}{round(results[False]):>12,}{round(results[True]):>12,}{results[True]/results[False]:>7.1f}x")
+
+
+def run_return_estimate_benchmark(horizon_counts=(32, 128, 512), n_steps=128, agents=128, samples=40):
+    """
+    Microbenchmark for the TVF return estimator, comparing the per horizon version to the batched one.
+    """
+    from rl import returns_truncated
+
+    print(f"{'K':<10}{'per_horizon':>14}{'batched':>12}{'ratio':>8}{'error':>12}")
+
+    rng = np.random.RandomState(0)
+    N, A, V = n_steps, agents, 128
+    value_sample_horizons = np.geomspace(1, 1024, num=V).astype('int32') - 1
+    value_samples = rng.normal(0.1, 0.4, [N + 1, A, V]).astype('float32')
+    value_samples[:, :, 0] = 0
+
+    for K in horizon_counts:
+        lamb = 1 - (1 / 40)
+        weights = np.asarray([lamb ** x for x in range(1, N + 1)])
+        weights /= weights.sum()
+        kwargs = {
+            'gamma': 0.997,
+            'rewards': rng.randint(-1, 2, [N, A]).astype('float32'),
+            'dones': rng.randint(0, 100, [N, A]) >= 98,
+            'required_horizons': np.geomspace(1, 1024, num=K).astype('int32'),
+            'value_sample_horizons': value_sample_horizons,
+            'value_samples': value_samples,
+            'n_step_samples': rng.choice(range(1, N + 1), size=(K, samples), replace=True, p=weights),
+        }
+        results = {}
+        times = {}
+        for name, fn in [
+            ('per_horizon', returns_truncated._calculate_sampled_return_multi_per_horizon),
+            ('batched', returns_truncated._calculate_sampled_return_multi_fast),
+        ]:
+            start_time = time.time()
+            results[name] = fn(**kwargs)
+            times[name] = time.time() - start_time
+        error = np.abs(results['per_horizon'] - results['batched']).max()
+        ratio = times['per_horizon'] / times['batched']
+        print(f"{K:<10}{times['per_horizon']:>13.3f}s{times['batched']:>11.3f}s{ratio:>7.1f}x{error:>12.2e}")
+
+
+def run_compile_benchmark(mode="default", micro_batch_size=512, steps=20, device=None):
+    """
+    Microbenchmark for torch.compile, timing a forward and backward pass through the dual TVF model used by the
+    regression runs, with and without compilation.
+    """
+    from rl import models, tvf
+
+    device = device or ("cuda" if GPUS > 0 else "cpu")
+    tvf_horizons = tvf.get_value_head_horizons(regression_args['tvf_value_samples'], regression_args['tvf_max_horizon'])
+
+    print(f"{'mode':<16}{'first step':>12}{'step':>12}{'ratio':>8}{'error':>12}")
+
+    x = torch.randint(0, 255, size=[micro_batch_size, 4, 84, 84], dtype=torch.uint8, device=device)
+    results = {}
+    times = {}
+    for compile_mode in ["off", mode]:
+        torch.manual_seed(0)
+        model = models.TVFModel(
+            encoder="nature",
+            encoder_args=None,
+            input_dims=(4, 84, 84),
+            actions=18,
+            device=device,
+            architecture=regression_args['architecture'],
+            hidden_units=regression_args['hidden_units'],
+            observation_normalization=regression_args['observation_normalization'],
+            tvf_fixed_head_horizons=tvf_horizons,
+        )
+        if compile_mode != "off":
+            model.enable_compile(compile_mode)
+
+        def step():
+            model.zero_grad()
+            result = model(x)
+            loss = result["log_policy"].mean() + result["value"].square().mean() + result["tvf_value"].square().mean()
+            loss.backward()
+            return result["tvf_value"].detach()
+
+        start_time = time.time()
+        results[compile_mode] = step()
+        first_step_time = time.time() - start_time
+        for _ in range(3):
+            step()
+        if device != "cpu":
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(steps):
+            step()
+        if device != "cpu":
+            torch.cuda.synchronize()
+        times[compile_mode] = (time.time() - start_time) / steps
+        error = (results[compile_mode] - results["off"]).abs().max().item()
+        ratio = times["off"] / times[compile_mode]
+        print(f"{compile_mode:<16}{first_step_time:>11.3f}s{times[compile_mode]:>11.3f}s{ratio:>7.1f}x{error:>12.2e}")
+
+
+def run_fused_forward_benchmark(batch_sizes=(1, 16, 128, 512), steps=20, device=None):
+    """
+    Microbenchmark for inference with the dual TVF model used by the regression runs, evaluating the policy and value
+    encoders separately, and in a single pass (fused_forward).
+    """
+    from rl import models, tvf
+
+    device = device or ("cuda" if GPUS > 0 else "cpu")
+    tvf_horizons = tvf.get_value_head_horizons(regression_args['tvf_value_samples'], regression_args['tvf_max_horizon'])
+
+    print(f"{'B':<10}{'separate':>12}{'fused':>12}{'ratio':>8}{'error':>12}")
+
+    model = models.TVFModel(
+        encoder="nature",
+        encoder_args=None,
+        input_dims=(4, 84, 84),
+        actions=18,
+        device=device,
+        architecture=regression_args['architecture'],
+        hidden_units=regression_args['hidden_units'],
+        observation_normalization=regression_args['observation_normalization'],
+        tvf_fixed_head_horizons=tvf_horizons,
+        fused_forward=True,
+    )
+
+    for B in batch_sizes:
+        x = torch.randint(0, 255, size=[B, 4, 84, 84], dtype=torch.uint8, device=device)
+        results = {}
+        times = {}
+        for fused_forward in [False, True]:
+            model.fused_forward = fused_forward
+            with torch.no_grad():
+                results[fused_forward] = model(x)["tvf_value"]
+                if device != "cpu":
+                    torch.cuda.synchronize()
+                start_time = time.time()
+                for _ in range(steps):
+                    model(x)
+                if device != "cpu":
+                    torch.cuda.synchronize()
+            times[fused_forward] = (time.time() - start_time) / steps
+        error = (results[True] - results[False]).abs().max().item()
+        ratio = times[False] / times[True]
+        print(f"{B:<10}{times[False]*1000:>10.2f}ms{times[True]*1000:>10.2f}ms{ratio:>7.1f}x{error:>12.2e}")
+
+
+def get_regression_job_name(seed: int, amp: str = "off"):
+    return f"pong_{seed}" if amp == "off" else f"pong_{amp}_{seed}"
+
+
+def run_regressions(amp: str = "off"):
     """
     Runs pong for 10M three times and checks the results.
+    amp: autocast mode to run with [off|bf16|fp16], used to check that reduced precision does not hurt performance.
     """
     job_results = []
 
     print("Running regression.")
 
     for seed in [0, 1, 2, 3]:
-        job_name = f"pong_{seed}"
+        job_name = get_regression_job_name(seed, amp)
         p = execute_job(
             folder=REGRESSION_FOLDER,
             run_name=job_name,
             env_name="Pong",
             seed=seed,
             device=f'cuda:{seed % GPUS}',
-            quiet_mode=not args.verbose
+            quiet_mode=not args.verbose,
+            amp=amp,
         )
         job_results.append((job_name, p))
 
@@ -296,14 +484,14 @@ def run_regressions():
         if args.verbose:
             print_outputs(outs, errs)
 
-    show_regression_results()
+    show_regression_results(amp)
 
-def show_regression_results():
+def show_regression_results(amp: str = "off"):
     """ Loads latest regression result and prints outout. """
     mean_scores = []
     aoc_scores = []
     for seed in [0, 1, 2, 3]:
-        job_name = f"pong_{seed}"
+        job_name = get_regression_job_name(seed, amp)
         logs = pu.get_runs("./Run/"+REGRESSION_FOLDER, run_filter=lambda x : job_name in x)
         assert len(logs) == 1, f"Expected one log with name '{job_name}' " \
                                f"in folder {REGRESSION_FOLDER} but found {len(logs)}."
@@ -338,7 +526,7 @@ if __name__ == "__main__":
         os.environ["MKL_THREADING_LAYER"] = "GNU"
 
         parser = argparse.ArgumentParser(description="Benchmarker")
-        parser.add_argument("mode", type=str, help="[full|quick|ppo|regression|show|suite]")
+        parser.add_argument("mode", type=str, help="[full|quick|ppo|regression|show|suite|transport|returns|compile|fused]")
         parser.add_argument("--verbose", type=str2bool, default=False)
         parser.add_argument("--parallel_jobs", type=int, default=1)
         parser.add_argument("--use_compression", type=str2bool, default=False)
@@ -346,6 +534,8 @@ if __name__ == "__main__":
         parser.add_argument("--numa", type=str, default=None, help='e.g. [0,1]')
         parser.add_argument("--jobs", type=str, default=None)
         parser.add_argument("--custom_args", type=str, default=None)
+        parser.add_argument("--compile", type=str, default="default", help="torch.compile mode for compile benchmark.")
+        parser.add_argument("--amp", type=str, default="off", help="[off|bf16|fp16] autocast mode for regression.")
 
         args = parser.parse_args()
 
@@ -370,11 +560,19 @@ if __name__ == "__main__":
                 architecture="single",
             )
         elif mode == "regression":
-            run_regressions()
+            run_regressions(amp=args.amp)
         elif mode == "suite":
             run_suite()
         elif mode == "show":
-            show_regression_results()
+            show_regression_results(amp=args.amp)
+        elif mode == "transport":
+            run_transport_benchmark()
+        elif mode == "returns":
+            run_return_estimate_benchmark()
+        elif mode == "compile":
+            run_compile_benchmark(mode=args.compile)
+        elif mode == "fused":
+            run_fused_forward_benchmark()
         else:
             raise Exception(f"Invalid mode {args.mode}")
 
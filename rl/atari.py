@@ -2,6 +2,7 @@ import gym
 import numpy as np
 import hashlib
 import os
+import functools
 
 import rl.config
 from . import wrappers, config, ale_roms
@@ -116,11 +117,13 @@ ec3beb6d8b5689e867bafb5d5f507491 word_zapper.bin
 c5930d0e8cdae3e037349bfa08e871be yars_revenge.bin
 eea0da9b987d661264cce69a7c13c3bd zaxxon.bin""".split("\n")]}
 
-def make(env_id:str, monitor_video=False, seed=None, args=None, determanistic_saving=True):
+def make(env_id:str, monitor_video=False, seed=None, args=None, determanistic_saving=True, vector_preprocessing=False):
     """
     Construct environment of given name, including any required wrappers.
     @determanistic_saving: When true RND is saved with the environment, so restoring will always produce the same
         results. When false RNG is not persisted through saving, which can be helpful when generating return samples.
+    @vector_preprocessing: When true raw frames are returned, and frame processing should be applied to the vector
+        env with make_vec_preprocessing.
     """
 
     # this global reference will not work on windows when we spawn instead of fork,
@@ -197,12 +200,13 @@ def make(env_id:str, monitor_video=False, seed=None, args=None, determanistic_sa
             raise ValueError("reward_clipping should be off, sqrt, or a float")
         env = wrappers.ClipRewardWrapper(env, clip)
 
-    env = wrappers.AtariWrapper(env, width=args.env.res_x, height=args.env.res_y)
+    if not vector_preprocessing:
+        env = wrappers.AtariWrapper(env, width=args.env.res_x, height=args.env.res_y)
 
-    if args.debug.zero_obs:
-        env = wrappers.ZeroObsWrapper(env)
+        if args.debug.zero_obs:
+            env = wrappers.ZeroObsWrapper(env)
 
-    env = wrappers.ColorTransformWrapper(env, args.env.color_mode)
+        env = wrappers.ColorTransformWrapper(env, args.env.color_mode)
 
     if args.env.atari_terminal_on_loss_of_life:
         env = wrappers.EpisodicLifeEnv(env)
@@ -210,21 +214,49 @@ def make(env_id:str, monitor_video=False, seed=None, args=None, determanistic_sa
     if args.env.deferred_rewards != 0:
         env = wrappers.DeferredRewardWrapper(env, args.env.deferred_rewards)
 
+    if vector_preprocessing:
+        # frame processing is done by VecAtariPreprocessing (see make_vec_preprocessing).
+        assert not args.env.embed_state, "embed_state is not supported with vector_preprocessing."
+        return wrappers.NullActionWrapper(env)
+
     if args.env.embed_action:
         # should go before framestack
         env = wrappers.ActionAwareWrapper(env)
 
-    env = wrappers.FrameStack(env, n_stacks=args.env.frame_stack)
+    if args.env.embed_state:
+        # state history modifies the observation, so needs a copy of the stack.
+        env = wrappers.FrameStack(env, n_stacks=args.env.frame_stack)
 
-    if args.env.embed_time:
-        env = wrappers.TimeChannelWrapper(env)
+        if args.env.embed_time:
+            env = wrappers.TimeChannelWrapper(env)
 
-    if args.env.embed_state:
         env = wrappers.StateHistoryWrapper(env)
 
-    # for some reason the rest of my code wants it in this order...
-    env = wrappers.ChannelsFirstWrapper(env)
+        # for some reason the rest of my code wants it in this order...
+        env = wrappers.ChannelsFirstWrapper(env)
+    else:
+        env = wrappers.RingFrameStack(env, n_stacks=args.env.frame_stack, embed_time=args.env.embed_time)
 
     env = wrappers.NullActionWrapper(env)
 
-    return env
\ No newline at end of file
+    return env
+
+
+def make_vec_preprocessing(args=None):
+    """
+    Returns a function that applies the frame processing skipped by make (with vector_preprocessing) to a vector env
+    of these environments. See wrappers.VecAtariPreprocessing.
+    """
+    args:rl.config.Config = args or config.args
+    if args.env.embed_time:
+        assert args.env.timeout > 0, "embed_time requires a timeout."
+    return functools.partial(
+        wrappers.VecAtariPreprocessing,
+        width=args.env.res_x,
+        height=args.env.res_y,
+        color_mode=args.env.color_mode,
+        n_stacks=args.env.frame_stack,
+        embed_action=args.env.embed_action,
+        embed_time=args.env.embed_time,
+        zero_obs=args.debug.zero_obs,
+    )
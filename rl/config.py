@@ -226,6 +226,8 @@ class TVFConfig(BaseConfig):
     return_distribution: str = "exponential"  # fixed|exponential|uniform|hyperbolic|quadratic
     return_samples: int = 8         # Number of n-step samples to use for distributional return calculation.
     return_use_log_interpolation: bool = False # Interpolates in log space.
+    return_workers: int = 0         # Splits horizons between this many threads when calculating returns (0=off).
+    return_backend: str = "numpy"   # numpy|torch, torch calculates returns on args.device.
     max_horizon: int = 30000        # Max horizon for TVF.
     value_heads: int = 128          # Number of value heads to use.
     head_spacing: str = "geometric" # geometric|linear|even_x
@@ -466,6 +468,7 @@ class ModelConfig(BaseConfig):
     architecture: str = "dual"      # [dual|single]
     head_scale: float = 0.1         # Scales weights for value and policy heads.
     head_bias: bool = True          # Enables bias on output heads.
+    fused_forward: bool = False     # Evaluates policy and value encoders in one pass during inference [dual, nature|mlp].
 
     def __init__(self, parser: argparse.ArgumentParser):
         super().__init__(prefix="model", parser=parser)
@@ -499,6 +502,7 @@ class EnvConfig(BaseConfig):
 
     name: str = "Pong"                  # Name of environment (e.g. pong) or alternatively a list of environments (e.g.) ['Pong', 'Breakout'].
     type: str = "atari"                 # [atari|mujoco|procgen]
+    backend: str = "classic"            # [classic|envpool] envpool is faster, but resets environments when restoring from a checkpoint.
     warmup_period: int = 250            # Number of random steps to take before training agent.
     timeout: str = "auto"               # "Set the timeout for the environment, 0=off, (given in unskipped environment steps)")
     repeat_action_probability: float = 0.0
@@ -508,6 +512,9 @@ class EnvConfig(BaseConfig):
     reward_normalization: str = "rms"   # "off|rms"
     reward_normalization_clipping: float = 10  # How much to clip rewards after normalization, negative to disable.
     deferred_rewards: int = 0           #  If positive, all rewards accumulated so far will be given at time step deferred_rewards, then no reward afterwards.
+    compact_infos: bool = True          # Workers return common info fields through shared memory, and only send rare keys as dictionaries.
+    shared_actions: bool = False        # Sends actions to workers through shared memory and semaphores, rather than pipes.
+    vector_preprocessing: bool = False  # Atari frames are resized, stacked etc. for all of a worker's environments at once, rather than per environment.
 
     # (stuck)
     max_repeated_actions: int = 100     # "Agent is given a penalty if it repeats the same action more than this many times.
@@ -630,6 +637,9 @@ class Config(BaseConfig):
         self.obs_compression = bool()
         self.device = str()
         self.upload_batch = bool()
+        self.batch_prefetch = int()
+        self.compile = str()
+        self.amp = str()
         self.disable_logging = bool()
         self.ignore_lock = bool()
         self.ignore_device = str()
@@ -654,6 +664,11 @@ class Config(BaseConfig):
         self.freeze_observation_normalization = bool()
         self.max_micro_batch_size = int()
         self.sync_envs = bool()
+        self.rollout_groups = int()
+        self.worker_topology = str()
+        self.async_batch_size = int()
+        self.direct_obs = bool()
+        self.gae_backend = str()
         self.benchmark_mode = bool()
 
         self.override_reward_normalization_gamma = object()
@@ -730,6 +745,9 @@ class Config(BaseConfig):
         parser.add_argument("--obs_compression", type=str2bool, default=False, help="Use LZ4 compression on states (around 20x smaller), but is 10% slower")
         parser.add_argument("--device", type=str, default="cpu", help="Device to use [cpu|cuda:n|auto]")
         parser.add_argument("--upload_batch", type=str2bool, default=False, help='Uploads an entire batch to GPU, faster, but uses more GPU RAM.')
+        parser.add_argument("--batch_prefetch", type=int, default=0, help='When upload_batch is off, number of micro-batches to prepare (decompress and upload) ahead on background threads. 0 = off.')
+        parser.add_argument("--compile", type=str, default="off", help='[off|default|reduce-overhead|max-autotune] Compiles the model and the policy, value and distil training steps with torch.compile. reduce-overhead uses CUDA graphs. Only the first few batch sizes are compiled, others run eagerly.')
+        parser.add_argument("--amp", type=str, default="off", help='[off|bf16|fp16] Runs the model encoders under autocast with this dtype, for both inference and training. Observation normalization and all heads stay in float32. fp16 uses loss scaling, and requires cuda.')
         parser.add_argument("--disable_logging", type=str2bool, default=False, help='Useful when profiling.')
         parser.add_argument("--ignore_lock", type=str2bool, default=False, help="ignores previous lock")
         parser.add_argument("--ignore_device", type=str, default="[]", help="Devices to ignore when using auto")
@@ -760,6 +778,16 @@ class Config(BaseConfig):
         parser.add_argument("--max_micro_batch_size", type=int, default=512, help="Can be useful to limit GPU memory")
         parser.add_argument("--sync_envs", type=str2bool, nargs='?', const=True, default=False,
                             help="Enables synchronous environments (slower, but helpful for debuging env errors).")
+        parser.add_argument("--rollout_groups", type=int, default=1,
+                            help="Splits agents into this many groups during rollout, so that environment steps overlap with the forward of the next group. Groups are aligned to env workers, so may be uneven. 1 disables pipelining.")
+        parser.add_argument("--worker_topology", type=str, default="fixed",
+                            help="[fixed|auto] auto benchmarks a few (workers x threads) layouts at startup and uses the fastest.")
+        parser.add_argument("--async_batch_size", type=int, default=0,
+                            help="If positive, environments are stepped asynchronously, and results are processed as soon as at least this many environments are ready, so slow environments do not hold up the rollout. 0 disables.")
+        parser.add_argument("--direct_obs", type=str2bool, default=False,
+                            help="Environment workers write observations directly into the (shared memory) rollout buffer, rather than copying them in each step. Requires async environments.")
+        parser.add_argument("--gae_backend", type=str, default="numpy",
+                            help="[numpy|numba|torch] Implementation used for the batched GAE / TD(lambda) calculation. numba requires numba to be installed.")
         parser.add_argument("--benchmark_mode", type=str2bool, default=False, help="Enables benchmarking mode.")
         parser.add_argument("--precision", type=str, default="medium", help="low|medium|high")
 
@@ -816,6 +844,7 @@ class Config(BaseConfig):
 
         valid_restore = ["always", "never", "auto"]
         assert self.restore in valid_restore, f"Expecting {self.restore} to be one of {valid_restore} but was {self.restore}"
+        assert self.amp in ["off", "bf16", "fp16"], f"Invalid amp mode {self.amp}"
 
 
     def _add_remappings(self):
@@ -0,0 +1,393 @@
+"""
+Vector environment using envpool.
+
+envpool is only used for emulation, frame skipping, resizing and sticky actions. The remaining wrappers from
+atari.make and procgen.make are applied here, vectorized over all environments, in the same order as the single
+environment versions. This means observations (channels first, newest frame first, optional time channel) and info
+fields (see hybridVecEnv.INFO_DTYPE) match the classic pipeline.
+
+Differences to the classic pipeline:
+    - emulator state can not be saved, so checkpoints do not include it, and environments are reset on resume.
+    - room_count is not available for Montezuma's Revenge, as envpool does not expose RAM.
+    - noop starts are performed by envpool, and so use envpool's random number generator.
+    - embed_state is not supported.
+"""
+
+import gym
+import numpy as np
+import cv2
+
+from rl import config
+from rl.hybridVecEnv import INFO_DTYPE
+
+# size of the blocks used to mark actions onto frames (see wrappers.ActionAwareWrapper)
+ACTION_BLOCK_SIZE = 4
+
+# episode limit given to envpool when timeout is off, as envpool otherwise applies its own default limit.
+NO_TIMEOUT_STEPS = 2 ** 30
+
+
+def get_task_id(env_type: str, env_name: str, procgen_difficulty: str = "hard"):
+    """
+    Returns envpool task id for given environment.
+    """
+    if env_type == "atari":
+        return f"{env_name}-v5"
+    elif env_type == "procgen":
+        return f"{env_name.capitalize()}{procgen_difficulty.capitalize()}-v0"
+    else:
+        raise ValueError(f"Environment type {env_type} is not supported by envpool.")
+
+
+def color_transform(frames: np.ndarray, color_mode: str):
+    """
+    Vectorized version of wrappers.ColorTransformWrapper.
+    frames: RGB frames of dims [N, 3, H, W]
+    returns frames of dims [N, C, H, W]
+    """
+    if color_mode == "rgb":
+        return frames
+    N, C, H, W = frames.shape
+    # stack environments vertically so that opencv can process them in one call.
+    hwc = np.ascontiguousarray(frames.transpose(0, 2, 3, 1)).reshape(N * H, W, C)
+    if color_mode == "bw":
+        return cv2.cvtColor(hwc, cv2.COLOR_RGB2GRAY).reshape(N, 1, H, W)
+    elif color_mode == "yuv":
+        hwc = cv2.cvtColor(hwc, cv2.COLOR_RGB2YUV)
+    elif color_mode == "hsv":
+        hwc = cv2.cvtColor(hwc, cv2.COLOR_RGB2HSV)
+    else:
+        raise ValueError(f"Invalid color_mode {color_mode}")
+    return hwc.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+
+
+def mark_actions(obs: np.ndarray, actions: np.ndarray):
+    """
+    Vectorized version of wrappers.ActionAwareWrapper, marks actions onto frames of dims [N, C, H, W] in place.
+    Negative actions are not marked.
+    """
+    for action in np.unique(actions):
+        if action < 0:
+            continue
+        x = action * ACTION_BLOCK_SIZE
+        obs[actions == action, :, x:x + ACTION_BLOCK_SIZE, 0:ACTION_BLOCK_SIZE] = 255
+
+
+class EnvPoolVecEnv(gym.vector.VectorEnv):
+    """
+    Wraps an envpool environment so that it matches the classic (HybridAsyncVectorEnv) pipeline.
+    Typed info fields for the most recent step are given by info_arrays, and the infos returned by step are empty.
+
+    Observations returned by step and reset are a buffer that is overwritten on the next step.
+
+    Emulator state can not be saved, so no state is saved for this env (see utils.save_env_state). Runs using envpool
+    resume with their environments reset (see Runner.load_checkpoint).
+    """
+
+    def __init__(self, env_type: str, env_name: str, num_envs: int, seed: int = 0, args=None):
+
+        # lazy load, as this might not be installed.
+        import envpool
+
+        self.args = args = args or config.args
+
+        assert env_type in ["atari", "procgen"], f"Environment type {env_type} is not supported by envpool."
+        assert not args.env.embed_state, "embed_state is not supported with envpool."
+        assert args.env.color_mode in ["bw", "rgb", "yuv", "hsv"], f"Invalid color_mode {args.env.color_mode}"
+        if args.env.embed_time:
+            assert args.env.timeout > 0, "embed_time requires a timeout."
+
+        is_atari = env_type == "atari"
+
+        self.env_type = env_type
+        self.timeout = args.env.timeout
+        self.color_mode = args.env.color_mode
+        self.embed_time = args.env.embed_time
+        self.embed_action = args.env.embed_action
+        # these wrappers are only applied for atari (see atari.make and procgen.make)
+        self.zero_obs = is_atari and args.debug.zero_obs
+        self.termination_probability = args.env.per_step_termination_probability if is_atari else 0
+        self.reward_clipping = args.env.reward_clipping if is_atari else "off"
+        self.deferred_rewards = args.env.deferred_rewards if is_atari else 0
+        self.terminal_on_loss_of_life = is_atari and args.env.atari_terminal_on_loss_of_life
+
+        if self.reward_clipping not in ["off", "sqrt"]:
+            try:
+                self.reward_clip = float(self.reward_clipping)
+            except:
+                raise ValueError("reward_clipping should be off, sqrt, or a float")
+
+        env_args = {}
+        if is_atari:
+            assert args.env.res_x == args.env.res_y, "Atari preprocessing only supports square resolutions."
+            env_args.update(
+                frame_skip=args.env.frame_skip,
+                img_height=args.env.res_y,
+                img_width=args.env.res_x,
+                # color transform and frame stacking are done here so that they match the classic pipeline.
+                gray_scale=False,
+                stack_num=1,
+                noop_max=args.env.noop_duration if args.env.noop_start else 1,
+                episodic_life=False,
+                reward_clip=False,
+                use_fire_reset=False,
+                repeat_action_probability=args.env.repeat_action_probability,
+                full_action_space=args.env.full_action_space,
+            )
+            # always set this, as the classic pipeline has no limit when timeout is off.
+            env_args['max_episode_steps'] = self.timeout if self.timeout > 0 else NO_TIMEOUT_STEPS
+            self.n_stacks = args.env.frame_stack
+        else:
+            assert args.env.frame_skip == 1, "Frame skip should be 1 for procgen"
+            self.n_stacks = 1
+
+        self.env = envpool.make_gym(
+            get_task_id(env_type, env_name, args.env.procgen_difficulty),
+            num_envs=num_envs,
+            batch_size=num_envs,
+            seed=seed,
+            **env_args
+        )
+
+        # procgen frames are channels last.
+        shape = self.env.observation_space.shape
+        self.channels_last = shape[-1] == 3 and shape[0] != 3
+        H, W = shape[:2] if self.channels_last else shape[1:]
+        frame_channels = 1 if self.color_mode == "bw" else 3
+        obs_channels = frame_channels * self.n_stacks + (1 if self.embed_time else 0)
+
+        super().__init__(
+            num_envs,
+            gym.spaces.Box(0, 255, (obs_channels, H, W), dtype=np.uint8),
+            gym.spaces.Discrete(self.env.action_space.n),
+        )
+
+        # most recent frames for each environment, with newest frame first.
+        self.stack = np.zeros([num_envs, self.n_stacks, frame_channels, H, W], dtype=np.uint8)
+        self.obs = np.zeros([num_envs, obs_channels, H, W], dtype=np.uint8)
+
+        # per environment wrapper state
+        self.time = np.zeros([num_envs], dtype=np.int32)
+        self.ep_score = np.zeros([num_envs], dtype=np.float64)
+        self.ep_length = np.zeros([num_envs], dtype=np.int32)
+        self.lives = np.zeros([num_envs], dtype=np.int32)
+        self.deferred_t = np.zeros([num_envs], dtype=np.int32)
+        self.deferred_reward = np.zeros([num_envs], dtype=np.float64)
+        self.game_over = np.zeros([num_envs], dtype=bool)
+
+        self.info_arrays = np.zeros([num_envs], dtype=INFO_DTYPE)
+
+    def _sort_results(self, obs, info, env_ids):
+        """
+        Returns order of results so that they match env_ids (which must be sorted).
+        """
+        if info is None or "env_id" not in info:
+            return np.arange(len(obs))
+        order = np.argsort(info["env_id"])
+        assert np.array_equal(np.asarray(info["env_id"])[order], env_ids), "envpool returned unexpected environments."
+        return order
+
+    def _process_frames(self, obs, order):
+        obs = np.asarray(obs)[order]
+        if self.channels_last:
+            obs = obs.transpose(0, 3, 1, 2)
+        return color_transform(obs, self.color_mode)
+
+    def _get_lives(self, info, order, n: int):
+        if info is None or "lives" not in info:
+            return np.full([n], -1, dtype=np.int32)
+        return np.asarray(info["lives"])[order]
+
+    def _envpool_reset(self, env_ids):
+        """
+        Resets given environments, returns frames, lives
+        """
+        result = self.env.reset(env_ids)
+        obs, info = result if type(result) is tuple else (result, None)
+        order = self._sort_results(obs, info, env_ids)
+        return self._process_frames(obs, order), self._get_lives(info, order, len(env_ids))
+
+    def _envpool_step(self, actions, env_ids):
+        """
+        Steps given environments, returns frames, rewards, dones, lives
+        """
+        result = self.env.step(np.asarray(actions, dtype=np.int32), env_ids)
+        if len(result) == 5:
+            obs, rewards, terminated, truncated, info = result
+            dones = np.logical_or(terminated, truncated)
+        else:
+            obs, rewards, dones, info = result
+        order = self._sort_results(obs, info, env_ids)
+        return (
+            self._process_frames(obs, order),
+            np.asarray(rewards, dtype=np.float64)[order],
+            np.asarray(dones, dtype=bool)[order],
+            self._get_lives(info, order, len(env_ids)),
+        )
+
+    def _clip_rewards(self, rewards):
+        """
+        Vectorized version of wrappers.ClipRewardWrapper and wrappers.SqrtRewardWrapper
+        """
+        if self.reward_clipping == "off":
+            return rewards
+        elif self.reward_clipping == "sqrt":
+            epsilon = 1e-3
+            return np.sign(rewards) * (np.sqrt(np.abs(rewards) + 1) - 1) + epsilon * rewards
+        else:
+            return np.clip(rewards, -self.reward_clip, +self.reward_clip)
+
+    def _write_obs(self, env_ids, frames, actions, time_frac, reset_mask):
+        """
+        Applies frame processing from the wrappers that follow EpisodicLifeEnv (action embedding, frame stack, time
+        channel) and writes the result into self.obs.
+        Environments in reset_mask have their stack filled with the given frame, and do not have an action marked.
+        """
+        actions = np.where(reset_mask, -1, actions)
+        if self.env_type == "atari":
+            if self.zero_obs:
+                frames = frames * 0
+            if self.embed_action:
+                mark_actions(frames, actions)
+            stack = self.stack[env_ids]
+            stack[:, 1:] = stack[:, :-1]
+            stack[:, 0] = frames
+            stack[reset_mask] = frames[reset_mask, None]
+            self.stack[env_ids] = stack
+            N = len(env_ids)
+            obs = np.zeros([N, *self.single_observation_space.shape], dtype=np.uint8)
+            obs[:, :-1 if self.embed_time else None] = stack.reshape(N, -1, *stack.shape[-2:])
+            if self.embed_time:
+                obs[:, -1] = (time_frac * 255).astype(np.uint8)[:, None, None]
+        else:
+            obs = frames
+            if self.embed_time:
+                time_channel = np.broadcast_to((time_frac * 255).astype(np.uint8)[:, None, None, None], [len(obs), 1, *obs.shape[-2:]])
+                obs = np.concatenate([obs, time_channel], axis=1)
+            if self.embed_action:
+                mark_actions(obs, actions)
+        self.obs[env_ids] = obs
+
+    def reset(self):
+        env_ids = np.arange(self.num_envs)
+        frames, lives = self._envpool_reset(env_ids)
+        self.time *= 0
+        self.ep_score *= 0
+        self.ep_length *= 0
+        self.lives[:] = lives
+        self.deferred_t *= 0
+        self.deferred_reward *= 0
+        self.game_over[:] = False
+        self.info_arrays[:] = 0
+        self.info_arrays['raw_reward'] = np.nan
+        self.info_arrays['room_count'] = np.nan
+        self.info_arrays['lives'] = -1
+        self._write_obs(env_ids, frames, -1, np.zeros([self.num_envs]), np.ones([self.num_envs], dtype=bool))
+        return self.obs
+
+    def step(self, actions):
+        """
+        Steps all environments. Negative actions leave the environment as it was (see wrappers.NullActionWrapper).
+        Returns obs, rewards, dones, infos
+        """
+        actions = np.asarray(actions)
+        info = self.info_arrays
+
+        # environments given a null action return their previous info, with no reward.
+        info['reward'] = 0
+        info['done'] = False
+
+        env_ids = np.flatnonzero(actions >= 0)
+        if len(env_ids) > 0:
+            self._step(env_ids, actions[env_ids])
+
+        return self.obs, info['reward'].copy(), info['done'].copy(), [{} for _ in range(self.num_envs)]
+
+    def _step(self, env_ids, actions):
+
+        game_over = self.game_over[env_ids]
+        if np.any(game_over):
+            # these games ended during the noop step that follows a loss of life. The classic pipeline would step the
+            # finished game once more, which reports done, whereas envpool would reset it, so we fake this step.
+            frames = np.zeros([len(env_ids), *self.stack.shape[2:]], dtype=np.uint8)
+            raw_rewards = np.zeros([len(env_ids)], dtype=np.float64)
+            dones = game_over.copy()
+            lives = self.lives[env_ids]
+            if not np.all(game_over):
+                frames[~game_over], raw_rewards[~game_over], dones[~game_over], lives[~game_over] = \
+                    self._envpool_step(actions[~game_over], env_ids[~game_over])
+            self.game_over[env_ids] = False
+        else:
+            frames, raw_rewards, dones, lives = self._envpool_step(actions, env_ids)
+
+        # RandomTerminationWrapper
+        if self.termination_probability > 0:
+            dones |= np.random.rand(len(env_ids)) < self.termination_probability
+
+        # TimeLimitWrapper (envpool is given the same timeout, but may not be the one to trigger it)
+        self.time[env_ids] += 1
+        if self.timeout > 0:
+            dones |= self.time[env_ids] >= self.timeout
+
+        # MonitorWrapper and EpisodeScoreWrapper
+        self.ep_score[env_ids] += raw_rewards
+        self.ep_length[env_ids] += 1
+
+        rewards = self._clip_rewards(raw_rewards)
+
+        # EpisodicLifeEnv
+        fake_dones = np.zeros_like(dones)
+        if self.terminal_on_loss_of_life:
+            fake_dones = (lives < self.lives[env_ids]) & (lives > 0)
+            self.lives[env_ids] = lives
+        all_dones = dones | fake_dones
+
+        # DeferredRewardWrapper
+        if self.deferred_rewards != 0:
+            self.deferred_t[env_ids] += 1
+            give_rewards = (self.deferred_t[env_ids] == self.deferred_rewards) | ((self.deferred_rewards == -1) & all_dones)
+            deferred_reward = self.deferred_reward[env_ids] + rewards
+            rewards = np.where(give_rewards, deferred_reward, 0)
+            self.deferred_reward[env_ids] = np.where(give_rewards, 0, deferred_reward)
+
+        info = self.info_arrays
+        info['reward'][env_ids] = rewards
+        info['raw_reward'][env_ids] = raw_rewards
+        info['done'][env_ids] = all_dones
+        info['time'][env_ids] = np.where(dones, 0, self.time[env_ids])
+        info['ep_score'][env_ids] = self.ep_score[env_ids]
+        info['ep_length'][env_ids] = self.ep_length[env_ids]
+        info['lives'][env_ids] = lives
+        info['fake_done'][env_ids] = fake_dones
+
+        if self.timeout > 0:
+            time_frac = np.where(all_dones, 0, self.time[env_ids] / self.timeout)
+        else:
+            time_frac = np.zeros([len(env_ids)])
+
+        # the vector env resets environments that are done, which for loss of life only performs a noop step.
+        real_resets = env_ids[dones]
+        if len(real_resets) > 0:
+            frames[dones], self.lives[real_resets] = self._envpool_reset(real_resets)
+            self.time[real_resets] = 0
+            self.ep_score[real_resets] = 0
+            self.ep_length[real_resets] = 0
+
+        life_resets = env_ids[fake_dones & ~dones]
+        if len(life_resets) > 0:
+            life_frames, life_rewards, life_dones, life_lives = self._envpool_step(np.zeros_like(life_resets), life_resets)
+            self.game_over[life_resets] = life_dones
+            frames[fake_dones & ~dones] = life_frames
+            self.time[life_resets] += 1
+            self.ep_score[life_resets] += life_rewards
+            self.ep_length[life_resets] += 1
+            self.lives[life_resets] = life_lives
+
+        reset_ids = env_ids[all_dones]
+        self.deferred_t[reset_ids] = 0
+        self.deferred_reward[reset_ids] = 0
+
+        self._write_obs(env_ids, frames, actions, time_frac, all_dones)
+
+    def close_extras(self, **kwargs):
+        self.env.close()
@@ -11,7 +11,9 @@ import gym
 
 from rl import atari, mujoco, procgen
 from rl import hybridVecEnv         # this is my vector env, it's a bit clunky, but it gets the job done.
+from rl import envpoolVecEnv
 from rl import wrappers
+from rl import utils
 
 def make_env(env_type, env_id, **kwargs):
     """
@@ -27,109 +29,56 @@ def make_env(env_type, env_id, **kwargs):
         raise ValueError(f"Invalid environment type {env_type}")
     return make_fn(env_id, **kwargs)
 
-def create_envs_envpool(N=None, monitor_video=False):
+def create_envs(N=None, monitor_video=False):
     """
-    Creates environments using (faster) envpool. Not all features supported et
+    Creates (vectorized) environments for runner, using the backend given by args.env.backend.
     """
+    if args.env.backend == "classic":
+        return create_envs_classic(N, monitor_video=monitor_video)
+    elif args.env.backend == "envpool":
+        return create_envs_envpool(N, monitor_video=monitor_video)
+    else:
+        raise ValueError(f"Invalid env_backend {args.env.backend}")
 
-    # lazy load, as this might not be on cluster yet...
-    import envpool
 
-    # build id
-    env_id = f"{args.env.type}:{args.env.name}"
+def add_vec_wrappers(vec_env):
+    """
+    Applies the standard vector wrappers (reward normalization etc.) used by both backends.
+    """
 
-    # build gym args
-    gym_args = {}
-    if args.env.type == "procgen":
-        gym_args.update(
-            difficulty = args.env.procgen_difficulty
-        )
-    if args.env.type == "atari":
-        gym_args.update(
-            repeat_action_probability=args.env.repeat_action_probability,
-            full_action_space=args.env.full_action_space,
+    # ema normalization is handled externally.
+    if args.env.reward_normalization == "rms":
+        vec_env = wrappers.VecNormalizeRewardWrapper(
+            vec_env,
+            gamma=args.reward_normalization_gamma,
+            mode="rms",
+            clip=args.env.reward_normalization_clipping,
         )
 
-    envs = envpool.make_gym(env_id, **gym_args)
-
-    # todo: make sure no timelimit was applied
-
-    if args.env.type == "atari":
-        # todo: rom check
-        pass
-
-    # standard wrappers
-    # label env_id
-    # label seed
-    # set seeds (do above?)
-
-    # todo...
-    # per step termination prob
-    # save env state (might be hard?)
-
-    if args.env.is_vision_env:
-
-        # vision processing... it's quite a long list...
-        # i'll try to integrate these two as much as I can.
-
-        if args.env.type == "atari":
-            # maybe we can change the config to get env pool to do this?
-            assert args.env.color_mode == "bw", f"Envpool generates black and white frames, so {args.env.color_mode} format is not supported."
-            assert args.env.res_x == args.env.res_y, "Atari preprocessing only supports square resolutions."
-
-        # -------------------------
-        # for atari...
-        # -------------------------
-        # noop start
-
-        # [done] frame skip
-        # timelimit
-        # mr info
-        # monitor video
-        # ep score
-        # reward clipping
-        # atari processing (scale?)
-
-        envs = gym.wrappers.AtariPreprocessing(
-            envs,
-            noop_max=args.env.noop_duration,
-            frame_skip=args.env.frame_skip,
-            screen_size=args.env.res_x,
-            terminal_on_life_loss=args.env.atari_terminal_on_loss_of_life,
-            grayscale_obs=False,
-            scale_obs=False,
-        )
-        # zero obs
-        # color transform
-        # terminal on loss of life
-        # differed reward
-        # embed action
-        # [done] framestack
-        # embed time
-        # embed state (remove?)
-        # channels first (if needed)
-        # null action wrapper (won't work anymore... remove, this will make desync impossiable though)
-
-        # -------------------------
-        # for procgen...
-        # -------------------------
-        # timelimit
-        # procgen wrapper
-        # monitor video
-        # color transform
-        # embed time
-        # channels first
-        # ep score
-        # embed action
-        # null action
-    else:
-        # this is really just for mujoco
-        raise Exception("Mujoco not yet supported with envpool.")
+    if args.env.max_repeated_actions > 0 and args.env.type != "mujoco":
+        vec_env = wrappers.VecRepeatedActionPenalty(vec_env, args.env.max_repeated_actions,
+                                                         args.env.repeated_action_penalty)
 
-    # other standard
+    return vec_env
 
-    return envs
 
+def create_envs_envpool(N=None, monitor_video=False):
+    """
+    Creates (vectorized) environments for runner using envpool, which is much faster than the classic method.
+    Observations and infos match the classic method (see envpoolVecEnv for the differences).
+    """
+
+    assert not monitor_video, "Video monitoring is not supported with envpool."
+    assert args.env.is_vision_env, "Only atari and procgen are supported with envpool."
+
+    N = N or args.agents
+    base_seed = args.seed
+    if base_seed is None or base_seed < 0:
+        base_seed = np.random.randint(0, 9999)
+
+    vec_env = envpoolVecEnv.EnvPoolVecEnv(args.env.type, args.env.name, N, seed=base_seed, args=args)
+
+    return add_vec_wrappers(vec_env)
 
 
 def create_envs_classic(N=None, monitor_video=False):
@@ -143,30 +92,53 @@ def create_envs_classic(N=None, monitor_video=False):
     base_seed = args.seed
     if base_seed is None or base_seed < 0:
         base_seed = np.random.randint(0, 9999)
+    if args.env.vector_preprocessing:
+        assert args.env.type == "atari", "vector_preprocessing is only supported for atari."
+        # environments return raw frames, which are then processed by each worker as a batch.
+        vec_wrapper = atari.make_vec_preprocessing(args)
+        make_kwargs = {'vector_preprocessing': True}
+    else:
+        vec_wrapper = None
+        make_kwargs = {}
+
     env_fns = [lambda i=i: make_env(args.env.type, env_id=args.env.name, args=args, seed=base_seed + (i * 997),
-                                    monitor_video=monitor_video) for i in range(N)]
+                                    monitor_video=monitor_video, **make_kwargs) for i in range(N)]
+
+    if args.direct_obs:
+        assert not args.sync_envs, "direct_obs requires async environments (sync_envs=False)."
+        # one slot for each step of the rollout, plus the final observation (see Runner.all_obs)
+        obs_slots = args.n_steps + 1
+    else:
+        obs_slots = 1
 
     if args.sync_envs:
         vec_env = gym.vector.SyncVectorEnv(env_fns)
-    else:
+        if vec_wrapper is not None:
+            vec_env = vec_wrapper(vec_env)
+    elif args.worker_topology == "auto":
+        vec_env = hybridVecEnv.select_topology(
+            env_fns,
+            max_cpus=args.workers,
+            numa_groups=utils.detect_numa_groups(),
+            verbose=True,
+            copy=False,
+            compact_infos=args.env.compact_infos,
+            shared_actions=args.env.shared_actions,
+            vec_wrapper=vec_wrapper,
+            obs_slots=obs_slots,
+        )
+    elif args.worker_topology == "fixed":
         vec_env = hybridVecEnv.HybridAsyncVectorEnv(
             env_fns,
             copy=False,
             max_cpus=args.workers,
-            verbose=True
+            verbose=True,
+            compact_infos=args.env.compact_infos,
+            shared_actions=args.env.shared_actions,
+            vec_wrapper=vec_wrapper,
+            obs_slots=obs_slots,
         )
+    else:
+        raise ValueError(f"Invalid worker_topology {args.worker_topology}")
 
-    # ema normalization is handled externally.
-    if args.env.reward_normalization == "rms":
-        vec_env = wrappers.VecNormalizeRewardWrapper(
-            vec_env,
-            gamma=args.reward_normalization_gamma,
-            mode="rms",
-            clip=args.env.reward_normalization_clipping,
-        )
-
-    if args.env.max_repeated_actions > 0 and args.env.type != "mujoco":
-        vec_env = wrappers.VecRepeatedActionPenalty(vec_env, args.env.max_repeated_actions,
-                                                         args.env.repeated_action_penalty)
-
-    return vec_env
\ No newline at end of file
+    return add_vec_wrappers(vec_env)
\ No newline at end of file
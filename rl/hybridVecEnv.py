@@ -1,24 +1,93 @@
 import gym
 import numpy as np
 import functools
+import multiprocessing
+import os
 import sys
+import time
 
 from rl import wrappers, utils
 
 from gym.vector import AsyncVectorEnv, SyncVectorEnv
-from gym.vector.utils import write_to_shared_memory, concatenate
+from gym.vector.async_vector_env import AsyncState
 from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from typing import List
+
+
+# typed per-env info fields, written by the workers into shared memory (see HybridAsyncVectorEnv.info_arrays).
+# reward and done are as returned by the environment (i.e. before any vector wrappers).
+INFO_DTYPE = np.dtype([
+    ('reward', np.float64),
+    ('raw_reward', np.float32),
+    ('done', np.bool_),
+    ('time', np.int32),
+    ('ep_score', np.float64),
+    ('ep_length', np.int32),
+    ('lives', np.int32),
+    ('room_count', np.float32),
+    ('fake_done', np.bool_),
+], align=True)
+
+# info key, and value used when key is missing, for each of the info fields.
+INFO_KEYS = {
+    'raw_reward': ('raw_reward', np.nan),
+    'time': ('time', 0),
+    'ep_score': ('ep_score', 0),
+    'ep_length': ('ep_length', 0),
+    'lives': ('ale.lives', -1),
+    'room_count': ('room_count', np.nan),
+    'fake_done': ('fake_done', False),
+}
+
+# keys that are given every step but not needed during training, these are not sent when using compact infos.
+INFO_DROP_KEYS = {'time_frac', 'channels'}
+
+# keys that are sent as fields, and so do not need to be sent as dictionaries.
+_INFO_FIELD_KEYS = {key for key, default in INFO_KEYS.values()}
+
+
+def write_info_arrays(target: np.ndarray, rewards, dones, infos):
+    """
+    Writes rewards, dones and info fields into target, which is a structured array of dtype INFO_DTYPE.
+    """
+    target['reward'] = rewards
+    target['done'] = dones
+    for field, (key, default) in INFO_KEYS.items():
+        target[field] = [info.get(key, default) for info in infos]
+
+
+def info_arrays_from_infos(rewards, dones, infos) -> np.ndarray:
+    """
+    Converts a list of info dictionaries into a structured array of dtype INFO_DTYPE.
+    """
+    result = np.zeros([len(infos)], dtype=INFO_DTYPE)
+    write_info_arrays(result, rewards, dones, infos)
+    return result
+
+
+def get_info_arrays(vec_env, rewards, dones, infos) -> np.ndarray:
+    """
+    Returns info fields for the most recent step of vec_env as a structured array of dtype INFO_DTYPE.
+    Environments that do not provide them (e.g. SyncVectorEnv) have them generated from infos.
+    """
+    info_arrays = getattr(vec_env, "info_arrays", None)
+    if info_arrays is None:
+        info_arrays = info_arrays_from_infos(rewards, dones, infos)
+    return info_arrays
 
 
 # modified to support vector environments...
 
 class ThreadVectorEnv(SyncVectorEnv):
-    """Vectorized environment that uses threads to run multiple environments."""
+    """
+    Vectorized environment that uses threads to run multiple environments.
+    Only box observation spaces are supported.
+    """
 
     def __init__(self, env_fns, observation_space=None, action_space=None,
-                 copy=True):
-        self.pool = ThreadPoolExecutor(max_workers=2)
+                 copy=True, threads=2):
+        self.pool = ThreadPoolExecutor(max_workers=threads)
         super().__init__(env_fns, observation_space, action_space, copy)
 
     def step_wait(self):
@@ -35,17 +104,40 @@ class ThreadVectorEnv(SyncVectorEnv):
             if self._dones[i]:
                 observation = env.reset()
             infos[i] = info
-            return observation
-
-        result = self.pool.map(run_env, range(len(self.envs)))
-        observations = list(result)
+            # each thread writes its observation straight into the (possibly shared) output buffer.
+            self.observations[i] = observation
 
-        self.observations = concatenate(observations, self.observations, self.single_observation_space)
+        list(self.pool.map(run_env, range(N)))
 
-        return (deepcopy(self.observations) if self.copy else self.observations,
+        return (self.observations.copy() if self.copy else self.observations,
                 np.copy(self._rewards), np.copy(self._dones), infos)
 
 
+def split_envs(n_envs: int, n_workers: int) -> List[int]:
+    """
+    Returns the number of environments each worker should run, as evenly as possible.
+    """
+    assert 0 < n_workers <= n_envs, f"Can not split {n_envs} environments between {n_workers} workers."
+    base, extra = divmod(n_envs, n_workers)
+    return [base + (1 if i < extra else 0) for i in range(n_workers)]
+
+
+def split_groups(worker_offsets: List[int], n_groups: int) -> List[int]:
+    """
+    Returns the offsets of (at most) n_groups contiguous groups of environments, as evenly sized as possible, with
+    each boundary on a worker boundary (as required by HybridAsyncVectorEnv.step_partial).
+    """
+    offsets = np.asarray(worker_offsets)
+    n_envs = int(offsets[-1])
+    result = [0]
+    for i in range(1, n_groups):
+        boundary = int(offsets[np.argmin(np.abs(offsets - n_envs * i / n_groups))])
+        if result[-1] < boundary < n_envs:
+            result.append(boundary)
+    result.append(n_envs)
+    return result
+
+
 class HybridAsyncVectorEnv(gym.vector.async_vector_env.AsyncVectorEnv):
     """
     Async vector env, that limits the number of worker threads spawned
@@ -53,33 +145,201 @@ class HybridAsyncVectorEnv(gym.vector.async_vector_env.AsyncVectorEnv):
 
     """
 
-    def __init__(self, env_fns, max_cpus=8, verbose=False, copy=True, allow_threaded=True):
-        # create sequential envs for each worker
-        assert len(env_fns) % max_cpus == 0, "Number of environments ({}) must be a multiple of the CPU count ({}).".format(len(env_fns), max_cpus)
-        self.n_sequential = len(env_fns) // max_cpus
+    def __init__(self, env_fns, max_cpus=8, verbose=False, copy=True, allow_threaded=True, compact_infos=False,
+                 shared_actions=False, spin_iterations=1000, threads_per_worker=2, worker_cpus=None, vec_wrapper=None,
+                 obs_slots=1):
+        """
+        max_cpus: number of worker processes. Environments are split as evenly as possible between them.
+        compact_infos: if true only the typed info fields (see INFO_DTYPE) are returned each step, along with any
+            rare keys. This avoids pickling every info dictionary, but infos will be missing keys in INFO_DROP_KEYS
+            and INFO_KEYS (use info_arrays instead).
+        shared_actions: if true actions are written to shared memory, and workers are signalled with semaphores,
+            rather than sending actions through pipes. Other commands (reset, save, load, seed etc) still use the
+            pipes. Works best with compact_infos, as then nothing is sent through the pipes on a typical step.
+        spin_iterations: number of times to poll a worker before sleeping while waiting for it (shared_actions only).
+        threads_per_worker: number of threads each worker uses to step its environments.
+        worker_cpus: (optional) list containing the set of CPUs each worker should be restricted to.
+        vec_wrapper: (optional) function applied to each worker's vector env, e.g. to process observations for all
+            of the worker's environments at once (see wrappers.VecAtariPreprocessing).
+        obs_slots: number of observation buffers of dims [num_envs, *obs_shape] to allocate in shared memory (see
+            obs_buffer). Workers write to the slot given by set_obs_slot, which allows a rollout buffer to be filled
+            without copying.
+        """
         self.n_parallel = max_cpus
+        self.worker_sizes = split_envs(len(env_fns), max_cpus)
+        self.worker_offsets = [int(x) for x in np.cumsum([0] + self.worker_sizes)]
+        self.threads_per_worker = threads_per_worker
         vec_functions = []
         for i in range(self.n_parallel):
             # I prefer the lambda, but it won't work with pickle, and I want to multiprocessor this...
             # Note: thread vector env is a lot faster than gym.vector.sync_vector_env
             # but I'm not 100% sure ALE is thread safe (I think it is ...), but just in case...
 
-            BaseVecEnv = ThreadVectorEnv if allow_threaded else SyncVectorEnv
+            if allow_threaded:
+                BaseVecEnv = functools.partial(ThreadVectorEnv, threads=threads_per_worker)
+            else:
+                BaseVecEnv = SyncVectorEnv
 
-            constructor = functools.partial(BaseVecEnv, env_fns[i*self.n_sequential:(i+1)*self.n_sequential], copy=copy)
+            constructor = functools.partial(BaseVecEnv, env_fns[self.worker_offsets[i]:self.worker_offsets[i+1]], copy=copy)
+            if vec_wrapper is not None:
+                constructor = functools.partial(_make_wrapped_vec_env, constructor, vec_wrapper)
             vec_functions.append(constructor)
 
         if verbose:
-            print("Creating {} cpu workers with {} environments each.".format(self.n_parallel, self.n_sequential))
+            if min(self.worker_sizes) == max(self.worker_sizes):
+                print("Creating {} cpu workers with {} environments each.".format(self.n_parallel, self.worker_sizes[0]))
+            else:
+                print("Creating {} cpu workers with {}-{} environments each.".format(
+                    self.n_parallel, min(self.worker_sizes), max(self.worker_sizes)))
+
+        # the shared memory depends on the environment spaces, which AsyncVectorEnv would only find once it is too
+        # late (the workers are started straight after). So we create its dummy worker env ourselves, and hand it
+        # over to be reused rather than creating a second one.
+        dummy_env = vec_functions[0]()
+        obs_space = dummy_env.single_observation_space
+        action_space = dummy_env.single_action_space
+        vec_functions[0] = _ExistingEnv(vec_functions[0], dummy_env)
+
+        # observations are written by the workers into shared memory, one row per environment.
+        assert type(obs_space) is gym.spaces.Box, "Only box observation spaces are supported."
+        obs_shape = [obs_slots, len(env_fns), *obs_space.shape]
+        self._obs_memory = multiprocessing.RawArray('B', int(np.prod(obs_shape)) * obs_space.dtype.itemsize)
+        # the slot each worker writes its observations to.
+        self._obs_slot_memory = multiprocessing.RawArray('i', self.n_parallel)
+        self._obs_slots = np.frombuffer(self._obs_slot_memory, dtype=np.int32)
+
+        # typed info fields are written by the workers into shared memory, and read here as a zero-copy view.
+        self.compact_infos = compact_infos
+        self._info_memory = multiprocessing.RawArray('B', len(env_fns) * INFO_DTYPE.itemsize)
+        self._info_block = np.frombuffer(self._info_memory, dtype=INFO_DTYPE)
+
+        # optional shared memory action transport
+        self.spin_iterations = spin_iterations
+        if shared_actions:
+            action_shape = [len(env_fns), *action_space.shape]
+            self._action_memory = multiprocessing.RawArray('B', int(np.prod(action_shape)) * action_space.dtype.itemsize)
+            self._shared_actions = np.frombuffer(self._action_memory, dtype=action_space.dtype).reshape(action_shape)
+            # step_ready signals worker that actions are ready, step_done signals parent that results are ready.
+            self._step_ready = [multiprocessing.Semaphore(0) for _ in range(self.n_parallel)]
+            self._step_done = [multiprocessing.Semaphore(0) for _ in range(self.n_parallel)]
+            # 0 = step complete, 1 = step complete and infos were sent on pipe, -1 = error
+            self._status_memory = multiprocessing.RawArray('b', self.n_parallel)
+            self._worker_status = np.frombuffer(self._status_memory, dtype=np.int8)
+        else:
+            self._action_memory = self._status_memory = None
+            self._step_ready = self._step_done = None
+            self._shared_actions = None
+
+        worker = functools.partial(
+            _worker_shared_memory,
+            worker_offsets=self.worker_offsets,
+            obs_memory=self._obs_memory,
+            obs_space=obs_space,
+            obs_slot_memory=self._obs_slot_memory,
+            info_memory=self._info_memory,
+            compact_infos=compact_infos,
+            action_memory=self._action_memory,
+            action_space=action_space if shared_actions else None,
+            step_ready=self._step_ready,
+            step_done=self._step_done,
+            status_memory=self._status_memory,
+            worker_cpus=worker_cpus,
+        )
 
-        super().__init__(vec_functions, copy=copy, shared_memory=True, worker=_worker_shared_memory)
+        # we manage our own shared memory, as workers may have a different number of environments.
+        super().__init__(
+            vec_functions, observation_space=obs_space, action_space=action_space, copy=copy, shared_memory=False,
+            worker=worker
+        )
+        vec_functions[0].close()
 
         # super will set num_envs to number of workers, so we fix it here.
         self.num_envs = len(env_fns)
+        self.observation_space = gym.vector.utils.batch_space(self.single_observation_space, self.num_envs)
+        self.action_space = gym.spaces.Tuple((self.single_action_space,) * self.num_envs)
+        self.obs_buffer = np.frombuffer(self._obs_memory, dtype=obs_space.dtype).reshape(obs_shape)
+        self.observations = self.obs_buffer[0]
+
+        # workers that have been sent an action, but not yet collected (see step_partial)
+        self._dispatched = np.zeros([self.n_parallel], dtype=bool)
+
+        # workers that are running an async step (see send / recv)
+        self._in_flight = np.zeros([self.n_parallel], dtype=bool)
+        self._async_actions = None
+
+        # typed info fields for most recent step (see INFO_DTYPE)
+        self.info_arrays = None
+
+        # set when layout was chosen by select_topology
+        self.topology = None
+
+        # set when obs_buffer has been page locked (see pin_obs_buffer)
+        self._obs_buffer_pinned = False
+
+    def set_obs_slot(self, slot: int, env_ids=None):
+        """
+        Sets the slot of obs_buffer that the given environments (default all) will write their next observations to.
+        env_ids must contain every environment of each worker it touches.
+        """
+        if env_ids is None:
+            self._obs_slots[:] = slot
+            self.observations = self.obs_buffer[slot]
+            return
+
+        env_ids = np.asarray(env_ids)
+        slots = np.broadcast_to(slot, env_ids.shape)
+        workers = np.searchsorted(self.worker_offsets, env_ids, side='right') - 1
+        for worker in np.unique(workers):
+            worker_slots = slots[workers == worker]
+            assert len(worker_slots) == self.worker_sizes[worker] and np.all(worker_slots == worker_slots[0]), \
+                "Every environment of a worker must write to the same slot."
+            self._obs_slots[worker] = worker_slots[0]
+
+    def pin_obs_buffer(self) -> bool:
+        """
+        Page locks obs_buffer, so that uploads to the GPU are faster. The buffer is unpinned when the env is closed.
+        Returns if the buffer was pinned.
+        """
+        if not self._obs_buffer_pinned:
+            self._obs_buffer_pinned = utils.pin_memory(self.obs_buffer)
+        return self._obs_buffer_pinned
+
+    def get_obs_slot(self) -> int:
+        """
+        Returns the slot of obs_buffer that all environments write their observations to.
+        """
+        assert np.all(self._obs_slots == self._obs_slots[0]), "Environments are writing to different slots."
+        return int(self._obs_slots[0])
+
+    def _check_observation_spaces(self):
+        self._assert_is_running()
+        for pipe in self.parent_pipes:
+            pipe.send(('_check_observation_space', self.single_observation_space))
+        same_spaces, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+        self._raise_if_errors(successes)
+        if not all(same_spaces):
+            raise RuntimeError('Some environments have an observation space different from '
+                               f'`{self.single_observation_space}`. In order to batch observations, the '
+                               'observation spaces from all environments must be equal.')
+
+    def _raise_if_errors(self, successes):
+        # successes has one entry per worker, not per environment, so we can not use num_envs here.
+        if all(successes):
+            return
+        for _ in range(len(successes) - sum(successes)):
+            index, exctype, value = self.error_queue.get()
+            self.parent_pipes[index].close()
+            self.parent_pipes[index] = None
+        raise exctype(value)
 
     def reset(self):
-        obs = super().reset()
-        return np.reshape(obs, [-1, *obs.shape[2:]])
+        self._assert_is_running()
+        self._cancel_pending_steps()
+        for pipe in self.parent_pipes:
+            pipe.send(('reset', None))
+        _, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+        self._raise_if_errors(successes)
+        return deepcopy(self.observations) if self.copy else self.observations
 
     def save_state(self, buffer):
         # note we might be able to do this more easily by having a fetch for envs, then iterating over them.
@@ -95,12 +355,10 @@ class HybridAsyncVectorEnv(gym.vector.async_vector_env.AsyncVectorEnv):
                 counter += 1
 
     def seed(self, seeds=None):
-        # put seeds into 2d python array.
-        seeds = np.reshape(seeds, [self.n_parallel, self.n_sequential])
-        seeds = [list(seeds[i]) for i in range(len(seeds))]
-
-        for pipe, seed in zip(self.parent_pipes, seeds):
-            pipe.send(('seed', [int(x) for x in seed]))
+        # split seeds between workers.
+        seeds = [int(x) for x in seeds]
+        for i, pipe in enumerate(self.parent_pipes):
+            pipe.send(('seed', seeds[self.worker_offsets[i]:self.worker_offsets[i+1]]))
         _, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
         self._raise_if_errors(successes)
 
@@ -116,65 +374,491 @@ class HybridAsyncVectorEnv(gym.vector.async_vector_env.AsyncVectorEnv):
         # split data up...
         splits = [{} for _ in range(self.n_parallel)]
         for i in range(self.n_parallel):
-            for j in range(self.n_sequential):
-                splits[i][f"vec_{j:03d}"] = buffer[f"vec_{i*self.n_sequential+j:03d}"]
+            for j in range(self.worker_sizes[i]):
+                splits[i][f"vec_{j:03d}"] = buffer[f"vec_{self.worker_offsets[i]+j:03d}"]
 
         for pipe, save_split in zip(self.parent_pipes, splits):
             pipe.send(('load', save_split))
         self._poll()
         results, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
 
+    def _worker_index(self, env_index: int):
+        """
+        Returns index of worker that starts at given environment index.
+        """
+        assert env_index in self.worker_offsets, \
+            f"Partial steps must align with workers, but {env_index} is not one of {self.worker_offsets}."
+        return self.worker_offsets.index(env_index)
+
+    def step_partial(self, actions, start: int, end: int):
+        """
+        Sends actions to environments [start, end) without waiting for them to complete.
+        This allows the caller to do other work (e.g. forward the next group of agents) while these environments
+        are running. Once every environment has been sent an action, results are collected with step_wait.
+
+        start and end must align with worker boundaries (see worker_offsets).
+        """
+        worker_start = self._worker_index(start)
+        worker_end = self._worker_index(end)
+        self._assert_is_running()
+
+        assert not np.any(self._in_flight), "Can not mix step_partial with send / recv."
+        if self._state == AsyncState.DEFAULT and np.any(self._dispatched):
+            # a previous step was interrupted (e.g. step_wait timed out), so finish it first.
+            self._cancel_pending_steps()
+        assert self._state == AsyncState.WAITING_STEP or self._state == AsyncState.DEFAULT, \
+            f"Can not step while waiting for a pending call to {self._state.value} to complete."
+        assert not np.any(self._dispatched[worker_start:worker_end]), "Environment was stepped twice."
+
+        if self._shared_actions is not None:
+            self._shared_actions[start:end] = actions
+            for i in range(worker_start, worker_end):
+                self._step_ready[i].release()
+        else:
+            for i in range(worker_start, worker_end):
+                worker_actions = actions[self.worker_offsets[i]-start:self.worker_offsets[i+1]-start]
+                self.parent_pipes[i].send(('step', list(worker_actions)))
+        self._dispatched[worker_start:worker_end] = True
+        self._state = AsyncState.WAITING_STEP
+
+    def step_wait(self, timeout=None):
+        assert np.all(self._dispatched), "All environments must be sent an action before calling step_wait."
+        self._assert_is_running()
+        assert self._state == AsyncState.WAITING_STEP, "Calling step_wait without any prior call to step_partial."
+
+        if self._shared_actions is not None:
+            results = [self._wait_for_worker(i, timeout) for i in range(self.n_parallel)]
+        else:
+            if not self._poll(timeout):
+                self._state = AsyncState.DEFAULT
+                raise multiprocessing.TimeoutError(f"The call to step_wait has timed out after {timeout} seconds.")
+            results, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+            self._raise_if_errors(successes)
+        self._dispatched[:] = False
+        self._state = AsyncState.DEFAULT
+
+        infos = self._combine_infos(results)
+        self.info_arrays = self._info_block
+
+        return (
+            deepcopy(self.observations) if self.copy else self.observations,
+            self._info_block['reward'].copy(),
+            self._info_block['done'].copy(),
+            infos,
+        )
+
+    def _wait_for_worker(self, index: int, timeout=None):
+        """
+        Waits for worker to complete its step (shared_actions only), spinning for a while before sleeping.
+        Returns infos sent by the worker.
+        """
+        step_done = self._step_done[index]
+        for _ in range(self.spin_iterations):
+            if step_done.acquire(block=False):
+                break
+        else:
+            if not step_done.acquire(timeout=timeout):
+                self._state = AsyncState.DEFAULT
+                raise multiprocessing.TimeoutError(f"The call to step_wait has timed out after {timeout} seconds.")
+
+        self._dispatched[index] = False
+        return self._read_worker_result(index)
+
+    def _worker_ready(self, index: int, timeout: float = 0):
+        """
+        Returns if worker has completed its step, waiting at most timeout seconds.
+        For shared_actions this consumes the worker's step_done signal, so the result must then be read.
+        """
+        if self._shared_actions is not None:
+            if timeout > 0:
+                return self._step_done[index].acquire(timeout=timeout)
+            return self._step_done[index].acquire(block=False)
+        return self.parent_pipes[index].poll(timeout)
+
+    def _read_worker_result(self, index: int):
+        """
+        Returns infos from a worker that has completed its step.
+        """
+        if self._shared_actions is not None and self._worker_status[index] == 0:
+            return {} if self.compact_infos else [{} for _ in range(self.worker_sizes[index])]
+        result, success = self.parent_pipes[index].recv()
+        if not success:
+            _, exctype, value = self.error_queue.get()
+            raise exctype(value)
+        return result
+
+    def _combine_infos(self, results, workers=None):
+        """
+        Combines infos returned by the given workers (default all) into a list with one entry per environment.
+        """
+        # rewards, dones and common info fields are in shared memory, so the pipe only carries the (remaining) infos.
+        if workers is None:
+            workers = range(self.n_parallel)
+        if not self.compact_infos:
+            return [info for worker_infos in results for info in worker_infos]
+        infos = []
+        for worker_index, rare_infos in zip(workers, results):
+            worker_infos = [{} for _ in range(self.worker_sizes[worker_index])]
+            for i, info in rare_infos.items():
+                worker_infos[i] = info
+            infos.extend(worker_infos)
+        return infos
+
+    def _cancel_pending_steps(self, timeout=None):
+        """
+        Waits for any steps still running (see step_partial and send) and discards their results, so that they can
+        not be mistaken for the result of a later call. With shared_actions, steps that a worker has not yet started
+        are withdrawn, and any step signals left over (e.g. from a step_wait that timed out) are drained.
+        Returns False if a worker did not complete its step within timeout seconds.
+        """
+        pending = self._dispatched | self._in_flight
+        if self._step_ready is not None:
+            for i in range(self.n_parallel):
+                while self._step_ready[i].acquire(block=False):
+                    pending[i] = False
+        for i in np.flatnonzero(pending):
+            if self.parent_pipes[i] is None:
+                # worker has already failed.
+                continue
+            if self._step_done is not None:
+                if not self._step_done[i].acquire(timeout=timeout):
+                    return False
+            elif not self.parent_pipes[i].poll(timeout):
+                return False
+            self._read_worker_result(i)
+        if self._step_done is not None:
+            for step_done in self._step_done:
+                while step_done.acquire(block=False):
+                    pass
+        self._dispatched[:] = False
+        self._in_flight[:] = False
+        self._state = AsyncState.DEFAULT
+        return True
+
+    def close_extras(self, timeout=None, terminate=False):
+        if self._obs_buffer_pinned:
+            # the shared memory is released once obs_buffer is dropped, so it must be unregistered first.
+            utils.unpin_memory(self.obs_buffer)
+            self._obs_buffer_pinned = False
+        if not terminate:
+            try:
+                terminate = not self._cancel_pending_steps(timeout)
+            except Exception:
+                # a worker failed during its last step, so make sure they all stop.
+                terminate = True
+        if terminate:
+            # processes are about to be terminated, so there is no need to wait for the pending call.
+            self._state = AsyncState.DEFAULT
+        super().close_extras(timeout=timeout, terminate=terminate)
+
     def step(self, actions):
+        self.step_partial(actions, 0, self.num_envs)
+        return self.step_wait()
+
+    def send(self, actions, env_ids=None):
         """
-        mask: (optional) boolean nd array of shape [A] indicating which environments should accept this input.
+        Sends actions to the given environments (default all), without waiting for them to complete.
+        Results are collected with recv, which returns environments as soon as they are ready, so that slow workers
+        do not hold up the others (similar to envpool's async mode).
+
+        env_ids must contain every environment of each worker it touches, which is always the case for the env_ids
+        returned by recv.
         """
-        # put actions into 2d python array.
-        if type(actions[0]) is tuple:
-            n = len(actions[0])
-            actions = np.reshape(actions, [self.n_parallel, self.n_sequential, n])
-            actions = [list(actions[i]) for i in range(len(actions))]
+        env_ids = np.arange(self.num_envs) if env_ids is None else np.asarray(env_ids)
+        workers = np.unique(np.searchsorted(self.worker_offsets, env_ids, side='right') - 1)
+        assert len(np.unique(env_ids)) == len(env_ids) == sum(self.worker_sizes[w] for w in workers), \
+            "Actions must be sent to every environment of a worker."
+        assert not np.any(self._in_flight[workers]), "Environment was sent an action before its result was received."
+        assert self._state == AsyncState.DEFAULT, \
+            f"Can not send actions while waiting for a pending call to {self._state.value} to complete."
+        self._assert_is_running()
+
+        if self._shared_actions is not None:
+            self._shared_actions[env_ids] = actions
+            for i in workers:
+                self._step_ready[i].release()
         else:
-            n, *action_shape = actions.shape
-            actions = np.reshape(actions, [self.n_parallel, self.n_sequential, *action_shape])
-            actions = [list(actions[i]) for i in range(len(actions))]
+            if self._async_actions is None:
+                actions = np.asarray(actions)
+                self._async_actions = np.zeros([self.num_envs, *actions.shape[1:]], dtype=actions.dtype)
+            self._async_actions[env_ids] = actions
+            for i in workers:
+                self.parent_pipes[i].send(('step', list(self._async_actions[self.worker_offsets[i]:self.worker_offsets[i+1]])))
+        self._in_flight[workers] = True
+
+    def recv(self, min_envs: int = 1, timeout=None):
+        """
+        Waits until at least min_envs environments (or all environments in flight, if fewer) have completed their
+        step, and returns the results of every environment that is ready.
 
-        observations_list, rewards, dones, infos = super().step(actions)
+        Returns obs, rewards, dones, infos, env_ids where env_ids gives the environment index of each row.
+        """
+        self._assert_is_running()
+        pending = list(np.flatnonzero(self._in_flight))
+        assert len(pending) > 0, "Calling recv without any environments in flight."
+        min_envs = min(min_envs, sum(self.worker_sizes[w] for w in pending))
+
+        deadline = None if timeout is None else time.time() + timeout
+        ready = []
+        ready_envs = 0
+        spins = 0
+        while ready_envs < min_envs:
+            for i in list(pending):
+                if self._worker_ready(i):
+                    pending.remove(i)
+                    ready.append(i)
+                    ready_envs += self.worker_sizes[i]
+            if ready_envs >= min_envs:
+                break
+            if deadline is not None and time.time() > deadline:
+                # workers that are ready have consumed their step_done signal, so their results must be read now.
+                for i in ready:
+                    self._in_flight[i] = False
+                    self._read_worker_result(i)
+                raise multiprocessing.TimeoutError(f"The call to recv has timed out after {timeout} seconds.")
+            spins += 1
+            if spins > self.spin_iterations:
+                # sleep a little while waiting for the first pending worker.
+                if self._worker_ready(pending[0], timeout=0.001):
+                    ready.append(pending.pop(0))
+                    ready_envs += self.worker_sizes[ready[-1]]
+
+        ready = sorted(ready)
+        results = []
+        for i in ready:
+            self._in_flight[i] = False
+            results.append(self._read_worker_result(i))
+        infos = self._combine_infos(results, ready)
+
+        env_ids = np.concatenate([np.arange(self.worker_offsets[i], self.worker_offsets[i+1]) for i in ready])
+        self.info_arrays = self._info_block[env_ids]
+        slots = np.repeat(self._obs_slots[ready], [self.worker_sizes[i] for i in ready])
 
         return (
-            np.reshape(observations_list, [-1, *observations_list.shape[2:]]),
-            np.reshape(rewards, [-1]),
-            np.reshape(dones, [-1]),
-            np.reshape(infos, [-1])
+            self.obs_buffer[slots, env_ids],
+            self.info_arrays['reward'].copy(),
+            self.info_arrays['done'].copy(),
+            infos,
+            env_ids,
         )
 
-def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
+
+def get_numa_cpus(numa_groups) -> List[List[int]]:
+    """
+    Returns list of CPUs for each of the given NUMA nodes (as returned by utils.detect_numa_groups).
+    """
+    result = []
+    for node in numa_groups:
+        cpus = []
+        with open(f"/sys/devices/system/node/node{node}/cpulist", "r") as f:
+            for part in f.read().strip().split(","):
+                if "-" in part:
+                    a, b = part.split("-")
+                    cpus.extend(range(int(a), int(b) + 1))
+                elif part != "":
+                    cpus.append(int(part))
+        result.append(cpus)
+    return result
+
+
+def get_worker_cpus(n_workers: int, numa_groups=None):
+    """
+    Assigns workers to NUMA nodes round robin, and returns the CPUs each worker may run on.
+    Returns None if there is only one NUMA node (or numactl is not installed).
+    """
+    if not numa_groups or len(numa_groups) <= 1:
+        return None
+    try:
+        node_cpus = get_numa_cpus(numa_groups)
+    except OSError:
+        return None
+    return [node_cpus[i % len(node_cpus)] for i in range(n_workers)]
+
+
+def benchmark_topology(env_fns, workers: int, threads: int, steps: int = 50, numa_groups=None, **kwargs):
+    """
+    Returns environment steps per second for given (workers x threads) layout, using random actions.
+    """
+    vec_env = HybridAsyncVectorEnv(
+        env_fns,
+        max_cpus=workers,
+        threads_per_worker=threads,
+        worker_cpus=get_worker_cpus(workers, numa_groups),
+        **kwargs,
+    )
+    try:
+        vec_env.reset()
+        action_space = vec_env.single_action_space
+        actions = np.asarray([action_space.sample() for _ in range(len(env_fns))])
+        # first step can be slow, so do not include it.
+        vec_env.step(actions)
+        start_time = time.time()
+        for _ in range(steps):
+            vec_env.step(actions)
+        return steps * len(env_fns) / (time.time() - start_time)
+    finally:
+        vec_env.close()
+
+
+def select_topology(env_fns, max_cpus: int, numa_groups=None, steps: int = 50, verbose=False, obs_slots: int = 1,
+                    **kwargs):
+    """
+    Benchmarks a few (workers x threads) layouts for the given environments, and creates a HybridAsyncVectorEnv
+    using the fastest. Workers are spread over the given NUMA nodes.
+    The chosen layout and its steps per second are stored in the topology attribute of the returned vector env.
+    Candidates are benchmarked with a single observation slot, only the returned env allocates obs_slots.
+    """
+    n_envs = len(env_fns)
+    worker_counts = sorted({min(max(x, 1), n_envs) for x in [max_cpus // 2, max_cpus, max_cpus * 2]})
+    if numa_groups:
+        # keep the workers balanced between nodes.
+        worker_counts = [x for x in worker_counts if x % len(numa_groups) == 0] or worker_counts
+
+    results = {}
+    for workers in worker_counts:
+        for threads in [1, 2]:
+            results[(workers, threads)] = benchmark_topology(
+                env_fns, workers, threads, steps=steps, numa_groups=numa_groups, **kwargs
+            )
+            if verbose:
+                print(f" -{workers} workers x {threads} threads: {round(results[(workers, threads)]):,} steps per second.")
+
+    (workers, threads), steps_per_second = max(results.items(), key=lambda x: x[1])
+
+    vec_env = HybridAsyncVectorEnv(
+        env_fns,
+        max_cpus=workers,
+        threads_per_worker=threads,
+        worker_cpus=get_worker_cpus(workers, numa_groups),
+        verbose=verbose,
+        obs_slots=obs_slots,
+        **kwargs,
+    )
+    vec_env.topology = {
+        'workers': workers,
+        'threads': threads,
+        'numa_groups': list(numa_groups) if numa_groups else [],
+        'steps_per_second': steps_per_second,
+    }
+    return vec_env
+
+
+def _make_wrapped_vec_env(make_vec_env, vec_wrapper):
+    return vec_wrapper(make_vec_env())
+
+
+class _ExistingEnv:
+    """
+    Env constructor that returns an env that has already been created the first time it is called by the process
+    that created it, and otherwise constructs a new one (e.g. in a worker).
+    """
+
+    def __init__(self, make_env, env):
+        self.make_env = make_env
+        self.env = env
+        self.pid = os.getpid()
+
+    def __call__(self):
+        if self.env is not None and os.getpid() == self.pid:
+            env, self.env = self.env, None
+            return env
+        return self.make_env()
+
+    def __getstate__(self):
+        # the existing env is never sent to another process.
+        return {**self.__dict__, 'env': None}
+
+    def close(self):
+        """ Closes the existing env if it was never used. """
+        if self.env is not None:
+            self.env.close()
+            self.env = None
+
+
+def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error_queue, worker_offsets=None,
+                          obs_memory=None, obs_space=None, obs_slot_memory=None, info_memory=None, compact_infos=False,
+                          action_memory=None, action_space=None, step_ready=None, step_done=None, status_memory=None,
+                          worker_cpus=None):
 
     import os
     os.nice(1) # give priority to the main threads so they can keep the GPU full
 
-    assert shared_memory is not None
+    if worker_cpus is not None:
+        os.sched_setaffinity(0, worker_cpus[index])
+
     env = env_fn()
-    observation_space = env.observation_space
     parent_pipe.close()
+
+    env_slice = slice(worker_offsets[index], worker_offsets[index+1])
+    obs_buffer = np.frombuffer(obs_memory, dtype=obs_space.dtype).reshape([-1, worker_offsets[-1], *obs_space.shape])
+    obs_slots = np.frombuffer(obs_slot_memory, dtype=np.int32)
+    info_block = np.frombuffer(info_memory, dtype=INFO_DTYPE)[env_slice]
+
+    if action_memory is not None:
+        all_actions = np.frombuffer(action_memory, dtype=action_space.dtype).reshape([-1, *action_space.shape])
+        actions = all_actions[env_slice]
+        status = np.frombuffer(status_memory, dtype=np.int8)
+        step_ready = step_ready[index]
+        step_done = step_done[index]
+
+    def get_obs_block():
+        """ Returns the part of the shared observation buffer that we should write to. """
+        obs_block = obs_buffer[obs_slots[index], env_slice]
+        if isinstance(env, SyncVectorEnv):
+            # have the vector env write the observations straight into shared memory.
+            env.observations = obs_block
+        return obs_block
+
+    def do_step(data):
+        """ Steps environment, and returns the infos that need to be sent to the parent. """
+        obs_block = get_obs_block()
+        observation, reward, done, info = env.step(data)
+        # Vectorized environments will reset by themselves so we don't need to auto reset them here.
+        if type(done) != np.ndarray and done:
+            observation = env.reset()
+        if observation is not obs_block:
+            obs_block[:] = observation
+        write_info_arrays(info_block, reward, done, info)
+        if compact_infos:
+            # only send the keys that are not already in shared memory, which are usually none.
+            rare_infos = {}
+            for i, env_info in enumerate(info):
+                extra_keys = env_info.keys() - _INFO_FIELD_KEYS - INFO_DROP_KEYS
+                if len(extra_keys) > 0:
+                    rare_infos[i] = {k: env_info[k] for k in extra_keys}
+            return rare_infos
+        else:
+            return info
+
     try:
         while True:
+
+            if action_memory is not None:
+                # fast path, actions are in shared memory. We check the pipe every 10ms for other commands.
+                if step_ready.acquire(timeout=0.01):
+                    result = do_step(list(actions))
+                    if len(result) > 0:
+                        pipe.send((result, True))
+                        status[index] = 1
+                    else:
+                        status[index] = 0
+                    step_done.release()
+                    continue
+                if not pipe.poll():
+                    continue
+
             command, data = pipe.recv()
 
             # print(f"received command {command}")
 
             if command == 'reset':
+                obs_block = get_obs_block()
                 observation = env.reset()
-                write_to_shared_memory(index, observation, shared_memory,
-                                       observation_space)
+                if observation is not obs_block:
+                    obs_block[:] = observation
                 pipe.send((None, True))
             elif command == 'step':
-                observation, reward, done, info = env.step(data)
-                # Vectorized environments will reset by themselves so we don't need to auto reset them here.
-                if type(done) != np.ndarray and done:
-                    observation = env.reset()
-                write_to_shared_memory(index, observation, shared_memory,
-                                       observation_space)
-                pipe.send(((None, reward, done, info), True))
+                pipe.send((do_step(data), True))
             elif command == 'seed':
                 env.seed(data)
                 pipe.send((None, True))
@@ -191,7 +875,7 @@ def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error
                 pipe.send((None, True))
                 break
             elif command == '_check_observation_space':
-                pipe.send((data == observation_space, True))
+                pipe.send((data == env.single_observation_space, True))
             else:
                 raise RuntimeError('Received unknown command `{0}`. Must '
                     'be one of {`reset`, `step`, `save`, `load`, `seed`, `close`, '
@@ -199,5 +883,9 @@ def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error
     except (KeyboardInterrupt, Exception):
         error_queue.put((index,) + sys.exc_info()[:2])
         pipe.send((None, False))
+        if step_done is not None:
+            # make sure parent is not left waiting for us.
+            status[index] = -1
+            step_done.release()
     finally:
         env.close()
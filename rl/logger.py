@@ -169,6 +169,7 @@ class Logger():
     def add_variable(self, variable: LogVariable):
         self._vars[variable.name] = variable
 
+    @utils.no_compile  # logging is host side, and should not be traced by torch.compile
     def watch(self, key, value, **kwargs):
         """ Logs a value, creates log variable if needed. """
         if self.mode == self.LM_MUTE:
@@ -198,6 +199,7 @@ class Logger():
         """ Logs a value, creates full variable if needed. """
         self.watch(key, value, history_length=history_length, type="stats", **kwargs)
 
+    @utils.no_compile
     def watch_mean_std(self, key, value: np.ndarray, **kwargs):
         """ Logs a value, creates full variable if needed. """
         self.watch_mean(key, np.mean(value), **kwargs)
@@ -206,6 +208,7 @@ class Logger():
         self.watch_mean(key+"_std", np.std(value), **kwargs)
 
 
+    @utils.no_compile
     def watch_stats(self, key, value, history_length=100, **kwargs):
         """ Logs a value, creates full variable if needed. """
 
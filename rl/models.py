@@ -32,6 +32,18 @@ def get_memory_format():
 def get_dtype():
     return torch.float16 if AMP else torch.float32
 
+AUTOCAST_DTYPES = {
+    "off": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+def get_autocast(device: torch.device, dtype: torch.dtype = None):
+    """
+    Returns an autocast context for given device, which does nothing if dtype is None.
+    """
+    return torch.autocast(device_type=device.type, dtype=dtype or torch.float32, enabled=dtype is not None)
+
 class TVFMode(Enum):
     OFF = 'off'
     FIXED = 'fixed'
@@ -144,6 +156,35 @@ class NatureCNN(BaseNet):
 
         return features_out
 
+    @staticmethod
+    def stack_weights(nets: list):
+        """ Returns weights for stacked_forward, which evaluates all given (identically shaped) nets at once. """
+        def conv(name):
+            return torch.cat([getattr(net, name).weight for net in nets]), torch.cat([getattr(net, name).bias for net in nets])
+        if nets[0].hidden_units > 0:
+            fc = torch.stack([net.fc.weight.t() for net in nets]), torch.stack([net.fc.bias for net in nets])[:, None]
+        else:
+            fc = None
+        return conv("conv1"), conv("conv2"), conv("conv3"), fc
+
+    def stacked_forward(self, x, weights):
+        """
+        Forwards input through E networks at once, using weights from stack_weights, returns features as [E, B, D]
+        The input is read once by the first convolution, the others are grouped convolutions.
+        """
+        (w1, b1), (w2, b2), (w3, b3), fc = weights
+        E = len(w1) // len(self.conv1.weight)
+        B = len(x)
+
+        x = F.relu(F.conv2d(x, w1, b1, stride=self.conv1.stride, padding=self.conv1.padding))
+        x = F.relu(F.conv2d(x, w2, b2, stride=self.conv2.stride, padding=self.conv2.padding, groups=E))
+        x = F.relu(F.conv2d(x, w3, b3, stride=self.conv3.stride, padding=self.conv3.padding, groups=E))
+
+        x = torch.reshape(x, [B, E, self.d]).transpose(0, 1)
+        if fc is not None:
+            x = torch.baddbmm(fc[1], x, fc[0])
+        return x
+
 
 class StandardMLP(BaseNet):
     """ Based on https://arxiv.org/pdf/1707.06347.pdf
@@ -168,6 +209,26 @@ class StandardMLP(BaseNet):
 
         return x
 
+    @staticmethod
+    def stack_weights(nets: list):
+        """ Returns weights for stacked_forward, which evaluates all given (identically shaped) nets at once. """
+        fc1 = torch.cat([net.fc1.weight for net in nets]), torch.cat([net.fc1.bias for net in nets])
+        fc2 = torch.stack([net.fc2.weight.t() for net in nets]), torch.stack([net.fc2.bias for net in nets])[:, None]
+        return fc1, fc2
+
+    def stacked_forward(self, x, weights):
+        """
+        Forwards input through E networks at once, using weights from stack_weights, returns features as [E, B, D]
+        """
+        (w1, b1), (w2, b2) = weights
+        E = len(w1) // self.hidden_units
+        B = len(x)
+
+        x = torch.tanh(F.linear(x, w1, b1))
+        x = torch.reshape(x, [B, E, self.hidden_units]).transpose(0, 1)
+        x = torch.baddbmm(b2, x, w2)
+        return x
+
 
 class RTG_LSTM(BaseNet):
     """ Takes stacked frames as input, and outputs features.
@@ -327,6 +388,7 @@ class DualHeadNet(nn.Module):
             head_bias: bool=False,
 
             device=None,
+            amp_dtype: torch.dtype = None,
             **kwargs
     ):
         """
@@ -338,6 +400,7 @@ class DualHeadNet(nn.Module):
         @tvf_fixed_head_horizons: if given then model enables tvf with fixed heads at these locations.
         @value_heads: list of value heads to output, a standard and tvf output will be created.
         @device: the device to allocate model to
+        @amp_dtype: if given the encoder is run under autocast with this dtype, heads are always float32
         """
 
         if len(kwargs) > 0:
@@ -349,6 +412,7 @@ class DualHeadNet(nn.Module):
         self.encoder = construct_network(encoder, input_dims, hidden_units=hidden_units, **kwargs).to(device)
 
         self.hidden_units = hidden_units
+        self.amp_dtype = amp_dtype
 
         self.encoder_activation_fn = activation_fn
 
@@ -436,17 +500,21 @@ class DualHeadNet(nn.Module):
             exclude_policy=False,
             exclude_tvf=False,
             include_features: bool = False,
-            required_tvf_heads: list = None
+            required_tvf_heads: list = None,
+            encoder_features: torch.Tensor = None,
         ):
         """
         x is [B, *state_shape]
 
         @param required_tvf_heads: list of tvf heads required, none evaluates all heads
+        @param encoder_features: if given, these are used instead of encoding x (see TVFModel.stacked_encoder_forward)
         """
 
         result = {}
 
-        encoder_features = self.encoder(x)
+        if encoder_features is None:
+            with get_autocast(x.device, self.amp_dtype):
+                encoder_features = self.encoder(x)
 
         # convert back to float32, and also switch to channels first, not that that should matter.
         encoder_features = encoder_features.float(memory_format=torch.contiguous_format)
@@ -532,7 +600,9 @@ class TVFModel(nn.Module):
             value_head_names=('ext',),
             norm_eps: float = 1e-5,
             head_bias: bool = False,
-            observation_scaling: str = "scaled"
+            observation_scaling: str = "scaled",
+            fused_forward: bool = False,
+            amp: str = "off",
     ):
         """
             Truncated Value Function model
@@ -547,6 +617,9 @@ class TVFModel(nn.Module):
             use_rnd: enables random network distilation for exploration
             hidden_units: number of hidden units to use on FC layer before output
             network_args: dict containing arguments for network
+            fused_forward: evaluates the policy and value encoders in a single pass when gradients are not needed
+                (dual architecture with nature or mlp encoder only, other models run each encoder separately)
+            amp: runs encoders under autocast [off|bf16|fp16], normalization and heads stay in float32
 
         """
 
@@ -577,6 +650,7 @@ class TVFModel(nn.Module):
         self._mu = None
         self._std = None
         self.tvf_fixed_head_horizons = tvf_fixed_head_horizons
+        self.amp_dtype = AUTOCAST_DTYPES[amp]
 
         if type(encoder_args) is str:
             encoder_args = ast.literal_eval(encoder_args)
@@ -598,6 +672,7 @@ class TVFModel(nn.Module):
                 head_scale=head_scale,
                 value_head_names=value_head_names,
                 head_bias=head_bias,
+                amp_dtype=self.amp_dtype,
                 **extra_args,
                 **(encoder_args or {})
             )
@@ -611,6 +686,8 @@ class TVFModel(nn.Module):
             raise Exception("Invalid architecture, use [dual|single]")
 
         self.architecture = architecture
+        self.fused_forward = fused_forward and architecture == "dual" and hasattr(self.policy_net.encoder, "stacked_forward")
+        self._stacked_encoder_weights = None
 
         if self.observation_normalization:
             # we track each channel separately. Helps if one channel is watermarked, or if we are using color.
@@ -795,11 +872,16 @@ class TVFModel(nn.Module):
                 result[k] = v
             return result
 
+        if output in ["default", "full"] and self.fused_forward and not torch.is_grad_enabled():
+            policy_features, value_features = self.stacked_encoder_forward(x)
+        else:
+            policy_features, value_features = None, None
+
         if output == "full":
             # this is a special case where we return all heads from both networks
             # required for distillation.
-            policy_part = self.policy_net(x, **args)
-            value_part = self.value_net(x, **args)
+            policy_part = self.policy_net(x, **args, encoder_features=policy_features)
+            value_part = self.value_net(x, **args, encoder_features=value_features)
             for k,v in policy_part.items():
                 result["policy_" + k] = v
             for k, v in value_part.items():
@@ -811,15 +893,46 @@ class TVFModel(nn.Module):
                 x,
                 **args,
                 exclude_value=output == 'default',
+                encoder_features=policy_features,
             ))
         if output in ["default", "value"]:
             result.update(self.value_net(
                 x,
                 **args,
                 exclude_policy=output == 'default',
+                encoder_features=value_features,
                 ))
         return result
 
+    @utils.no_compile
+    def _get_stacked_encoder_weights(self):
+        """
+        Returns stacked weights for the policy and value encoders, these are cached until either encoder's
+        parameters change.
+        """
+        encoders = [self.policy_net.encoder, self.value_net.encoder]
+        key = tuple((p.data_ptr(), p._version) for encoder in encoders for p in encoder.parameters())
+        if self._stacked_encoder_weights is None or self._stacked_encoder_weights[0] != key:
+            with torch.no_grad():
+                self._stacked_encoder_weights = (key, type(encoders[0]).stack_weights(encoders))
+        return self._stacked_encoder_weights[1]
+
+    def stacked_encoder_forward(self, x):
+        """
+        Returns (policy_features, value_features) for (prepped and normalized) input x, evaluating both encoders
+        in a single pass. Gradients are not supported.
+        """
+        with get_autocast(x.device, self.amp_dtype):
+            features = self.policy_net.encoder.stacked_forward(x, self._get_stacked_encoder_weights())
+        return features.unbind(0)
+
+    def enable_compile(self, mode: str = "default"):
+        """
+        Compiles forward with torch.compile, for the first few batch sizes it is called with.
+        See utils.BatchSizeCompiledFunction.
+        """
+        self.forward = utils.BatchSizeCompiledFunction(self.forward, lambda x, *_, **__: len(x), mode=mode)
+
     @torch.no_grad()
     def prep_for_model(self, x, scale_int=True):
         """ Converts data to format for model (i.e. uploads to GPU, converts type).
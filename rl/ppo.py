@@ -14,7 +14,7 @@ from .utils import Color
 
 import torch.multiprocessing
 
-from . import utils, models, keyboard, envs
+from . import utils, models, keyboard, envs, hybridVecEnv
 from .config import args
 
 
@@ -34,7 +34,7 @@ def desync_envs(runner, min_duration:int, max_duration:int, verbose=True):
             utils.sample_action_from_logp(prob) if mask else -1 for prob, mask in zip(log_policy, masks)
         ], dtype=np.int32)
         runner.obs, ext_rewards, dones, infos = runner.vec_env.step(actions)
-        runner.time = np.asarray([info.get("time", 0.0) for info in infos])
+        runner.time = hybridVecEnv.get_info_arrays(runner.vec_env, ext_rewards, dones, infos)["time"].copy()
         if t % 100 == 0 and verbose:
             print(".", end='', flush=True)
 
@@ -78,7 +78,7 @@ def train(model: models.TVFModel, log: Logger):
     end_iteration = math.ceil((final_epoch * 1e6) / batch_size)
 
     runner = Runner(model, log, action_dist="gaussian" if args.env.type == "mujoco" else "discrete")
-    runner.vec_env = envs.create_envs_classic()
+    runner.vec_env = envs.create_envs()
     runner.reset()
 
     # logging
@@ -86,6 +86,12 @@ def train(model: models.TVFModel, log: Logger):
     log.important("Generated {} agents ({}) using {} ({:.2f}M params) {} model.".
                        format(args.agents, "async" if not args.sync_envs else "sync", runner.model.name,
                               model_total_size, runner.model.dtype))
+    topology = getattr(runner.vec_env.unwrapped, "topology", None)
+    if topology is not None:
+        log.info("Using {} workers x {} threads{} ({:,} env steps/s when benchmarked).".format(
+            topology['workers'], topology['threads'],
+            f" over NUMA nodes {topology['numa_groups']}" if topology['numa_groups'] else "",
+            round(topology['steps_per_second'])))
 
 
     # detect a previous experiment
@@ -246,6 +252,10 @@ def train(model: models.TVFModel, log: Logger):
 
     old_header = None
 
+    # env steps and time spent generating rollouts, used for benchmarking
+    rollout_steps = 0
+    rollout_seconds = 0.0
+
     if args.save_initial_checkpoint:
         save_checkpoint(runner, log)
 
@@ -257,6 +267,8 @@ def train(model: models.TVFModel, log: Logger):
 
         rollout_start_time = time.time()
         runner.generate_rollout()
+        rollout_seconds += time.time() - rollout_start_time
+        rollout_steps += batch_size
         rollout_time = (time.time() - rollout_start_time) / batch_size
 
         # calculate returns
@@ -362,7 +374,8 @@ def train(model: models.TVFModel, log: Logger):
                   f"{1000*compression.av_decompression_time():.4f}ms, "
                   f"{compression.ratio():.1f}x ratio"
                   )
-        print(f"IPS: {round(steps/time_to_complete):,}")
+        # IPS is overall throughput, the rollout figure is environment steps per second while generating rollouts.
+        print(f"IPS: {round(steps/time_to_complete):,} (rollout: {round(rollout_steps/max(rollout_seconds, 1e-6)):,} env steps/s)")
 
     # -------------------------------------
     # save final information
@@ -375,6 +388,7 @@ def train(model: models.TVFModel, log: Logger):
     log.important("Training Complete.")
     log.info()
 
+    runner.close()
     utils.release_lock()
 
     if pause_at_end:
@@ -15,21 +15,186 @@ def gae(
     """
     Calculates GAE based on rollout data.
     """
-    N, A = batch_rewards.shape
+    if batch_terminal is None:
+        batch_terminal = np.zeros(batch_rewards.shape, dtype=np.float32)
+    return gae_multi(
+        batch_rewards[..., None],
+        batch_value[..., None],
+        np.asarray(final_value_estimate)[..., None],
+        batch_terminal,
+        gamma,
+        lamb,
+    )[..., 0]
+
+
+# compiled scan kernel, see _get_numba_scan
+_numba_scan = None
+
+
+def _get_numba_scan():
+    """
+    Returns (and compiles on first use) a numba version of the GAE reverse scan.
+    """
+    global _numba_scan
+    if _numba_scan is None:
+        # lazy load, as this might not be installed.
+        import numba
+
+        @numba.njit
+        def scan(delta, decay):
+            N, M = delta.shape
+            advantages = np.empty_like(delta)
+            for m in range(M):
+                prev_adv = np.float32(0)
+                for t in range(N - 1, -1, -1):
+                    prev_adv = delta[t, m] + decay[t, m] * prev_adv
+                    advantages[t, m] = prev_adv
+            return advantages
+
+        _numba_scan = scan
+    return _numba_scan
+
+
+def gae_multi(
+        batch_rewards,
+        batch_value,
+        final_value_estimate,
+        batch_terminal,
+        gamma,
+        lamb,
+        backend: str = "numpy",
+        device=None,
+    ):
+    """
+    Calculates GAE for H (rewards, value estimate, gamma, lambda) combinations at once, with a single reverse pass
+    over time. Head h matches gae(batch_rewards[..., h], batch_value[..., h], ..., gamma[h], lamb[h]).
+    TD(lambda) returns are just the advantages plus the value estimates.
+
+    :param batch_rewards: nd array of dims [N, A, H]
+    :param batch_value: nd array of dims [N, A, H]
+    :param final_value_estimate: nd array of dims [A, H]
+    :param batch_terminal: nd array of dims [N, A, H], or [N, A] if shared between heads.
+    :param gamma: float, or list of length H
+    :param lamb: float, or list of length H
+    :param backend: [numpy|numba|torch], torch runs on device (if given), otherwise on the device the inputs are on.
+    :return: advantages of dims [N, A, H], as a tensor if the inputs were tensors.
+    """
+
+    if backend == "torch":
+        import torch
+        return_numpy = not torch.is_tensor(batch_value)
+        device = device or (batch_value.device if torch.is_tensor(batch_value) else "cpu")
 
-    batch_advantage = np.zeros_like(batch_rewards, dtype=np.float32)
-    prev_adv = np.zeros([A], dtype=np.float32)
+        def to_tensor(x):
+            return torch.as_tensor(x, device=device).to(torch.float32)
+
+        rewards, values, final_value, terminals = (
+            to_tensor(x) for x in (batch_rewards, batch_value, final_value_estimate, batch_terminal)
+        )
+        gamma = to_tensor(np.asarray(gamma, dtype=np.float64))
+        gamma_lamb = to_tensor(np.asarray(gamma, dtype=np.float64) * np.asarray(lamb, dtype=np.float64))
+        cat = torch.cat
+    elif backend in ["numpy", "numba"]:
+        rewards, values, final_value, terminals = batch_rewards, batch_value, final_value_estimate, batch_terminal
+        gamma_lamb = (np.asarray(gamma, dtype=np.float64) * np.asarray(lamb, dtype=np.float64)).astype(np.float32)
+        gamma = np.asarray(gamma, dtype=np.float32)
+        cat = np.concatenate
+    else:
+        raise ValueError(f"Invalid gae backend {backend}")
+
+    N, A, H = values.shape
+
+    if terminals.ndim == 2:
+        terminals = terminals[..., None]
+    # batch_terminal[t] records if prev_state[t] was terminal state
+    not_terminal = 1.0 - terminals
+
+    value_next = cat([values[1:], final_value[None]], 0)
+    delta = rewards + gamma * value_next * not_terminal - values
+    decay = gamma_lamb * not_terminal
+
+    if backend == "numba":
+        scan = _get_numba_scan()
+        return scan(
+            np.ascontiguousarray(delta, dtype=np.float32).reshape(N, -1),
+            np.ascontiguousarray(np.broadcast_to(decay, delta.shape), dtype=np.float32).reshape(N, -1),
+        ).reshape(N, A, H)
+
+    advantages = delta * 0
+    prev_adv = 0
     for t in reversed(range(N)):
-        is_next_new_episode = batch_terminal[
-            t] if batch_terminal is not None else False  # batch_terminal[t] records if prev_state[t] was terminal state)
-        value_next_t = batch_value[t + 1] if t != N - 1 else final_value_estimate
-        delta = batch_rewards[t] + gamma * value_next_t * (1.0 - is_next_new_episode) - batch_value[t]
-        batch_advantage[t] = prev_adv = delta + gamma * lamb * (
-                1.0 - is_next_new_episode) * prev_adv
-    return batch_advantage
+        advantages[t] = prev_adv = delta[t] + decay[t] * prev_adv
+
+    if backend == "numpy":
+        return advantages.astype(np.float32, copy=False)
+    return advantages.cpu().numpy() if return_numpy else advantages
+
+
+class ReturnContext:
+    """
+    Discounted reward sums and terminal positions for a rollout, calculated once so that n_step reward sums and
+    discounts for any n can be read off without recalculating them.
 
+    Stores (in float64)
+        partial_returns[t]: discounted sum of rewards from t up to the end of the episode, or rollout, [N+1, A]
+        next_terminal[t]: index of the first terminal at or after t, or N if there is none, [N, A]
+    """
+
+    def __init__(self, rewards: np.ndarray, dones: np.ndarray, gamma: float):
+        N, A = rewards.shape
+        self.N, self.A = N, A
+        self.gamma = gamma
+        self.rewards = rewards
+        self.dones = dones
+        self.powers = gamma ** np.arange(N + 1, dtype=np.float64)
+
+        self.partial_returns = np.zeros([N + 1, A], dtype=np.float64)
+        self.next_terminal = np.zeros([N + 1, A], dtype=np.int64) + N
+        for t in reversed(range(N)):
+            not_done = 1 - dones[t]
+            self.partial_returns[t] = rewards[t] + gamma * not_done * self.partial_returns[t + 1]
+            self.next_terminal[t] = np.where(not_done, self.next_terminal[t + 1], t)
+        self.next_terminal = self.next_terminal[:N]
+        self._time = np.arange(N)[:, None]
+
+    def _alive(self, n: int):
+        """
+        Returns mask [N-n+1, A] that is true for steps t which reach t+n without a terminal.
+        """
+        return self.next_terminal[:self.N - n + 1] >= self._time[:self.N - n + 1] + n
+
+    def reward_sum(self, n: int) -> np.ndarray:
+        """
+        Returns the discounted sum of the next n rewards (stopping at terminals, or the end of the rollout) [N, A]
+        """
+        result = self.partial_returns[:self.N].copy()
+        if n <= self.N:
+            result[:self.N - n + 1] -= self.powers[n] * self._alive(n) * self.partial_returns[n:]
+        return result.astype(np.float32)
 
-def calculate_bootstrapped_returns(rewards, dones, final_value_estimate, gamma) -> np.ndarray:
+    def discount(self, n: int) -> np.ndarray:
+        """
+        Returns the discount applied to the value estimate n steps ahead (0 if a terminal occurs before then).
+        Steps with fewer than n steps remaining in the rollout use the discount to the end of the rollout. [N, A]
+        """
+        steps = np.minimum(n, self.N - self._time)
+        alive = self.next_terminal >= self._time + steps
+        return (self.powers[steps] * alive).astype(np.float32)
+
+    def tail_discount(self) -> np.ndarray:
+        """
+        Returns the discount from each step to the end of the rollout [N, A]
+        """
+        return self.discount(self.N)
+
+    def bootstrapped_returns(self, final_value_estimate: np.ndarray) -> np.ndarray:
+        """
+        Returns the discounted returns, bootstrapped from the final value estimate [N, A]
+        """
+        return (self.partial_returns[:self.N] + self.tail_discount() * final_value_estimate).astype(np.float32)
+
+
+def calculate_bootstrapped_returns(rewards, dones, final_value_estimate, gamma, context: ReturnContext = None) -> np.ndarray:
     """
     Calculates returns given a batch of rewards, dones, and a final value estimate.
 
@@ -38,9 +203,13 @@ def calculate_bootstrapped_returns(rewards, dones, final_value_estimate, gamma)
     :param dones:   nd array of dims [N,A] where 1 = done and 0 = not done.
     :param final_value_estimate: nd array [A] containing value estimate of final state after last action.
     :param gamma:   discount rate.
+    :param context: (optional) return context for these rewards, dones and gamma.
     :return: np array of dims [N,A]
     """
 
+    if context is not None:
+        return context.bootstrapped_returns(final_value_estimate)
+
     N, A = rewards.shape
 
     returns = np.zeros([N, A], dtype=np.float32)
@@ -3,8 +3,12 @@ Library to help with calculating estimates for truncated returns.
 """
 
 import numpy as np
+import torch
 from typing import Optional
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from .returns import ReturnContext
 
 
 def get_return_estimate(
@@ -20,6 +24,11 @@ def get_return_estimate(
         max_samples: int = 40,
         use_log_interpolation: bool = False,
         seed=None,
+        workers: int = 0,
+        pool: ThreadPoolExecutor = None,
+        backend: str = "numpy",
+        context: ReturnContext = None,
+        interpolator: "HorizonInterpolator" = None,
 ):
     """
     Very slow reference version of return calculation. Calculates a weighted average of multiple n_step returns
@@ -34,6 +43,12 @@ def get_return_estimate(
     @param value_samples: float32 ndarray of dims [N+1, A, V] bootstrap first moment estimates
     @param n_step: horizon to use for fixed / exponential estimator
     @param max_samples: maximum number of samples to use for the weighted average estimators
+    @param workers: if > 1 horizons are split between this many threads. Results do not depend on the number of workers.
+    @param pool: (optional) thread pool to use for the workers, if not given one is created for this call.
+    @param backend: [numpy|torch] torch works on the device the value_samples are on, and returns a tensor.
+    @param context: (optional) ReturnContext for rewards, dones and gamma, so that reward sums can be shared between
+        calls for the same rollout.
+    @param interpolator: (optional) HorizonInterpolator for value_sample_horizons and use_log_interpolation.
 
     returns
         E(r),                       (if only value_samples are provided)        
@@ -45,9 +60,33 @@ def get_return_estimate(
     N, A = rewards.shape
     K = len(required_horizons)
 
-    def calc_return(samples: np.ndarray):
+    if context is not None:
+        assert context.gamma == gamma and (context.N, context.A) == (N, A), "Return context does not match rollout."
+    elif backend != "torch":
+        # (the torch backend calculates its own context on device)
+        to_numpy = lambda x: x.cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+        context = ReturnContext(to_numpy(rewards), to_numpy(dones), gamma)
+
+    def calc_return(samples: np.ndarray = None, n_step_weights: np.ndarray = None):
+        if backend == "torch":
+            return _calculate_sampled_return_multi_torch(
+                n_step_samples=samples,
+                n_step_weights=n_step_weights,
+                gamma=gamma,
+                rewards=rewards,
+                dones=dones,
+                required_horizons=required_horizons,
+                value_sample_horizons=value_sample_horizons,
+                value_samples=value_samples,
+                use_log_interpolation=use_log_interpolation,
+                context=context,
+                interpolator=interpolator,
+            )
+        elif backend != "numpy":
+            raise ValueError(f"Invalid return backend {backend}")
         return _calculate_sampled_return_multi_fast(
             n_step_samples=samples,
+            n_step_weights=n_step_weights,
             gamma=gamma,
             rewards=rewards,
             dones=dones,
@@ -55,6 +94,10 @@ def get_return_estimate(
             value_sample_horizons=value_sample_horizons,
             value_samples=value_samples,
             use_log_interpolation=use_log_interpolation,
+            workers=workers,
+            pool=pool,
+            context=context,
+            interpolator=interpolator,
         )
 
     lamb = 1 - (1 / n_step)
@@ -128,13 +171,8 @@ def get_return_estimate(
                 samples[k, :] = np.random.choice(range(1, len(weights) + 1), size=C, replace=True, p=weights)
         return calc_return(samples)
     elif mode == "full":
-        # calculate each horizon and do a weighted average
-        # very slow...
-        returns = np.zeros([N, A, K], dtype=np.float32)
-        for n_step, weight in zip(range(1, N + 1), weights):
-            n_step_samples = np.zeros([K, 1], dtype=np.int32) + n_step
-            returns += calc_return(n_step_samples) * weight
-        return returns
+        # exact weighted average over every n_step, calculated in a single pass.
+        return calc_return(n_step_weights=np.repeat(weights[None, :], K, axis=0))
     else:
         raise ValueError(f"Invalid return mode {mode}")
 
@@ -620,7 +658,7 @@ def _n_step_estimate(job, rewards, value_sample_horizons, value_samples, discoun
     return idx, target_h, returns
 
 
-def _calculate_sampled_return_multi_fast(
+def _calculate_sampled_return_multi_per_horizon(
         gamma: float,
         rewards: np.ndarray,
         dones: np.ndarray,
@@ -632,7 +670,8 @@ def _calculate_sampled_return_multi_fast(
         use_log_interpolation: bool = False,
 ):
     """
-    New strategy, just generate these returns in parallel, and simplify the algorithm *alot*.
+    Per horizon version of return calculation, processes one job per horizon.
+    Kept as a reference for _calculate_sampled_return_multi_fast, which computes all horizons at once.
 
     @param n_step_samples: nd array of dims [K, C] with C samples for each of K horizons.
     """
@@ -691,3 +730,406 @@ def _calculate_sampled_return_multi_fast(
     assert len(ids) == len(set(ids))
 
     return all_results
+
+
+def _n_step_weights(n_step_samples: np.ndarray, horizons: np.ndarray, N: int, n_step_weights: np.ndarray = None):
+    """
+    Reduces n_step samples [K, C], or a weighting over n_steps [K, M], to weights [K, J] over the J distinct
+    n_steps used. n_steps are clipped to their horizon, and horizons of 0 always have a return of 0.
+
+    @param n_step_weights: if given, n_step_weights[k, n-1] is the weight of n_step n for horizon k.
+
+    returns
+        used_n_steps: sorted distinct (non-zero) n_steps, [J]
+        weights: weights[k, j] is the weight of n_step used_n_steps[j] for horizon k, [K, J]
+    """
+
+    K = len(horizons)
+
+    if n_step_weights is not None:
+        n_step_weights = np.asarray(n_step_weights, dtype=np.float32)
+        M = n_step_weights.shape[1]
+        assert n_step_weights.shape == (K, M) and M <= N
+        n = np.arange(1, M + 1)
+        below_horizon = n[None, :] < horizons[:, None]
+        dense = np.where(below_horizon, n_step_weights, 0)
+        # weight for n_steps at or beyond the horizon all goes to the n_step equal to the horizon.
+        rows = np.flatnonzero((horizons >= 1) & (horizons <= M))
+        dense[rows, horizons[rows] - 1] += np.where(below_horizon, 0, n_step_weights)[rows].sum(axis=1)
+        used_n_steps = np.flatnonzero(np.any(dense != 0, axis=0)) + 1
+        return used_n_steps, dense[:, used_n_steps - 1]
+
+    C = n_step_samples.shape[1]
+    assert n_step_samples.shape == (K, C)
+    n_steps = np.minimum(n_step_samples, horizons[:, None]).astype(np.int64)
+    assert np.all(n_steps[horizons > 0] >= 1) and np.all(n_steps <= N)
+
+    used_n_steps = np.unique(n_steps[n_steps > 0])
+    lookup = np.searchsorted(used_n_steps, n_steps).ravel()
+    mask = n_steps.ravel() > 0
+    weights = np.zeros([K, len(used_n_steps)], dtype=np.float32)
+    np.add.at(weights, (np.repeat(np.arange(K), C)[mask], lookup[mask]), 1 / C)
+    return used_n_steps, weights
+
+
+def _reached_end_weights(used_n_steps: np.ndarray, weights: np.ndarray):
+    """
+    Returns the total weight of n_steps that are at least r, for r = 1..max(used_n_steps), as [K, R].
+    These are the n_steps that reach the end of the rollout when there are r steps remaining.
+    """
+    dense = np.zeros([len(weights), used_n_steps[-1]], dtype=np.float32)
+    dense[:, used_n_steps - 1] = weights
+    return np.cumsum(dense[:, ::-1], axis=1)[:, ::-1]
+
+
+def _interpolation_weights(horizons: np.ndarray, target_horizons: np.ndarray, use_log_interpolation: bool = False):
+    """
+    Vectorized version of _interpolate. Returns indices and weights such that the interpolated value at
+    target_horizons is values[..., i0] * w0 + values[..., i1] * w1.
+
+    horizons: sorted ndarray of shape [V] of horizons
+    target_horizons: ndarray of any shape containing the horizons we would like to know the interpolated values of.
+    """
+
+    horizons = np.asarray(horizons, dtype=np.float64)
+    targets = np.asarray(target_horizons, dtype=np.float64)
+
+    # by definition value of a 0 horizon is 0.
+    mask = targets > 0
+
+    if use_log_interpolation:
+        horizons = np.log10(10 + horizons) - 1
+        targets = np.log10(10 + np.maximum(targets, 0)) - 1
+
+    V = len(horizons)
+    index = np.searchsorted(horizons, targets)
+    post = np.minimum(index, V - 1)
+    pre = np.maximum(index - 1, 0)
+
+    dx = horizons[post] - horizons[pre]
+    # exact matches and out of range targets take a single value
+    interior = (index > 0) & (index < V) & (horizons[post] != targets)
+    # dx is zero if there are repeated values, in this case just take leftmost result
+    lerp = interior & (dx > 0)
+    factor = np.where(lerp, (targets - horizons[pre]) / np.where(lerp, dx, 1), 0)
+
+    i0 = np.where(interior, pre, post)
+    i1 = np.where(lerp, post, i0)
+
+    w0 = ((1 - factor) * mask).astype(np.float32)
+    w1 = (factor * mask).astype(np.float32)
+    return i0, i1, w0, w1
+
+
+class HorizonInterpolator:
+    """
+    Interpolates value estimates at a fixed set of horizons (e.g. the model's value heads) to other horizons.
+
+    Indices and weights for every integer horizon up to max_horizon are calculated once, so interpolation is just
+    a gather and a multiply-add. Non-integer targets fall back to _interpolation_weights.
+    """
+
+    def __init__(self, horizons: np.ndarray, max_horizon: int, use_log_interpolation: bool = False):
+        self.horizons = np.asarray(horizons)
+        self.use_log_interpolation = use_log_interpolation
+        # targets past the last horizon all take the final value, so clamping to the end of the table is exact.
+        self.max_horizon = int(max(max_horizon, self.horizons[-1]))
+        self.i0, self.i1, self.w0, self.w1 = _interpolation_weights(
+            self.horizons, np.arange(self.max_horizon + 1), use_log_interpolation
+        )
+
+    def weights(self, target_horizons: np.ndarray):
+        """
+        Returns indices and weights such that the interpolated value at target_horizons is
+        values[..., i0] * w0 + values[..., i1] * w1. Matches _interpolation_weights.
+        """
+        targets = np.asarray(target_horizons)
+        if not np.issubdtype(targets.dtype, np.integer) and not np.all(np.mod(targets, 1) == 0):
+            return _interpolation_weights(self.horizons, targets, self.use_log_interpolation)
+        # negative horizons share the zero entry, which has weight 0.
+        index = np.clip(targets, 0, self.max_horizon).astype(np.int64)
+        return self.i0[index], self.i1[index], self.w0[index], self.w1[index]
+
+    def __call__(self, values: np.ndarray, target_horizons: np.ndarray):
+        """
+        Returns interpolated values.
+
+        values: ndarray of shape [*shape, V] where values[..., v] corresponds to horizon horizons[v]
+        target_horizons: ndarray of shape [*shape] containing the horizon to interpolate to for each example
+        """
+        targets = np.asarray(target_horizons)
+        assert targets.shape == values.shape[:-1], f"{targets.shape} != {values.shape[:-1]}"
+        i0, i1, w0, w1 = self.weights(targets)
+        v0 = np.take_along_axis(values, i0[..., None], axis=-1)[..., 0]
+        v1 = np.take_along_axis(values, i1[..., None], axis=-1)[..., 0]
+        return v0 * w0 + v1 * w1
+
+
+def _calculate_sampled_return_multi_fast(
+        gamma: float,
+        rewards: np.ndarray,
+        dones: np.ndarray,
+        required_horizons: np.ndarray,
+        value_sample_horizons: np.ndarray,
+        value_samples: np.ndarray,
+        n_step_samples: np.ndarray = None,
+        n_step_list=None,
+        use_log_interpolation: bool = False,
+        workers: int = 0,
+        pool: ThreadPoolExecutor = None,
+        n_step_weights: np.ndarray = None,
+        context: ReturnContext = None,
+        interpolator: HorizonInterpolator = None,
+):
+    """
+    Calculates returns for all horizons at once. Matches _calculate_sampled_return_multi_per_horizon.
+
+    Samples are first reduced to a weight for each (horizon, n_step) pair. The n_step reward sums are then combined
+    with a single matrix multiply, and the bootstrap values are gathered for every horizon sharing an n_step in one go.
+    The final (truncated) n_step estimates only depend on whether a sample reached the end of the rollout, so they
+    are handled with a single gather over [K, n_steps].
+
+    Horizons are independent, so the bootstrapping can be split between threads (numpy releases the GIL). Each
+    horizon is always processed by the same sequence of operations, so results do not depend on the number of workers.
+
+    @param n_step_samples: nd array of dims [K, C] with C samples for each of K horizons.
+    @param workers: if > 1 horizons are split between this many threads.
+    @param pool: (optional) thread pool to use for the workers, if not given one is created (and shut down) here.
+    @param n_step_weights: nd array of dims [K, M] giving the weight of n_steps 1..M for each of K horizons, used
+        instead of samples. The result is the exact weighted average of the n_step returns.
+    @param context: (optional) ReturnContext for rewards, dones and gamma. Reward sums and discounts are read from
+        this rather than cached for every n_step.
+    @param interpolator: (optional) HorizonInterpolator for value_sample_horizons, used to look up interpolation
+        weights rather than calculate them.
+    """
+
+    assert n_step_samples is not None or n_step_list is not None or n_step_weights is not None
+
+    N, A = rewards.shape
+    K = len(required_horizons)
+
+    if n_step_list is not None:
+        n_step_samples = np.asarray([list(n_step_list) for _ in range(K)])
+
+    horizons = np.asarray(required_horizons).astype(np.int64)
+    used_n_steps, weights = _n_step_weights(n_step_samples, horizons, N, n_step_weights)
+    if len(used_n_steps) == 0:
+        return np.zeros([N, A, K], dtype=np.float32)
+    max_n = used_n_steps[-1]
+
+    if interpolator is not None:
+        assert interpolator.use_log_interpolation == use_log_interpolation
+        interpolation_weights = interpolator.weights
+    else:
+        interpolation_weights = lambda x: _interpolation_weights(value_sample_horizons, x, use_log_interpolation)
+
+    if context is None:
+        context = ReturnContext(rewards, dones, gamma)
+    reward_sums = np.stack([context.reward_sum(n) for n in used_n_steps])  # [J, N, A]
+    tail_discount = context.tail_discount()
+
+    # work with horizons as the leading dimension, so that gathers copy contiguous [N, A] blocks.
+    values = np.ascontiguousarray(value_samples.transpose(2, 0, 1))  # [V, N+1, A]
+    all_results = np.einsum('jna,kj->kna', reward_sums, weights, optimize=True)  # [K, N, A]
+    del reward_sums
+
+    # step 1: bootstrap from the value estimates n_steps ahead
+    i0, i1, w0, w1 = interpolation_weights(horizons[:, None] - used_n_steps[None, :])
+    w0 *= weights
+    w1 *= weights
+
+    # step 2: steps within n_step of the end of the rollout bootstrap from the final value estimate
+    # which happens whenever the n_step is at least the number of remaining steps r.
+    remaining = np.arange(1, max_n + 1)
+    reached_end = _reached_end_weights(used_n_steps, weights)  # [K, R]
+    tail_i0, tail_i1, tail_w0, tail_w1 = interpolation_weights(horizons[:, None] - remaining[None, :])
+    tail_w0 *= reached_end
+    tail_w1 *= reached_end
+    final_values = values[:, N]  # [V, A]
+
+    def bootstrap_horizons(k_start: int, k_end: int):
+        """
+        Adds the bootstrap estimates for horizons [k_start, k_end) to all_results.
+        """
+        for j, n_step in enumerate(used_n_steps):
+            if n_step >= N:
+                continue
+            ks = k_start + np.flatnonzero(
+                (weights[k_start:k_end, j] > 0) & (horizons[k_start:k_end] - n_step > 0)
+            )
+            if len(ks) == 0:
+                continue
+            bootstrap = values[i0[ks, j], n_step:N] * w0[ks, j, None, None]
+            bootstrap += values[i1[ks, j], n_step:N] * w1[ks, j, None, None]
+            bootstrap *= context.discount(n_step)[None, :N - n_step]
+            all_results[ks, :N - n_step] += bootstrap
+
+        ks = slice(k_start, k_end)
+        bootstrap = final_values[tail_i0[ks]] * tail_w0[ks, :, None] + final_values[tail_i1[ks]] * tail_w1[ks, :, None]
+        all_results[ks, N - remaining] += tail_discount[None, N - remaining] * bootstrap
+
+    if workers > 1 and K > 1:
+        bounds = np.linspace(0, K, min(workers, K) + 1).astype(int)
+        owned_pool = ThreadPoolExecutor(max_workers=workers) if pool is None else None
+        try:
+            # results are written to disjoint horizons of all_results.
+            futures = [(pool or owned_pool).submit(bootstrap_horizons, lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+        finally:
+            if owned_pool is not None:
+                owned_pool.shutdown(wait=True)
+    else:
+        bootstrap_horizons(0, K)
+
+    return np.ascontiguousarray(all_results.transpose(1, 2, 0))
+
+
+class TorchReturnContext:
+    """
+    Torch version of ReturnContext. Reward sums and discounts are calculated on device from the partial returns and
+    terminal positions, which are either calculated on device, or uploaded once from an existing ReturnContext.
+    """
+
+    def __init__(self, partial_returns: torch.Tensor, next_terminal: torch.Tensor, gamma: float):
+        self.N, self.A = next_terminal.shape
+        self.gamma = gamma
+        self.device = partial_returns.device
+        self.partial_returns = partial_returns  # [N+1, A] float64
+        self.next_terminal = next_terminal  # [N, A] int64
+        self.powers = gamma ** torch.arange(self.N + 1, dtype=torch.float64, device=self.device)
+        self._time = torch.arange(self.N, device=self.device)[:, None]
+
+    @classmethod
+    def from_context(cls, context: ReturnContext, device):
+        return cls(
+            torch.from_numpy(context.partial_returns).to(device),
+            torch.from_numpy(context.next_terminal).to(device),
+            context.gamma,
+        )
+
+    @classmethod
+    def from_rollout(cls, rewards, dones, gamma: float, device):
+        rewards = torch.as_tensor(rewards, device=device).to(torch.float64)
+        not_done = 1 - torch.as_tensor(dones, device=device).to(torch.float64)
+        N, A = rewards.shape
+        partial_returns = torch.zeros([N + 1, A], dtype=torch.float64, device=device)
+        for t in reversed(range(N)):
+            partial_returns[t] = rewards[t] + gamma * not_done[t] * partial_returns[t + 1]
+        # first terminal at or after t is a running minimum of terminal times, taken backwards through the rollout.
+        time = torch.arange(N, device=device)[:, None].expand(N, A)
+        terminal_times = torch.where(not_done == 0, time, torch.full_like(time, N))
+        next_terminal = terminal_times.flip(0).cummin(dim=0).values.flip(0)
+        return cls(partial_returns, next_terminal, gamma)
+
+    def reward_sum(self, n: int) -> torch.Tensor:
+        """
+        Returns the discounted sum of the next n rewards (stopping at terminals, or the end of the rollout) [N, A]
+        """
+        result = self.partial_returns[:self.N].clone()
+        if n <= self.N:
+            alive = self.next_terminal[:self.N - n + 1] >= self._time[:self.N - n + 1] + n
+            result[:self.N - n + 1] -= self.powers[n] * alive * self.partial_returns[n:]
+        return result.float()
+
+    def discount(self, n: int) -> torch.Tensor:
+        """
+        Returns the discount applied to the value estimate n steps ahead (0 if a terminal occurs before then) [N, A]
+        """
+        steps = torch.clamp(self.N - self._time, max=n)
+        alive = self.next_terminal >= self._time + steps
+        return (self.powers[steps] * alive).float()
+
+    def tail_discount(self) -> torch.Tensor:
+        """
+        Returns the discount from each step to the end of the rollout [N, A]
+        """
+        return self.discount(self.N)
+
+
+def _calculate_sampled_return_multi_torch(
+        gamma: float,
+        rewards: torch.Tensor,
+        dones: torch.Tensor,
+        required_horizons: np.ndarray,
+        value_sample_horizons: np.ndarray,
+        value_samples: torch.Tensor,
+        n_step_samples: np.ndarray = None,
+        n_step_list=None,
+        use_log_interpolation: bool = False,
+        n_step_weights: np.ndarray = None,
+        context: ReturnContext = None,
+        interpolator: HorizonInterpolator = None,
+):
+    """
+    Torch version of _calculate_sampled_return_multi_fast. Runs on the device value_samples are on.
+    Context may be a ReturnContext or a TorchReturnContext, and is calculated on device if not given.
+    Inputs may be tensors or ndarrays, horizons and samples are always processed on the CPU.
+
+    returns float32 tensor of dims [N, A, K]
+    """
+
+    assert n_step_samples is not None or n_step_list is not None or n_step_weights is not None
+
+    device = value_samples.device if torch.is_tensor(value_samples) else torch.device("cpu")
+    values = torch.as_tensor(value_samples, device=device, dtype=torch.float32).permute(2, 0, 1)  # [V, N+1, A]
+
+    N, A = rewards.shape
+    K = len(required_horizons)
+
+    if n_step_list is not None:
+        n_step_samples = np.asarray([list(n_step_list) for _ in range(K)])
+
+    horizons = np.asarray(required_horizons).astype(np.int64)
+    used_n_steps, weights = _n_step_weights(n_step_samples, horizons, N, n_step_weights)
+    if len(used_n_steps) == 0:
+        return torch.zeros([N, A, K], dtype=torch.float32, device=device)
+    max_n = used_n_steps[-1]
+
+    if interpolator is not None:
+        assert interpolator.use_log_interpolation == use_log_interpolation
+        interpolation_weights = interpolator.weights
+    else:
+        interpolation_weights = lambda x: _interpolation_weights(value_sample_horizons, x, use_log_interpolation)
+
+    def to_device(x: np.ndarray):
+        return torch.from_numpy(np.ascontiguousarray(x)).to(device)
+
+    # reward sums and discounts are calculated on device
+    if context is None:
+        context = TorchReturnContext.from_rollout(rewards, dones, gamma, device)
+    elif isinstance(context, ReturnContext):
+        context = TorchReturnContext.from_context(context, device)
+    reward_sums = torch.stack([context.reward_sum(n) for n in used_n_steps])  # [J, N, A]
+    tail_discount = context.tail_discount()
+
+    all_results = torch.einsum('jna,kj->kna', reward_sums, to_device(weights))  # [K, N, A]
+    del reward_sums
+
+    # step 1: bootstrap from the value estimates n_steps ahead
+    i0, i1, w0, w1 = interpolation_weights(horizons[:, None] - used_n_steps[None, :])
+    w0 = to_device(w0 * weights)
+    w1 = to_device(w1 * weights)
+    i0 = to_device(i0)
+    i1 = to_device(i1)
+    for j, n_step in enumerate(used_n_steps):
+        ks = np.flatnonzero((weights[:, j] > 0) & (horizons - n_step > 0))
+        if n_step >= N or len(ks) == 0:
+            continue
+        ks = to_device(ks)
+        bootstrap = values[i0[ks, j], n_step:N] * w0[ks, j, None, None]
+        bootstrap += values[i1[ks, j], n_step:N] * w1[ks, j, None, None]
+        bootstrap *= context.discount(n_step)[None, :N - n_step]
+        all_results[ks, :N - n_step] += bootstrap
+
+    # step 2: steps within n_step of the end of the rollout bootstrap from the final value estimate
+    remaining = np.arange(1, max_n + 1)
+    reached_end = _reached_end_weights(used_n_steps, weights)  # [K, R]
+    i0, i1, w0, w1 = interpolation_weights(horizons[:, None] - remaining[None, :])
+    final_values = values[:, N]  # [V, A]
+    bootstrap = final_values[to_device(i0)] * to_device(w0 * reached_end)[..., None]
+    bootstrap += final_values[to_device(i1)] * to_device(w1 * reached_end)[..., None]
+    rows = to_device(N - remaining)
+    all_results[:, rows] += tail_discount[None, rows] * bootstrap
+
+    return all_results.permute(1, 2, 0).contiguous()
@@ -16,17 +16,18 @@ import math
 import scipy
 
 from .logger import Logger
-from . import utils, wrappers, models, compression, config, hash
+from . import utils, wrappers, models, compression, config, hash, hybridVecEnv
 
 from .config import args
 from .mutex import Mutex
 from .replay import ExperienceReplayBuffer
 
-from .returns import gae, calculate_bootstrapped_returns, td_lambda
+from .returns import gae, gae_multi, calculate_bootstrapped_returns, td_lambda, ReturnContext
 
 from .utils import open_checkpoint
 
 import collections
+from concurrent.futures import ThreadPoolExecutor
 
 
 def add_relative_noise(X: np.ndarray, rel_error: float):
@@ -106,6 +107,9 @@ class RunnerModule:
     def on_train_value_minibatch(self, model_out, data, **kwargs):
         pass
 
+    def on_close(self):
+        pass
+
     def save(self):
         pass
 
@@ -156,6 +160,27 @@ class Runner:
         else:
             self.rnd_optimizer = None
 
+        # worker threads for utils.HostBatchPrefetcher, shared between calls to train_batch
+        self.prefetch_pool = None
+
+        # loss scaling for fp16 autocast (see backward and optimizer_step). Each optimizer has its own scaler, so that
+        # overflow while training one network does not reduce the loss scale for the others.
+        self.grad_scalers = {}
+        if args.amp == "fp16":
+            assert torch.device(model.device).type == "cuda", "--amp=fp16 requires a cuda device (use bf16 on the cpu)."
+            self.grad_scalers = {name: torch.amp.GradScaler("cuda") for name in self.optimizers.keys()}
+        # scaler for the optimizer currently being trained (set by train_batch)
+        self.grad_scaler = None
+
+        # compiled versions of the training steps, by name (see args.compile)
+        self.compiled_steps = {}
+        if args.compile != "off":
+            model.enable_compile(args.compile)
+            for step in [self.train_policy_minibatch, self.train_value_minibatch, self.train_distil_minibatch]:
+                self.compiled_steps[step.__name__] = utils.BatchSizeCompiledFunction(
+                    step, lambda data, *_, **__: len(data["prev_state"]), mode=args.compile
+                )
+
         self.vec_env = None
         self.log = log
 
@@ -215,6 +240,9 @@ class Runner:
             # in batch upload mode we can just keep all_obs on the GPU
             self.all_obs = torch.zeros(size=[N + 1, A, *self.state_shape], dtype=torch.uint8, device=self.model.device)
 
+        # if true all_obs is the vector env's shared observation buffer, which environments write to directly.
+        self.direct_obs = False
+
         if self.action_dist == "discrete":
             self.actions = np.zeros([N, A], dtype=np.int64)
         elif self.action_dist == "gaussian":
@@ -249,6 +277,8 @@ class Runner:
         self.value = np.zeros([N+1, A, VH], dtype=np.float32)
         self.returns = np.zeros([N, A, VH], dtype=np.float32)
 
+        # discounted ext reward sums for the current rollout, by gamma (see get_return_context)
+        self._return_contexts = {}
 
         # hashing
         if args.hash.enabled:
@@ -289,7 +319,7 @@ class Runner:
             'batch_action_repeats': 0,
         }
         self.ep_count = 0
-        self.episode_length_buffer = collections.deque(maxlen=1000)
+        self.episode_length_buffer = utils.SortedWindow(maxlen=1000)
         self.ttt_error_buffer = collections.deque(maxlen=1000)
 
         # create the replay buffer if needed
@@ -419,6 +449,8 @@ class Runner:
                 data['distil_optimizer_state_dict'] = self.distil_optimizer.state_dict()
             if self.aux_optimizer is not None:
                 data['aux_optimizer_state_dict'] = self.aux_optimizer.state_dict()
+            if len(self.grad_scalers) > 0:
+                data['grad_scaler_state_dicts'] = {k: v.state_dict() for k, v in self.grad_scalers.items()}
 
         if not disable_log:
             data['logs'] = self.log
@@ -484,12 +516,18 @@ class Runner:
             self.distil_optimizer.load_state_dict(checkpoint['distil_optimizer_state_dict'])
         if args.aux_opt.epochs > 0:
             self.aux_optimizer.load_state_dict(checkpoint['aux_optimizer_state_dict'])
+        for k, v in checkpoint.get('grad_scaler_state_dicts', {}).items():
+            if k in self.grad_scalers:
+                self.grad_scalers[k].load_state_dict(v)
 
         step = checkpoint['step']
         self.log = checkpoint['logs']
         self.step = step
         self.ep_count = checkpoint.get('ep_count', 0)
         self.episode_length_buffer = checkpoint['episode_length_buffer']
+        if not isinstance(self.episode_length_buffer, utils.SortedWindow):
+            # older checkpoints stored a deque
+            self.episode_length_buffer = utils.SortedWindow(maxlen=1000, values=self.episode_length_buffer)
         self.batch_counter = checkpoint.get('batch_counter', 0)
         self.stats = checkpoint.get('stats', 0)
         self.noise_stats = checkpoint.get('noise_stats', {})
@@ -514,8 +552,28 @@ class Runner:
 
         utils.restore_env_state(self.vec_env, checkpoint['env_state'])
 
+        if args.env.backend == "envpool":
+            # envpool can not save its emulators, so only the vector wrappers (e.g. reward normalization) were
+            # restored, and every environment starts a new episode.
+            self.log.warn("envpool does not support restoring environment state, so environments have been reset.")
+            self.obs = self.vec_env.reset()
+            self.done = np.zeros_like(self.done)
+            self.episode_score *= 0
+            self.discounted_episode_score *= 0
+            self.episode_len *= 0
+            self.time *= 0
+
         return step
 
+    def get_return_context(self, gamma: float) -> ReturnContext:
+        """
+        Returns the ReturnContext for this rollout's ext rewards and terminals, discounted with gamma.
+        Contexts are calculated on first use, and shared until the next rollout is generated.
+        """
+        if gamma not in self._return_contexts:
+            self._return_contexts[gamma] = ReturnContext(self.ext_rewards, self.terminals, gamma)
+        return self._return_contexts[gamma]
+
     def get_modules(self) -> List[RunnerModule]:
         result = []
         for child in self.__dict__.values():
@@ -530,6 +588,9 @@ class Runner:
         for module in self.get_modules():
             module.on_reset()
 
+        if args.direct_obs:
+            self._use_direct_obs()
+
         # initialize agent
         self.obs = self.vec_env.reset()
         self.done = np.zeros_like(self.done)
@@ -554,6 +615,18 @@ class Runner:
         # so that there is something in the buffer to start with.
         self.episode_length_buffer.append(1000)
 
+    def close(self):
+        """
+        Closes the environments, and shuts down any worker threads owned by the runner or its modules.
+        """
+        for module in self.get_modules():
+            module.on_close()
+        if self.prefetch_pool is not None:
+            self.prefetch_pool.shutdown(wait=True)
+            self.prefetch_pool = None
+        if self.vec_env is not None:
+            self.vec_env.close()
+
     @torch.no_grad()
     def detached_batch_forward(self, obs: Union[np.ndarray, torch.Tensor], **kwargs):
         """ Forward states through model, returns output, which is a dictionary containing
@@ -638,8 +711,9 @@ class Runner:
         Returns action sampled from the output of the given policy.
         """
         if self.action_dist == "discrete":
+            # sampling all agents at once draws the same random numbers as sampling each agent in turn.
             log_policy = model_out["log_policy"].cpu().numpy()
-            return np.asarray([utils.sample_action_from_logp(prob) for prob in log_policy], dtype=np.int32)
+            return np.asarray(utils.sample_action_from_logp(log_policy), dtype=np.int32)
         elif self.action_dist == "gaussian":
             mu = model_out["raw_policy"].cpu().numpy()
             model_std = self.get_current_actions_std().detach().cpu().numpy()[None, :]
@@ -699,22 +773,312 @@ class Runner:
         return self.hash_fn(hash_input)
 
 
+    @staticmethod
+    def _remap_rollout_output(model_out: dict):
+        """ Remaps output of a full forward to sensible defaults. """
+        model_out['value'] = model_out['value_value']
+        model_out['log_policy'] = model_out['policy_log_policy']
+        model_out['raw_policy'] = model_out['policy_raw_policy']
+        if args.tvf.enabled:
+            model_out['tvf_value'] = model_out['value_tvf_value']
+
+    @torch.no_grad()
+    def pipelined_forward_and_step(self):
+        """
+        Forwards current observations through the model in args.rollout_groups groups, sending each group's actions
+        to the environments as soon as they are sampled, so that the environments run while the next group is being
+        forwarded. Results are collected by the caller with vec_env.step_wait().
+        Groups are split on worker boundaries (see hybridVecEnv.split_groups), so may differ slightly in size.
+
+        Normalization constants are updated on the same micro-batches detached_batch_forward would use, and actions
+        are sampled in the same agent order, so output matches the non-pipelined version. This is exact when group
+        boundaries fall on micro-batch boundaries. Otherwise a micro-batch is forwarded in two parts, which can change
+        model outputs by float rounding (and so very rarely an action).
+
+        Returns model_out, actions
+        """
+
+        assert hasattr(self.vec_env, "step_partial"), "rollout_groups requires async environments (sync_envs=False)."
+
+        # groups must align with the environment workers, which might not split the agents evenly.
+        group_offsets = hybridVecEnv.split_groups(self.vec_env.unwrapped.worker_offsets, args.rollout_groups)
+        chunk_size = args.max_micro_batch_size
+
+        group_outputs = []
+        group_actions = []
+
+        for start, end in zip(group_offsets[:-1], group_offsets[1:]):
+
+            # split the group at micro-batch boundaries, and update normalization constants once per micro-batch.
+            # note: environments from earlier groups are running and will be writing to their part of self.obs,
+            # however micro-batches only ever look forward, so this is safe.
+            split_points = sorted({start, end, *range((start // chunk_size + 1) * chunk_size, end, chunk_size)})
+            outputs = []
+            for sub_start, sub_end in zip(split_points[:-1], split_points[1:]):
+                if self.model.observation_normalization and sub_start % chunk_size == 0:
+                    chunk = self.obs[sub_start:sub_start+chunk_size]
+                    self.model.perform_normalization(self.model.prep_for_model(chunk), update_normalization=True)
+                outputs.append(self.detached_batch_forward(
+                    self.obs[sub_start:sub_end],
+                    output="full",
+                    include_rnd=args.rnd.enabled,
+                    update_normalization=False,
+                ))
+            model_out = {k: torch.cat([output[k] for output in outputs], dim=0) for k in outputs[0].keys()}
+            self._remap_rollout_output(model_out)
+
+            actions = self.sample_actions(model_out)
+            self.vec_env.step_partial(actions, start, end)
+
+            group_outputs.append(model_out)
+            group_actions.append(actions)
+
+        model_out = {k: torch.cat([output[k] for output in group_outputs], dim=0) for k in group_outputs[0].keys()}
+        return model_out, np.concatenate(group_actions, axis=0)
+
+    def _use_direct_obs(self):
+        """
+        Switches all_obs to the vector env's shared observation buffer, so that environments write each step's
+        observations directly into the rollout (see HybridAsyncVectorEnv.set_obs_slot).
+        """
+        vec_env = self.vec_env.unwrapped
+        assert hasattr(vec_env, "obs_buffer"), "direct_obs requires async environments (sync_envs=False)."
+        vec_env.set_obs_slot(0)
+        if self.direct_obs:
+            return
+
+        assert not args.obs_compression, "direct_obs can not be used with obs_compression."
+        assert not args.upload_batch, "direct_obs can not be used with upload_batch."
+        assert vec_env.obs_buffer.shape == self.all_obs.shape, \
+            f"Vector env has observation buffer of shape {vec_env.obs_buffer.shape} but expected {self.all_obs.shape}."
+
+        self.all_obs = vec_env.obs_buffer
+        self.direct_obs = True
+
+        if args.device != "cpu" and not vec_env.pin_obs_buffer():
+            print("Warning: could not pin shared observation buffer, uploads to GPU will be slower.")
+
+    def _begin_direct_rollout(self):
+        """
+        Moves the current observations into the first slot of all_obs, and has environments write there.
+        """
+        vec_env = self.vec_env.unwrapped
+        slot = vec_env.get_obs_slot()
+        if slot != 0:
+            # final observations of the previous rollout are the first observations of this one.
+            self.all_obs[0] = self.all_obs[slot]
+            vec_env.set_obs_slot(0)
+        self.obs = self.all_obs[0]
+
+    def _upload_if_needed(self, x):
+        if type(self.all_obs) is torch.Tensor:
+            x = torch.from_numpy(x).to(self.all_obs.device)
+        return x
+
+    def _record_step(self, t, agents, prev_obs, prev_time, model_out, actions, ext_rewards, dones, infos,
+                     info_arrays, obs_hashes, rollout_discounted_returns):
+        """
+        Records the results of a step for the given agents into the rollout buffers.
+        t is the step index for each agent (or a single step index shared by all of them), and agents is an array
+        containing the agent index of each row of the other inputs.
+        self.obs and self.time should already contain the new observations and times for these agents.
+        """
+
+        # hashing if needed...
+        if args.hash.enabled:
+            hashes = self.generate_hashes(self.obs[agents])
+            self.hash_recent_counts *= args.hash.decay
+            for obs_hash in hashes:
+                self.hash_global_counts[obs_hash] += 1
+                self.hash_recent_counts[obs_hash] += 1
+            obs_hashes[t, agents] = hashes
+
+        if args.rnd.enabled:
+            # update the intrinsic rewards
+            self.int_rewards[t, agents] += model_out["rnd_error"].detach().cpu().numpy()
+
+        # save raw rewards for monitoring the agents progress
+        raw_rewards = info_arrays["raw_reward"]
+        raw_rewards = np.where(np.isnan(raw_rewards), ext_rewards, raw_rewards).astype(np.float32)
+
+        self.episode_score[agents] += raw_rewards
+        self.discounted_episode_score[agents] = args.gamma * self.discounted_episode_score[agents] + ext_rewards
+        rollout_discounted_returns[t, agents] = self.discounted_episode_score[agents]
+        self.episode_len[agents] += 1
+
+        # log repeated action stats
+        if 'max_repeats' in infos[0]:
+            self.log.watch_mean('max_repeats', infos[0]['max_repeats'], display_name="reps", display_width=7)
+        if 'mean_repeats' in infos[0]:
+            self.log.watch_mean('mean_repeats', infos[0]['mean_repeats'], display_width=0)
+
+        # compress observations if needed
+        if args.obs_compression:
+            prev_obs = np.asarray([compression.BufferSlot(prev_obs[i]) for i in range(len(prev_obs))])
+
+        # take advantage of the fact that V_h = V_min(h, remaining_time).
+        if args.tvf.enabled:
+            start_time = clock.time()
+            tvf_values = model_out["tvf_value"].cpu().numpy() # A,K,VH
+            tvf_values[:, 0, :] = 0 # first value head should always be zero.
+            self.tvf.tvf_untrimmed_value[t, agents] = tvf_values
+            self.tvf.tvf_value[t, agents], self.tvf.tvf_final_value[t, agents], ttt = self.tvf.trim_horizons(
+                tvf_values,
+                prev_time,
+                method=args.tvf.trimming,
+                mode=args.tvf.trimming_mode
+            )
+            if ttt is not None:
+                for a, agent_ttt in zip(agents, ttt):
+                    self.ttt_predictions[a].append(agent_ttt)
+
+            ms = (clock.time() - start_time) * 100
+            self.log.watch_mean("*t_trim", ms)
+
+        # get all the information we need from the model
+        if not self.direct_obs:
+            self.all_obs[t, agents] = self._upload_if_needed(prev_obs)
+        self.all_time[t, agents] = prev_time
+        self.value[t, agents] = model_out["value"].cpu().numpy()
+        self.actions[t, agents] = actions
+        self.ext_rewards[t, agents] = ext_rewards
+        self.log_policy[t, agents] = model_out["log_policy"].cpu().numpy()
+        self.raw_policy[t, agents] = model_out["raw_policy"].cpu().numpy()
+        self.terminals[t, agents] = dones
+        self.done[agents] = dones
+
+        if "reward_clips" in infos[0]:
+            self.stats['reward_clips'] += infos[0]["reward_clips"]
+        if "repeated_actions" in infos[0]:
+            self.stats['action_repeats'] += infos[0]["repeated_actions"]
+            self.stats['batch_action_repeats'] += infos[0]["repeated_actions"]
+        if not np.all(np.isnan(info_arrays["room_count"])):
+            self.log.watch_mean("av_room_count", np.nanmean(info_arrays["room_count"]), history_length=100,
+                                display_name="rooms_av")
+
+        # process each environment that has finished, this is rare, so we can loop over them.
+        for j in np.flatnonzero(dones):
+            i = agents[j]
+            ep_score = info_arrays["ep_score"][j]
+            ep_length = info_arrays["ep_length"][j]
+            room_count = info_arrays["room_count"][j]
+
+            # this should be always updated, even if it's just a loss of life terminal
+            self.episode_length_buffer.append(int(ep_length))
+
+            if info_arrays["fake_done"][j]:
+                # this is a fake reset on loss of life...
+                continue
+
+            predictions = self.ttt_predictions[i]
+
+            # check how good our ttt predictions were
+            deltas = []
+            for k, pred_ttt in enumerate(predictions):
+                true_ttt = len(predictions) - k
+                delta = pred_ttt - true_ttt
+                self.ttt_error_buffer.append(delta)
+                deltas.append(delta)
+
+            predictions.clear()
+
+            # reset is handled automatically by vectorized environments
+            # so just need to keep track of book keeping
+            self.ep_count += 1
+            self.log.watch_full("ep_score", ep_score, history_length=100)
+            self.log.watch_full("ep_length", ep_length, history_length=100)
+            if not np.isnan(room_count):
+                self.log.watch_mean("ep_room_count", room_count, history_length=100,
+                                    display_name="rooms_ep")
+                try:
+                    old_room_count = self.log['max_room_count']
+                except:
+                    old_room_count = 0
+                self.log.watch("*max_room_count", max(old_room_count, room_count))
+            self.log.watch_mean("ep_count", self.ep_count, history_length=1)
+
+            self.episode_score[i] = 0
+            self.episode_len[i] = 0
+            self.discounted_episode_score[i] = 0
+
+    @torch.no_grad()
+    def async_forward_and_step(self, obs_hashes, rollout_discounted_returns):
+        """
+        Generates a rollout with asynchronous environments (see HybridAsyncVectorEnv.send / recv).
+        Rather than waiting for every environment each step, results are processed as soon as at least
+        args.async_batch_size environments are ready, and those agents are then forwarded and sent their next action.
+        Each agent has its own step counter, and results are written into the rollout buffers by agent id, so slow
+        environments (e.g. those being reset) do not hold up the others.
+
+        A rollout always ends with every agent having taken exactly N steps, and no steps in flight.
+        """
+
+        assert hasattr(self.vec_env, "send"), "async_batch_size requires async environments (sync_envs=False)."
+        assert args.rollout_groups == 1, "async_batch_size can not be combined with rollout_groups."
+
+        # environments write observations directly into their (shared) observation buffer, so take a copy, as we need
+        # the previous observations of agents that are still in flight.
+        self.obs = self.obs.copy()
+
+        steps = np.zeros([self.A], dtype=np.int64)
+        pending_out = None
+        pending_actions = None
+        to_send = np.arange(self.A)
+
+        while True:
+            if len(to_send) > 0:
+                model_out = self.detached_batch_forward(
+                    self.obs[to_send],
+                    output="full",
+                    include_rnd=args.rnd.enabled,
+                    update_normalization=True
+                )
+                self._remap_rollout_output(model_out)
+                actions = self.sample_actions(model_out)
+
+                if pending_out is None:
+                    # model outputs are on the model's device, so keep the pending outputs there too.
+                    pending_out = {k: torch.zeros([self.A, *v.shape[1:]], dtype=v.dtype, device=v.device) for k, v in model_out.items()}
+                    pending_actions = np.zeros([self.A, *actions.shape[1:]], dtype=actions.dtype)
+                for k, v in model_out.items():
+                    pending_out[k][to_send] = v
+                pending_actions[to_send] = actions
+
+                if self.direct_obs:
+                    self.vec_env.unwrapped.set_obs_slot(steps[to_send] + 1, to_send)
+                self.vec_env.send(actions, to_send)
+            elif np.all(steps == self.N):
+                break
+
+            obs, ext_rewards, dones, infos, agents = self.vec_env.recv(min_envs=args.async_batch_size)
+            info_arrays = hybridVecEnv.get_info_arrays(self.vec_env, ext_rewards, dones, infos)
+
+            prev_obs = self.obs[agents]
+            prev_time = self.time[agents]
+            self.obs[agents] = obs
+            self.time[agents] = info_arrays["time"]
+
+            self._record_step(
+                steps[agents], agents, prev_obs, prev_time,
+                {k: v[agents] for k, v in pending_out.items()}, pending_actions[agents],
+                ext_rewards, dones, infos, info_arrays, obs_hashes, rollout_discounted_returns,
+            )
+
+            steps[agents] += 1
+            to_send = agents[steps[agents] < self.N]
+
     @torch.no_grad()
     def generate_rollout(self):
 
         assert self.vec_env is not None, "Please call create_envs first."
 
-        def upload_if_needed(x):
-            if type(self.all_obs) is torch.Tensor:
-                x = torch.from_numpy(x).to(self.all_obs.device)
-            return x
-
         self.model.train()
 
         self.int_rewards *= 0
         self.ext_rewards *= 0
         self.value *= 0
         self.all_time *= 0
+        self._return_contexts.clear()
 
         for module in self.get_modules():
             module.on_before_generate_rollout()
@@ -727,152 +1091,55 @@ class Runner:
             if k.startswith("batch_"):
                 self.stats[k] *= 0
 
-        for t in range(self.N):
-
-            prev_obs = self.obs.copy()
-            prev_time = self.time.copy()
+        if self.direct_obs:
+            self._begin_direct_rollout()
 
-            # forward state through model, then detach the result and convert to numpy.
-            model_out = self.detached_batch_forward(
-                self.obs,
-                output="full",
-                include_rnd=args.rnd.enabled,
-                update_normalization=True
-            )
-
-            # remap to sensible defaults
-            model_out['value'] = model_out['value_value']
-            model_out['log_policy'] = model_out['policy_log_policy']
-            model_out['raw_policy'] = model_out['policy_raw_policy']
-            if args.tvf.enabled:
-                model_out['tvf_value'] = model_out['value_tvf_value']
-
-            # sample actions and run through environment.
-            actions = self.sample_actions(model_out)
-            self.obs, ext_rewards, dones, infos = self.vec_env.step(actions)
-            self.time = np.asarray([info["time"] for info in infos], dtype=np.int32)
-
-            # hashing if needed...
-            if args.hash.enabled:
-                hashes = self.generate_hashes(self.obs)
-                self.hash_recent_counts *= args.hash.decay
-                for a, obs_hash in enumerate(hashes):
-                    self.hash_global_counts[obs_hash] += 1
-                    self.hash_recent_counts[obs_hash] += 1
-                    obs_hashes[t, a] = obs_hash
-
-            if args.rnd.enabled:
-                # update the intrinsic rewards
-                self.int_rewards[t] += model_out["rnd_error"].detach().cpu().numpy()
-
-            # save raw rewards for monitoring the agents progress
-            raw_rewards = np.asarray([info.get("raw_reward", reward) for reward, info in zip(ext_rewards, infos)],
-                                     dtype=np.float32)
+        if args.async_batch_size > 0:
+            self.async_forward_and_step(obs_hashes, rollout_discounted_returns)
+        else:
+            agents = np.arange(self.A)
+            for t in range(self.N):
 
-            self.episode_score += raw_rewards
-            self.discounted_episode_score = args.gamma * self.discounted_episode_score + ext_rewards
-            rollout_discounted_returns[t] = self.discounted_episode_score
-            self.episode_len += 1
+                if self.direct_obs:
+                    # observations for this step are already in all_obs[t], and the next ones will be written to t+1.
+                    prev_obs = self.obs
+                    self.vec_env.unwrapped.set_obs_slot(t + 1)
+                else:
+                    prev_obs = self.obs.copy()
+                prev_time = self.time.copy()
 
-            # log repeated action stats
-            if 'max_repeats' in infos[0]:
-                self.log.watch_mean('max_repeats', infos[0]['max_repeats'], display_name="reps", display_width=7)
-            if 'mean_repeats' in infos[0]:
-                self.log.watch_mean('mean_repeats', infos[0]['mean_repeats'], display_width=0)
+                if args.rollout_groups > 1:
+                    # forward and step each group in turn, overlapping env steps with the forward of the next group.
+                    model_out, actions = self.pipelined_forward_and_step()
+                    self.obs, ext_rewards, dones, infos = self.vec_env.step_wait()
+                else:
+                    # forward state through model, then detach the result and convert to numpy.
+                    model_out = self.detached_batch_forward(
+                        self.obs,
+                        output="full",
+                        include_rnd=args.rnd.enabled,
+                        update_normalization=True
+                    )
+                    self._remap_rollout_output(model_out)
 
-            # compress observations if needed
-            if args.obs_compression:
-                prev_obs = np.asarray([compression.BufferSlot(prev_obs[i]) for i in range(len(prev_obs))])
+                    # sample actions and run through environment.
+                    actions = self.sample_actions(model_out)
+                    self.obs, ext_rewards, dones, infos = self.vec_env.step(actions)
+                info_arrays = hybridVecEnv.get_info_arrays(self.vec_env, ext_rewards, dones, infos)
+                self.time = info_arrays["time"].copy()
 
-            # take advantage of the fact that V_h = V_min(h, remaining_time).
-            if args.tvf.enabled:
-                start_time = clock.time()
-                tvf_values = model_out["tvf_value"].cpu().numpy() # A,K,VH
-                tvf_values[:, 0, :] = 0 # first value head should always be zero.
-                self.tvf.tvf_untrimmed_value[t] = tvf_values
-                self.tvf.tvf_value[t], self.tvf.tvf_final_value[t], ttt = self.tvf.trim_horizons(
-                    tvf_values,
-                    prev_time,
-                    method=args.tvf.trimming,
-                    mode=args.tvf.trimming_mode
+                self._record_step(
+                    t, agents, prev_obs, prev_time, model_out, actions, ext_rewards, dones, infos, info_arrays,
+                    obs_hashes, rollout_discounted_returns,
                 )
-                if ttt is not None:
-                    for a in range(self.A):
-                        self.ttt_predictions[a].append(ttt[a])
-
-                ms = (clock.time() - start_time) * 100
-                self.log.watch_mean("*t_trim", ms)
-
-            # get all the information we need from the model
-            self.all_obs[t] = upload_if_needed(prev_obs)
-            self.all_time[t] = prev_time
-            self.value[t] = model_out["value"].cpu().numpy()
-            self.actions[t] = actions
-            self.ext_rewards[t] = ext_rewards
-            self.log_policy[t] = model_out["log_policy"].cpu().numpy()
-            self.raw_policy[t] = model_out["raw_policy"].cpu().numpy()
-            self.terminals[t] = dones
-            self.done = dones
-
-            # process each environment, check if they have finished
-            for i, (done, info) in enumerate(zip(dones, infos)):
-                if "reward_clips" in info:
-                    self.stats['reward_clips'] += info["reward_clips"]
-                if "game_freeze" in info:
-                    self.stats['game_crashes'] += 1
-                if "repeated_action" in info:
-                    self.stats['action_repeats'] += 1
-                if "repeated_action" in info:
-                    self.stats['batch_action_repeats'] += 1
-                if "room_count" in info:
-                    self.log.watch_mean("av_room_count", info["room_count"], history_length=100,
-                                        display_name="rooms_av")
-
-                if done:
-                    # this should be always updated, even if it's just a loss of life terminal
-                    self.episode_length_buffer.append(info["ep_length"])
-
-                    if "fake_done" in info:
-                        # this is a fake reset on loss of life...
-                        continue
-
-                    predictions = self.ttt_predictions[i]
-
-                    # check how good our ttt predictions were
-                    deltas = []
-                    for j, pred_ttt in enumerate(predictions):
-                        true_ttt = len(predictions) - j
-                        delta = pred_ttt - true_ttt
-                        self.ttt_error_buffer.append(delta)
-                        deltas.append(delta)
-
-                    predictions.clear()
-
-                    # reset is handled automatically by vectorized environments
-                    # so just need to keep track of book keeping
-                    self.ep_count += 1
-                    self.log.watch_full("ep_score", info["ep_score"], history_length=100)
-                    self.log.watch_full("ep_length", info["ep_length"], history_length=100)
-                    if "room_count" in info:
-                        self.log.watch_mean("ep_room_count", info["room_count"], history_length=100,
-                                            display_name="rooms_ep")
-                        try:
-                            old_room_count = self.log['max_room_count']
-                        except:
-                            old_room_count = 0
-                        self.log.watch("*max_room_count", max(old_room_count, info["room_count"]))
-                    self.log.watch_mean("ep_count", self.ep_count, history_length=1)
-
-                    self.episode_score[i] = 0
-                    self.episode_len[i] = 0
-                    self.discounted_episode_score[i] = 0
 
         # process the final state
         if args.obs_compression:
             last_obs = np.asarray([compression.BufferSlot(self.obs[i]) for i in range(len(self.obs))])
         else:
             last_obs = self.obs
-        self.all_obs[-1] = upload_if_needed(last_obs)
+        if not self.direct_obs:
+            self.all_obs[-1] = self._upload_if_needed(last_obs)
         self.all_time[-1] = self.time
         final_model_out = self.detached_batch_forward(self.obs, output="default")
         self.value[-1] = final_model_out["value"].cpu().numpy()
@@ -985,7 +1252,8 @@ class Runner:
     @torch.no_grad()
     def log_dna_value_quality(self):
         targets = calculate_bootstrapped_returns(
-            self.ext_rewards, self.terminals, self.ext_value[self.N], args.gamma
+            self.ext_rewards, self.terminals, self.ext_value[self.N], args.gamma,
+            context=self.get_return_context(args.gamma),
         )
         values = self.ext_value[:self.N]
         ev = utils.explained_variance(values.ravel(), targets.ravel())
@@ -1137,12 +1405,10 @@ class Runner:
         return self.all_time[-1]
 
 
-    def calculate_intrinsic_returns(self):
-
-        if not args.use_intrinsic_rewards:
-            return 0
-
-        N, A, *state_shape = self.prev_obs.shape
+    def normalize_intrinsic_rewards(self):
+        """
+        Normalizes (and centers) the intrinsic rewards, ready for calculating intrinsic returns.
+        """
 
         if args.ir.normalize:
             # normalize returns using EMS
@@ -1167,18 +1433,6 @@ class Runner:
         if args.ir.center:
             self.int_rewards = self.int_rewards - self.int_rewards.mean()
 
-        int_advantage = gae(
-            self.int_rewards,
-            self.int_value[:N],
-            self.int_value[N],
-            (not args.ir.propagation) * self.terminals,
-            gamma=args.gamma_int,
-            lamb=args.lambda_policy
-        )
-
-        self.int_returns[:] = int_advantage + self.int_value[:N]
-        return int_advantage
-
     def calculate_returns(self):
         """
         Calculates return targets for all value heads as required
@@ -1204,27 +1458,39 @@ class Runner:
         # mostly interested in how noisy these are...
         self.log.watch_mean_std("*ext_value_estimates", ext_value_estimates)
 
-        ext_advantage = gae(
-            self.ext_rewards,
-            ext_value_estimates[:N],
-            ext_value_estimates[N],
-            self.terminals,
-            args.gamma,
-            args.lambda_policy,
+        # ext advantages, ext returns (td_lambda) and int advantages are all calculated with one reverse pass.
+        # heads are (rewards, value estimates, terminals, gamma, lambda)
+        heads = [
+            (self.ext_rewards, ext_value_estimates, self.terminals, args.gamma, args.lambda_policy),
+            (self.ext_rewards, ext_value_estimates, self.terminals, args.gamma, args.lambda_value),
+        ]
+        if args.use_intrinsic_rewards:
+            self.normalize_intrinsic_rewards()
+            heads.append(
+                (self.int_rewards, self.int_value, (not args.ir.propagation) * self.terminals, args.gamma_int,
+                 args.lambda_policy)
+            )
+        rewards, values, terminals, gammas, lambdas = zip(*heads)
+        values = np.stack(values, axis=-1)
+        advantages = gae_multi(
+            np.stack(rewards, axis=-1),
+            values[:N],
+            values[N],
+            np.stack(terminals, axis=-1),
+            gammas,
+            lambdas,
+            backend=args.gae_backend,
+            device=args.device,
         )
+
+        ext_advantage = advantages[..., 0]
         # calculate ext_returns.
-        self.ext_returns[:] = td_lambda(
-            self.ext_rewards,
-            ext_value_estimates[:N],
-            ext_value_estimates[N],
-            self.terminals,
-            args.gamma,
-            args.lambda_value,
-        )
+        self.ext_returns[:] = advantages[..., 1] + ext_value_estimates[:N]
 
         self.advantage = ext_advantage.copy()
         if args.use_intrinsic_rewards:
-            int_advantage = args.ir.scale * self.calculate_intrinsic_returns()
+            self.int_returns[:] = advantages[..., 2] + self.int_value[:N]
+            int_advantage = args.ir.scale * advantages[..., 2]
             self.advantage += int_advantage
             self.log.watch_mean_std("*adv_int", int_advantage, display_width=0)
             self.log.watch_mean("adv_ratio", ((ext_advantage**2).mean() / (int_advantage**2).mean())**0.5, display_width=0)
@@ -1284,8 +1550,40 @@ class Runner:
                 self.log_feature_statistics()
                 self.log_dna_value_quality()
 
+    @property
+    def optimizers(self) -> dict:
+        """ Returns dictionary of all optimizers in use, by name. """
+        optimizers = {
+            'policy': self.policy_optimizer,
+            'value': self.value_optimizer,
+            'distil': self.distil_optimizer,
+            'aux': self.aux_optimizer,
+            'rnd': self.rnd_optimizer,
+        }
+        return {k: v for k, v in optimizers.items() if v is not None}
+
+    def get_grad_scaler(self, optimizer: torch.optim.Optimizer):
+        """ Returns the loss scaler for given optimizer, or None if loss scaling is not enabled. """
+        for name, other in self.optimizers.items():
+            if other is optimizer:
+                return self.grad_scalers.get(name, None)
+        return None
+
+    def backward(self, loss: torch.Tensor):
+        """
+        Backpropagates loss, scaling it first if loss scaling is enabled (fp16 autocast) for the optimizer being
+        trained by train_batch, in which case the gradients are unscaled again by optimizer_step.
+        """
+        if self.grad_scaler is not None:
+            loss = self.grad_scaler.scale(loss)
+        loss.backward()
+
     def optimizer_step(self, optimizer: torch.optim.Optimizer, label: str = "opt"):
 
+        grad_scaler = self.get_grad_scaler(optimizer)
+        if grad_scaler is not None:
+            grad_scaler.unscale_(optimizer)
+
         # get parameters
         parameters = []
         for group in optimizer.param_groups:
@@ -1316,7 +1614,13 @@ class Runner:
             grad_norm = calc_grad_norm(parameters)
         self.log.watch_mean(f"grad_{label}", grad_norm, display_name=f"gd_{label}", display_width=10)
 
-        optimizer.step()
+        if grad_scaler is not None:
+            # skips the update if the gradients overflowed, and adjusts the loss scale.
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
+            self.log.watch_mean(f"grad_scale_{label}", grad_scaler.get_scale(), display_width=0)
+        else:
+            optimizer.step()
 
         return float(grad_norm)
 
@@ -1437,7 +1741,7 @@ class Runner:
         # -------------------------------------------------------------------------
 
         loss = loss * loss_scale
-        loss.mean().backward()
+        self.backward(loss.mean())
 
         self.log.watch_mean("loss_distil_policy", loss_policy.mean(), history_length=64 * args.distil_opt.epochs, display_width=0)
         self.log.watch_mean("loss_distil_value", loss_value.mean(), history_length=64 * args.distil_opt.epochs, display_width=0)
@@ -1493,7 +1797,7 @@ class Runner:
         # -------------------------------------------------------------------------
 
         opt_loss = loss * loss_scale
-        opt_loss.backward()
+        self.backward(opt_loss)
 
         self.log.watch_mean("loss_aux_value", value_loss , history_length=history_length, display_width=0)
         self.log.watch_mean("loss_aux_policy", policy_loss, history_length=history_length, display_width=0)
@@ -1553,7 +1857,7 @@ class Runner:
         # note, we want to log the true loss, not the modified loss.
         loss = loss * loss_scale
         mean_loss = loss.mean()
-        mean_loss.backward()
+        self.backward(mean_loss)
 
         # -------------------------------------------------------------------------
         # Logging
@@ -1750,7 +2054,7 @@ class Runner:
         # -------------------------------------------------------------------------
 
         loss = (-gain) * loss_scale
-        loss.mean().backward()
+        self.backward(loss.mean())
 
         # -------------------------------------------------------------------------
         # Generate log values
@@ -1776,11 +2080,11 @@ class Runner:
 
     @property
     def episode_length_mean(self):
-        return np.mean(self.episode_length_buffer)
+        return self.episode_length_buffer.mean()
 
     @property
     def episode_length_std(self):
-        return np.std(self.episode_length_buffer)
+        return self.episode_length_buffer.std()
 
     @property
     def agent_age(self):
@@ -1818,7 +2122,7 @@ class Runner:
         self.log.watch_mean("*feat_max", self.model.rnd_features_max, display_precision=1)
 
         loss = loss_rnd * loss_scale
-        loss.backward()
+        self.backward(loss)
 
 
     def train_rnd(self):
@@ -2315,80 +2619,108 @@ class Runner:
             micro_batch_size = min(args.max_micro_batch_size, mini_batch_size)
         assert mini_batch_size % micro_batch_size == 0
         micro_batches = mini_batch_size // micro_batch_size
+        mini_batch_func = self.compiled_steps.get(getattr(mini_batch_func, "__name__", None), mini_batch_func)
 
-        ordering = list(range(batch_size))
-        np.random.shuffle(ordering)
+        samples_per_micro_batch = int(micro_batch_size * thinning) if thinning < 1.0 else None
+        if args.upload_batch:
+            # batch is already on the device, so shuffle and gather micro-batches there.
+            sampler = utils.DeviceBatchSampler(
+                batch_data, micro_batch_size, self.model.device, samples_per_micro_batch=samples_per_micro_batch,
+            )
+        elif args.batch_prefetch > 0:
+            # prepare the next few micro-batches on background threads while training on this one.
+            if self.prefetch_pool is None:
+                self.prefetch_pool = ThreadPoolExecutor(max_workers=args.batch_prefetch)
+            sampler = utils.HostBatchPrefetcher(
+                batch_data, micro_batch_size, self.model.device, samples_per_micro_batch=samples_per_micro_batch,
+                prefetch=args.batch_prefetch, pool=self.prefetch_pool,
+            )
+        else:
+            sampler = None
+            ordering = list(range(batch_size))
+            np.random.shuffle(ordering)
 
         micro_batch_counter = 0
         outputs = []
 
         context = {}
 
-        for j in range(mini_batches):
+        self.grad_scaler = self.get_grad_scaler(optimizer)
 
-            optimizer.zero_grad(set_to_none=True)
+        try:
+            for j in range(mini_batches):
 
-            for k in range(micro_batches):
-                # put together a micro_batch.
-                batch_start = micro_batch_counter * micro_batch_size
-                batch_end = (micro_batch_counter + 1) * micro_batch_size
-                sample = ordering[batch_start:batch_end]
-                micro_batch_counter += 1
+                optimizer.zero_grad(set_to_none=True)
 
-                # context for the minibatch.
-                micro_batch_context = {
-                    'epoch': epoch,
-                    'mini_batch': j,
-                    'micro_batch': k,
-                    'is_first': j == 0,
-                    'is_last': j == mini_batches-1,
-                }
-                micro_batch_data = {}
-                micro_batch_data['context'] = micro_batch_context
+                for k in range(micro_batches):
+                    # put together a micro_batch.
+                    batch_start = micro_batch_counter * micro_batch_size
+                    batch_end = (micro_batch_counter + 1) * micro_batch_size
+                    micro_batch_counter += 1
 
-                for var_name, var_value in batch_data.items():
+                    # context for the minibatch.
+                    micro_batch_context = {
+                        'epoch': epoch,
+                        'mini_batch': j,
+                        'micro_batch': k,
+                        'is_first': j == 0,
+                        'is_last': j == mini_batches-1,
+                    }
+                    micro_batch_data = {}
+                    micro_batch_data['context'] = micro_batch_context
 
-                    if var_name.startswith('*'):
-                        # we pass these through directly.
-                        micro_batch_data[var_name] = var_value.to(self.model.device, non_blocking=True)
-                        continue
+                    if sampler is not None:
+                        micro_batch_data.update(sampler.sample(micro_batch_counter - 1))
+                    else:
+                        sample = ordering[batch_start:batch_end]
+                        for var_name, var_value in batch_data.items():
 
-                    data = var_value[sample]
+                            if var_name.startswith('*'):
+                                # we pass these through directly.
+                                micro_batch_data[var_name] = var_value.to(self.model.device, non_blocking=True)
+                                continue
 
-                    if thinning < 1.0:
-                        samples_to_use = int(micro_batch_size * thinning)
-                        data = data[:samples_to_use]
+                            data = var_value[sample]
 
-                    if data.dtype == np.object:
-                        # handle decompression
-                        data = np.asarray([data[i].decompress() for i in range(len(data))])
+                            if thinning < 1.0:
+                                samples_to_use = int(micro_batch_size * thinning)
+                                data = data[:samples_to_use]
 
-                    if type(data) is np.ndarray:
-                         data = torch.from_numpy(data)
+                            if data.dtype == np.object:
+                                # handle decompression
+                                data = np.asarray([data[i].decompress() for i in range(len(data))])
 
-                    # upload to gpu
-                    data = data.to(self.model.device, non_blocking=True)
+                            if type(data) is np.ndarray:
+                                 data = torch.from_numpy(data)
 
-                    micro_batch_data[var_name] = data
+                            # upload to gpu
+                            data = data.to(self.model.device, non_blocking=True)
 
-                result = mini_batch_func(micro_batch_data, loss_scale=1 / micro_batches)
+                            micro_batch_data[var_name] = data
 
-                if hooks is not None and "after_micro_batch" in hooks:
-                    hooks["after_micro_batch"](micro_batch_context)
+                    result = mini_batch_func(micro_batch_data, loss_scale=1 / micro_batches)
 
-                outputs.append(result)
+                    if hooks is not None and "after_micro_batch" in hooks:
+                        hooks["after_micro_batch"](micro_batch_context)
 
-            context = {
-                'mini_batches': j + 1,
-                'outputs': outputs
-            }
+                    outputs.append(result)
 
-            if hooks is not None and "after_mini_batch" in hooks:
-                if hooks["after_mini_batch"](context):
-                    context["did_break"] = True
-                    break
+                context = {
+                    'mini_batches': j + 1,
+                    'outputs': outputs
+                }
 
-            self.optimizer_step(optimizer=optimizer, label=label)
+                if hooks is not None and "after_mini_batch" in hooks:
+                    if hooks["after_mini_batch"](context):
+                        context["did_break"] = True
+                        break
+
+                self.optimizer_step(optimizer=optimizer, label=label)
+        finally:
+            # make sure background work is stopped, even if training fails part way through.
+            if sampler is not None:
+                sampler.close()
+            self.grad_scaler = None
 
         # free up memory by releasing grads.
         optimizer.zero_grad(set_to_none=True)
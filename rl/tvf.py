@@ -7,12 +7,13 @@ import rl
 from . config import args
 from . import utils
 from . returns import calculate_bootstrapped_returns
-from . returns_truncated import get_return_estimate
+from . returns_truncated import get_return_estimate, HorizonInterpolator
 
 import math
 import collections
 
 import time as clock
+from concurrent.futures import ThreadPoolExecutor
 
 
 class TVFRunnerModule(rl.rollout.RunnerModule):
@@ -29,6 +30,18 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
         self.tvf_final_value = np.zeros([N + 1, A], dtype=np.float32) # our final value estimate
         self.tvf_returns = np.zeros([N, A, K, VH], dtype=np.float32)
 
+        # head horizons are fixed for the run, so interpolation tables are only built once.
+        self.interpolators = {
+            use_log: HorizonInterpolator(parent.tvf_horizons, args.tvf.max_horizon, use_log_interpolation=use_log)
+            for use_log in [False, True]
+        }
+
+        # worker threads for get_return_estimate, shared between rollouts (see on_close)
+        if args.tvf.return_workers > 1:
+            self.return_pool = ThreadPoolExecutor(max_workers=args.tvf.return_workers)
+        else:
+            self.return_pool = None
+
     def on_train_value_minibatch(self, model_out, data, **kwargs):
 
         assert "tvf_returns" in data, "TVF returns were not uploaded with batch."
@@ -85,6 +98,11 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
     def on_reset(self):
         self._reset()
 
+    def on_close(self):
+        if self.return_pool is not None:
+            self.return_pool.shutdown(wait=True)
+            self.return_pool = None
+
     def on_before_generate_rollout(self):
         self._reset()
 
@@ -118,15 +136,15 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
         elif method == "timelimit":
             time_till_termination = np.maximum(args.env.timeout - time, 0)
         elif method == "est_term":
-            est_ep_length = np.percentile(list(self.runner.episode_length_buffer) + list(time), args.tvf.eta_percentile).astype(
+            est_ep_length = self.runner.episode_length_buffer.percentile(args.tvf.eta_percentile, time).astype(
                 int) + args.tvf.eta_buffer
             est_ep_length += args.tvf.eta_minh / 4  # apply small buffer
             time_till_termination = np.maximum(args.env.timeout - time, 0)
             est_time_till_termination = np.maximum(est_ep_length - time, args.tvf.eta_minh)
             time_till_termination = np.minimum(time_till_termination, est_time_till_termination)
             self.runner.log.watch_mean("*ttt_ep_length",
-                                np.percentile(self.runner.episode_length_buffer, args.tvf.eta_percentile).astype(int))
-            self.runner.log.watch_mean("*ttt_ep_std", np.std(self.runner.episode_length_buffer))
+                                self.runner.episode_length_buffer.percentile(args.tvf.eta_percentile).astype(int))
+            self.runner.log.watch_mean("*ttt_ep_std", self.runner.episode_length_buffer.std())
         else:
             raise ValueError(f"Invalid trimming method {method}")
 
@@ -134,6 +152,8 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
 
         A, K, VH = tvf_value_estimates.shape
         trimmed_ks = np.searchsorted(self.runner.tvf_horizons, time_till_termination)
+        # [A, K] true for horizons that extend past the trimming point
+        trimmed = np.arange(K)[None, :] >= trimmed_ks[:, None]
 
         # step 2: calculate new estimates
         if mode == "interpolate":
@@ -141,32 +161,19 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
             # however, all horizons still end up sharing the same estimate.
             # note: we now interpolate on log scale.
 
-            def log_scale(x):
-                return np.log10(10 + x) - 1
-
-            scale = log_scale
-            trimmed_value_estimate = horizon_interpolate(
-                scale(np.asarray(self.runner.tvf_horizons)),
+            trimmed_value_estimate = self.interpolators[True](
                 old_value_estimates[..., 0],  # select final value head
-                scale(time_till_termination)
+                time_till_termination,
             )
-            for a in range(A):
-                tvf_value_estimates[a, trimmed_ks[a]:, 0] = trimmed_value_estimate[a]
+            tvf_value_estimates[..., 0] = np.where(trimmed, trimmed_value_estimate[:, None], tvf_value_estimates[..., 0])
         elif mode == "average":
             # average up to h but no further
-            # implementation is a bit slow, drop if it's not better.
-            for a, trimmed_k in enumerate(trimmed_ks):
-                if trimmed_k >= len(self.runner.tvf_horizons) - 1:
-                    # this means no trimming
-                    continue
-                acc = 0
-                counter = 0
-                for k in range(trimmed_k, self.runner.K):
-                    # note: this could be tvf_value_estimate, but I want to make it explicit that we're using
-                    # the original values.
-                    acc += old_value_estimates[a, k, :]
-                    counter += 1
-                    tvf_value_estimates[a, k, :] = acc / counter
+            # running mean of the original values from the trimming point onwards.
+            # trimmed_k >= K-1 means no trimming.
+            mask = trimmed & (trimmed_ks[:, None] < K - 1)
+            acc = np.cumsum(np.where(mask[..., None], old_value_estimates, 0), axis=1)
+            counter = np.cumsum(mask, axis=1, dtype=np.float32)[..., None]
+            tvf_value_estimates = np.where(mask[..., None], acc / np.maximum(counter, 1), tvf_value_estimates)
         elif mode == "substitute":
             # just use the smallest h we can, very simple.
             untrimmed_ks = np.arange(self.runner.K)[None, :]
@@ -177,23 +184,22 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
         elif mode == "random":
             # randomly pick a valid horizon
             # the idea here is that each horizon (on each agent) gets a slightly different estimate.
-            # if this works well optimize...
-            for a, trimmed_k in zip(range(A), trimmed_ks):
-                new_ks = np.arange(K)
-                for k in range(trimmed_k, K):
-                    # leave horizons before trimming point as is,
-                    # latter horizons use a random horizon less than or equal to their own horizon
-                    new_ks[k] = np.random.randint(trimmed_k, k+1)
-                tvf_value_estimates[a, range(K)] = old_value_estimates[a, new_ks]
+            # leave horizons before trimming point as is,
+            # latter horizons use a random horizon less than or equal to their own horizon
+            ks = np.arange(K)[None, :]
+            low = np.minimum(trimmed_ks[:, None], ks)
+            new_ks = np.random.randint(low, ks + 1)
+            tvf_value_estimates = np.take_along_axis(old_value_estimates, new_ks[..., None], axis=1)
         else:
             raise ValueError(f"Invalid trimming mode {mode}")
 
         # calculate ext_value used for advantages by averaging over all valid horizons using
         # untrimmed estimates
-        final_value_estimates = np.zeros([A], dtype=np.float32)
-        for a, trimmed_k in enumerate(trimmed_ks):
-            trimmed_k = min(trimmed_k, K-1) # make sure there is always one sample.
-            final_value_estimates[a] = old_value_estimates[a, trimmed_k:, 0].mean() # just the ext_value head.
+        # make sure there is always one sample.
+        valid = np.arange(K)[None, :] >= np.minimum(trimmed_ks, K - 1)[:, None]
+        final_value_estimates = (
+                np.where(valid, old_value_estimates[..., 0], 0).sum(axis=1, dtype=np.float32) / valid.sum(axis=1)
+        ).astype(np.float32)  # just the ext_value head.
 
         # clip differences if needed...
         if args.tvf.trim_clip >= 0:
@@ -244,9 +250,19 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
         # step 2: calculate the returns
         start_time = clock.time()
 
+        # reward sums are shared with the other estimators when using this rollout's rewards.
+        if rewards is self.runner.ext_rewards and dones is self.runner.terminals:
+            context = self.runner.get_return_context(args.tvf.gamma)
+        else:
+            context = None
+
         # we must unnormalize the value estimates, then renormalize after
         values = self.tvf_value[..., self.runner.value_heads.index(value_head)]
 
+        if args.tvf.return_backend == "torch":
+            # rollout is stored on the cpu, so upload once and calculate returns on the model's device.
+            values = torch.from_numpy(np.ascontiguousarray(values)).to(args.device)
+
         returns = get_return_estimate(
             mode=tvf_return_mode,
             distribution=tvf_return_distribution,
@@ -259,8 +275,16 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
             n_step=tvf_n_step,
             max_samples=args.tvf.return_samples,
             use_log_interpolation=args.tvf.return_use_log_interpolation,
+            interpolator=self.interpolators[args.tvf.return_use_log_interpolation],
+            workers=args.tvf.return_workers,
+            pool=self.return_pool,
+            backend=args.tvf.return_backend,
+            context=context,
         )
 
+        if torch.is_tensor(returns):
+            returns = returns.cpu().numpy()
+
         return_estimate_time = clock.time() - start_time
         self.runner.log.watch_mean(
             "time_return_estimate",
@@ -294,7 +318,8 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
 
         # also log ev_ext
         targets = calculate_bootstrapped_returns(
-            self.runner.ext_rewards, self.runner.terminals, self.runner.ext_value[self.runner.N], args.gamma
+            self.runner.ext_rewards, self.runner.terminals, self.runner.ext_value[self.runner.N], args.gamma,
+            context=self.runner.get_return_context(args.gamma),
         )
         values = self.runner.ext_value[:self.runner.N]
         ev = utils.explained_variance(values.ravel(), targets.ravel())
@@ -357,6 +382,7 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
             old_gamma=args.tvf.gamma,
             new_gamma=new_gamma,
             horizons=self.runner.tvf_horizons,
+            device=args.device,
         ).reshape([(N + 1), A])
 
     def rediscount_horizons(self, old_value_estimates):
@@ -367,17 +393,13 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
         if args.tvf.gamma == args.gamma:
             return old_value_estimates
 
-        # old_distil_targets = batch_data["distil_targets"].copy()  # B, K
-        new_value_estimates = old_value_estimates.copy()
-        B, K = old_value_estimates.shape
-        for k in range(K):
-            new_value_estimates[:, k] = rl.tvf.get_rediscounted_value_estimate(
-                old_value_estimates[:, :k+1],
-                args.tvf.gamma,
-                args.gamma,
-                self.runner.tvf_horizons[:k+1]
-            )
-        return new_value_estimates
+        return rl.tvf.rediscount_value_curves(
+            old_value_estimates,
+            args.tvf.gamma,
+            args.gamma,
+            self.runner.tvf_horizons,
+            device=args.device,
+        )
 
     def save(self):
         pass
@@ -385,18 +407,88 @@ class TVFRunnerModule(rl.rollout.RunnerModule):
     def load(self):
         pass
 
+# rediscount matrices by (horizons, old_gamma, new_gamma, clipping, device), horizons are fixed for a run.
+_rediscount_matrices = {}
+
+
+def get_rediscount_matrix(horizons, old_gamma: float, new_gamma: float, clipping=10, device=None) -> torch.Tensor:
+    """
+    Returns (cached) float32 tensor M of shape [K, K] such that values @ M rediscounts value curves from old_gamma
+    to new_gamma. Column k gives the rediscounted value for the curve up to horizons[k].
+
+    horizons: int array of shape [K] giving horizon for value [:, k], first horizon must be 0
+    """
+
+    device = torch.device(device or "cpu")
+    key = (tuple(int(h) for h in horizons), old_gamma, new_gamma, clipping, str(device))
+    if key in _rediscount_matrices:
+        return _rediscount_matrices[key]
+
+    horizons = np.asarray(horizons, dtype=np.float64)
+    K = len(horizons)
+    assert horizons[0] == 0, 'first horizon must be 0'
+
+    # rewards occurred at some point after prev_h and before h, so just average them. Remembering that
+    # v_h includes up to and including h timesteps.
+    # also, we subtract 1 as the reward given by V_h=1 occurs at t=0
+    mid_h = ((horizons[:-1] + 1 + horizons[1:]) / 2) - 1
+    # a clipping of 10 gets us to about 2.5k horizon before we start introducing bias. (going from 1k to 10k discounting)
+    ratio = np.zeros([K + 1], dtype=np.float64)
+    ratio[1:K] = np.minimum((new_gamma ** mid_h) / (old_gamma ** mid_h), clipping)  # clipped ratio
+
+    # column k is sum_{i=1..k} (v_i - v_{i-1}) * ratio_i
+    i = np.arange(K)[:, None]
+    k = np.arange(K)[None, :]
+    matrix = ratio[:K, None] * ((i >= 1) & (i <= k)) - ratio[1:, None] * (i + 1 <= k)
+
+    result = torch.from_numpy(matrix.astype(np.float32)).to(device)
+    _rediscount_matrices[key] = result
+    return result
+
+
+def rediscount_value_curves(
+        values: Union[np.ndarray, torch.Tensor],
+        old_gamma: float,
+        new_gamma: float,
+        horizons,
+        clipping=10,
+        device=None,
+):
+    """
+    Rediscounts value curves for each horizon with a single matrix multiply.
+
+    values: float tensor of shape [*, K]
+    horizons: int tensor of shape [K] giving horizon for value [..., k]
+    device: device to use for ndarray inputs (tensors are processed on their own device)
+    returns float tensor of shape [*, K], where [..., k] is the rediscounted value at horizon horizons[k]
+    """
+
+    assert values.shape[-1] == len(horizons), f"missmatch {values.shape} {horizons}"
+
+    if type(values) is np.ndarray:
+        values = torch.from_numpy(np.ascontiguousarray(values, dtype=np.float32)).to(device or "cpu")
+        is_numpy = True
+    else:
+        is_numpy = False
+
+    result = values.float() @ get_rediscount_matrix(horizons, old_gamma, new_gamma, clipping, values.device)
+    return result.cpu().numpy() if is_numpy else result
+
+
 def get_rediscounted_value_estimate(
         values: Union[np.ndarray, torch.Tensor],
         old_gamma: float,
         new_gamma: float,
         horizons,
         clipping=10,
+        device=None,
 ):
     """
     Returns rediscounted return at horizon h
 
     values: float tensor of shape [B, K]
     horizons: int tensor of shape [K] giving horizon for value [:, k]
+    device: device to use for ndarray inputs (tensors are processed on their own device)
     returns float tensor of shape [B]
     """
 
@@ -406,31 +498,16 @@ def get_rediscounted_value_estimate(
         return values[:, -1]
 
     assert K == len(horizons), f"missmatch {K} {horizons}"
-    assert horizons[0] == 0, 'first horizon must be 0'
 
     if type(values) is np.ndarray:
-        values = torch.from_numpy(values)
+        values = torch.from_numpy(np.ascontiguousarray(values, dtype=np.float32)).to(device or "cpu")
         is_numpy = True
     else:
         is_numpy = False
 
-    prev = values[:, 0] # should be zero
-    prev_h = 0
-    discounted_reward_sum = torch.zeros([B], dtype=torch.float32, device=values.device)
-    for i_minus_one, h in enumerate(horizons[1:]):
-        i = i_minus_one + 1
-        # rewards occurred at some point after prev_h and before h, so just average them. Remembering that
-        # v_h includes up to and including h timesteps.
-        # also, we subtract 1 as the reward given by V_h=1 occurs at t=0
-        mid_h = ((prev_h+1 + h) / 2) - 1
-        discounted_reward = (values[:, i] - prev)
-        prev = values[:, i]
-        prev_h = h
-        # a clipping of 10 gets us to about 2.5k horizon before we start introducing bias. (going from 1k to 10k discounting)
-        ratio = min((new_gamma ** mid_h) / (old_gamma ** mid_h), clipping) # clipped ratio
-        discounted_reward_sum += discounted_reward * ratio
-
-    return discounted_reward_sum.numpy() if is_numpy else discounted_reward_sum
+    matrix = get_rediscount_matrix(horizons, old_gamma, new_gamma, clipping, values.device)
+    result = values.float() @ matrix[:, -1]
+    return result.cpu().numpy() if is_numpy else result
 
 
 def expand_to_h(h, x):
@@ -455,6 +532,78 @@ def calculate_gae_tvf(
     A modified version of GAE that uses truncated value estimates to support any discount function.
     This works by extracting estimated rewards from the value curve via a finite difference.
 
+    G^(n)(s_t) uses the rewards up to the pivot state t+n, then the expected rewards from the pivot state's value curve.
+    All G^(n) are calculated at once from cumulative sums, see _calculate_gae_tvf_reference for the direct version.
+
+    batch_reward: [N, A] rewards for each timestep
+    batch_value: [N, A, H] value at each timestep, for each horizon (0..max_horizon)
+    final_value_estimate: [A, H] value at timestep N+1
+    batch_terminal [N, A] terminal signals for each timestep
+    discount_fn A discount function in terms of t, the number of timesteps in the future.
+    lamb: lambda, as per GAE lambda.
+    """
+
+    N, A, H = batch_value.shape
+
+    values = np.concatenate([batch_value, final_value_estimate[None, :, :]], axis=0)
+
+    # get expected rewards. Note: I'm assuming here that the rewards have not been discounted
+    assert args.tvf.gamma == 1, "General discounting function requires TVF estimates to be undiscounted (might fix later)"
+    expected_rewards = values[:, :, 1:] - values[:, :, :-1]  # [N+1, A, H-1]
+
+    discounts = np.asarray([discount_fn(i) for i in range(N + H)], dtype=np.float32)
+
+    # offsets[t, i] = t + i, for the i-th step after t, only valid within the rollout.
+    offsets = np.arange(N)[:, None] + np.arange(N)[None, :]
+    in_rollout = (offsets < N)[..., None]
+    offsets = np.minimum(offsets, N - 1)
+
+    # terminal_discount[t, i] handles terminals for the i-th reward after t (terminal on that step included)
+    terminal_discount = np.cumprod(np.where(in_rollout, 1 - batch_terminal[offsets], 0), axis=1).astype(np.float32)
+
+    # reward_sums[t, n] is the (discounted) sum of the first n rewards after t, [N, N+1, A]
+    reward_sums = np.zeros([N, N + 1, A], dtype=np.float32)
+    reward_sums[:, 1:] = np.cumsum(
+        np.where(in_rollout, batch_reward[offsets], 0) * terminal_discount * discounts[None, :N, None], axis=1
+    )
+
+    # expected_sums[p, n] is the (discounted) sum of expected rewards from pivot state p, when it is n steps ahead.
+    # i.e. sum_j expected_rewards[p, j] * discount_fn(n + j) for n + j < H, [N+1, A, N+1]
+    n = np.arange(N + 1)
+    j = np.arange(H - 1)
+    future_discounts = np.where(n[:, None] + j[None, :] < H, discounts[n[:, None] + j[None, :]], 0)
+    expected_sums = expected_rewards @ future_discounts.T
+
+    # g[t, n-1] = G^(n)(s_t), for n=1..N (only n <= N-t are used, so the pivot state is always within the rollout or
+    # the final state)
+    ts = np.arange(N)[:, None]
+    ns = np.arange(1, N + 1)[None, :]
+    pivots = np.minimum(ts + ns, N)
+    # only the first H rewards are included, as the value curve stops at H.
+    g = reward_sums[:, np.minimum(ns[0], H)]
+    g += terminal_discount * expected_sums[pivots, :, ns].astype(np.float32)
+
+    # weights are assigned with exponential decay, except that the weight of the final g_return uses
+    # all remaining weight. This is the same as assuming that g(>max_n) = g(n)
+    max_ns = N - ts
+    weights = np.where(ns < max_ns, (1 - lamb) * lamb ** (ns - 1.0), lamb ** (max_ns - 1.0))
+    weights[(ns > max_ns) | (weights <= 1e-6)] = 0  # ignore small or zero weights.
+
+    advantages = np.einsum('tn,tna->ta', weights.astype(np.float32), g) - batch_value[:, :, -1]
+    return advantages.astype(np.float32)
+
+
+def _calculate_gae_tvf_reference(
+        batch_reward: np.ndarray,
+        batch_value: np.ndarray,
+        final_value_estimate: np.ndarray,
+        batch_terminal: np.ndarray,
+        discount_fn = lambda t: 0.999**t,
+        lamb: float = 0.95):
+
+    """
+    Slow reference version of calculate_gae_tvf.
+
     batch_reward: [N, A] rewards for each timestep
     batch_value: [N, A, H] value at each timestep, for each horizon (0..max_horizon)
     final_value_estimate: [A, H] value at timestep N+1
@@ -470,14 +619,14 @@ def calculate_gae_tvf(
 
     # get expected rewards. Note: I'm assuming here that the rewards have not been discounted
     assert args.tvf.gamma == 1, "General discounting function requires TVF estimates to be undiscounted (might fix later)"
-    expected_rewards = values[:, :, 0] - batch_value[:, :, 1]
+    expected_rewards = values[:, :, 1:] - values[:, :, :-1]
 
     def calculate_g(t, n:int):
         """ Calculate G^(n) (s_t) """
         # we use the rewards first, then use expected rewards from 'pivot' state onwards.
         # pivot state is either the final state in rollout, or t+n, which ever comes first.
-        sum_of_rewards = np.zeros([N], dtype=np.float32)
-        discount = np.ones([N], dtype=np.float32) # just used to handle terminals
+        sum_of_rewards = np.zeros([A], dtype=np.float32)
+        discount = np.ones([A], dtype=np.float32) # just used to handle terminals
         pivot_state = min(t+n, N)
         for i in range(H):
             if t+i < pivot_state:
@@ -503,7 +652,7 @@ def calculate_gae_tvf(
         for _ in range(max_n-1):
             weights.append(weight)
             weight *= lamb
-        weights.append(lamb**max_n)
+        weights.append(lamb**(max_n-1))
         weights = np.asarray(weights)
 
         assert abs(weights.sum() - 1.0) < 1e-6
@@ -538,7 +687,7 @@ def horizon_interpolate(horizons: np.ndarray, values: np.ndarray, target_horizon
     # I did this custom, as I could not find a way to get numpy to interpolate the way I needed it to.
     # the issue is we interpolate nd data with non-uniform target x's.
 
-    assert len(set(horizons)) == len(horizons), f"Horizons duplicates not supported {horizons}"
+    # strictly ascending also rules out duplicates
     assert np.all(np.diff(horizons) > 0), f"Horizons must be sorted and unique horizons:{horizons}, targets:{target_horizons}"
 
     assert horizons[0] == 0, "first horizon must be 0"
@@ -19,6 +19,8 @@ import gym
 
 from typing import List, Union
 from collections import deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 
 NATS_TO_BITS = 1.0/math.log(2)
 
@@ -455,6 +457,273 @@ class RunningMeanStd(object):
         self.mean, self.var, self.count = state
 
 
+class SortedWindow(object):
+    """
+    Fixed length window of values (like deque(maxlen=...)) that also keeps a sorted copy,
+    so that percentiles can be found without sorting the whole window every time.
+    A running sum and sum of squares are kept for the mean and standard deviation.
+    """
+
+    def __init__(self, maxlen: int, values=()):
+        self.maxlen = maxlen
+        self._items = deque(maxlen=maxlen)
+        self._sorted = np.zeros([0], dtype=np.float64)
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        if len(self._items) == self.maxlen:
+            oldest = self._items[0]
+            self._sorted = np.delete(self._sorted, np.searchsorted(self._sorted, oldest))
+            self._sum -= float(oldest)
+            self._sum_sq -= float(oldest) ** 2
+        self._items.append(value)
+        self._sorted = np.insert(self._sorted, np.searchsorted(self._sorted, value), value)
+        self._sum += float(value)
+        self._sum_sq += float(value) ** 2
+
+    def clear(self):
+        self._items.clear()
+        self._sorted = np.zeros([0], dtype=np.float64)
+        self._sum = 0.0
+        self._sum_sq = 0.0
+
+    def mean(self):
+        """
+        Returns the mean of the window (nan if empty), matching np.mean(window).
+        """
+        if len(self._items) == 0:
+            return float('nan')
+        return self._sum / len(self._items)
+
+    def std(self):
+        """
+        Returns the (population) standard deviation of the window (nan if empty), matching np.std(window).
+        """
+        if len(self._items) == 0:
+            return float('nan')
+        mean = self._sum / len(self._items)
+        return math.sqrt(max(self._sum_sq / len(self._items) - mean ** 2, 0.0))
+
+    def percentile(self, q: float, extra: np.ndarray = None):
+        """
+        Returns the q-th percentile of the window, optionally including some extra values (which are not stored).
+        Matches np.percentile(list(window) + list(extra), q).
+        """
+        values = self._sorted
+        if extra is not None and len(extra) > 0:
+            extra = np.sort(np.asarray(extra, dtype=np.float64).ravel())
+            values = np.insert(values, np.searchsorted(values, extra), extra)
+        # values are already sorted, so just interpolate between the closest ranks.
+        rank = (len(values) - 1) * q / 100
+        lo = int(math.floor(rank))
+        hi = min(lo + 1, len(values) - 1)
+        return values[lo] + (values[hi] - values[lo]) * (rank - lo)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(list(self._items), dtype=dtype)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_sum' not in state:
+            # windows saved before the running sums were added.
+            self._sum = float(np.sum(self._sorted))
+            self._sum_sq = float(np.sum(self._sorted ** 2))
+
+
+class DeviceBatchSampler(object):
+    """
+    Samples shuffled micro-batches from a batch that is already on the device (see Runner.upload_batch).
+    Orderings are generated on the device, and each micro-batch is gathered into preallocated buffers,
+    so sampling does not copy anything between the host and the device.
+
+    Buffers are reused, so a micro-batch is only valid until the next one is sampled.
+    """
+
+    def __init__(self, batch_data: dict, micro_batch_size: int, device, samples_per_micro_batch: int = None):
+        """
+        @param samples_per_micro_batch: if given only this many of each micro_batch_size samples are used (thinning).
+        """
+        self.device = torch.device(device)
+        self.micro_batch_size = micro_batch_size
+        self.samples_per_micro_batch = samples_per_micro_batch or micro_batch_size
+        # fields starting with '*' are passed through directly.
+        self.passthrough = {k: v for k, v in batch_data.items() if k.startswith('*')}
+        self.fields = {k: v for k, v in batch_data.items() if not k.startswith('*')}
+        for k, v in self.fields.items():
+            assert type(v) is torch.Tensor and v.device.type == self.device.type, f"Field {k} must be a tensor on {self.device}."
+        self.batch_size = len(next(iter(self.fields.values())))
+        self.buffers = {
+            k: torch.empty([self.samples_per_micro_batch, *v.shape[1:]], dtype=v.dtype, device=self.device)
+            for k, v in self.fields.items()
+        }
+        self.ordering = None
+        self.shuffle()
+
+    def shuffle(self):
+        self.ordering = torch.randperm(self.batch_size, device=self.device)
+
+    def sample(self, micro_batch: int) -> dict:
+        """
+        Returns the given micro-batch of the current ordering.
+        """
+        start = micro_batch * self.micro_batch_size
+        sample = self.ordering[start:start + self.samples_per_micro_batch]
+        for k, v in self.fields.items():
+            torch.index_select(v, 0, sample, out=self.buffers[k])
+        return {**self.buffers, **self.passthrough}
+
+    def close(self):
+        pass
+
+
+class HostBatchPrefetcher(object):
+    """
+    Samples shuffled micro-batches from a batch held in host memory (i.e. when upload_batch is off).
+    Micro-batches are gathered, decompressed and (on cuda) pinned and uploaded on background threads, a few
+    micro-batches ahead of the one being trained on. Uploads use a separate cuda stream, so they overlap with compute.
+    """
+
+    def __init__(
+            self,
+            batch_data: dict,
+            micro_batch_size: int,
+            device,
+            samples_per_micro_batch: int = None,
+            prefetch: int = 2,
+            pool: ThreadPoolExecutor = None,
+    ):
+        """
+        @param samples_per_micro_batch: if given only this many of each micro_batch_size samples are used (thinning).
+        @param prefetch: number of micro-batches to prepare ahead of the current one.
+        @param pool: thread pool to prepare micro-batches on, if not given one is created (and shut down on close).
+        """
+        self.device = torch.device(device)
+        self.micro_batch_size = micro_batch_size
+        self.samples_per_micro_batch = samples_per_micro_batch or micro_batch_size
+        self.prefetch = prefetch
+        self.passthrough = {k: v for k, v in batch_data.items() if k.startswith('*')}
+        self.fields = {k: v for k, v in batch_data.items() if not k.startswith('*')}
+        self.batch_size = len(next(iter(self.fields.values())))
+        self.micro_batches = self.batch_size // micro_batch_size
+        self.use_cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        self.owns_pool = pool is None
+        self.pool = pool or ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        self.pending = {}
+        self.ordering = np.random.permutation(self.batch_size)
+
+    def _gather(self, value, sample: np.ndarray) -> torch.Tensor:
+        """
+        Gathers samples from value into a (pinned if using cuda) tensor, decompressing if needed.
+        """
+        if type(value) is torch.Tensor:
+            data = value[torch.from_numpy(sample).to(value.device)]
+            return data.pin_memory() if self.use_cuda and data.device.type == "cpu" else data
+        data = value[sample]
+        if data.dtype == object:
+            # decompress straight into the output, rather than stacking then copying.
+            first = data[0].decompress()
+            dtype = torch.as_tensor(np.zeros([0], dtype=first.dtype)).dtype
+            result = torch.empty([len(data), *first.shape], dtype=dtype, pin_memory=self.use_cuda)
+            result_np = result.numpy()
+            result_np[0] = first
+            for i in range(1, len(data)):
+                result_np[i] = data[i].decompress()
+            return result
+        data = torch.from_numpy(data)
+        return data.pin_memory() if self.use_cuda else data
+
+    def _assemble(self, micro_batch: int):
+        start = micro_batch * self.micro_batch_size
+        sample = self.ordering[start:start + self.samples_per_micro_batch]
+        result = {k: self._gather(v, sample) for k, v in self.fields.items()}
+        if not self.use_cuda:
+            return {k: v.to(self.device) for k, v in result.items()}, None
+        with torch.cuda.stream(self.stream):
+            result = {k: v.to(self.device, non_blocking=True) for k, v in result.items()}
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return result, event
+
+    def sample(self, micro_batch: int) -> dict:
+        """
+        Returns the given micro-batch of the current ordering, and starts preparing the next ones.
+        """
+        for m in range(micro_batch, min(micro_batch + 1 + self.prefetch, self.micro_batches)):
+            if m not in self.pending:
+                self.pending[m] = self.pool.submit(self._assemble, m)
+        result, event = self.pending.pop(micro_batch).result()
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # memory was allocated on the upload stream, so make sure it is not reused while still in use.
+            for v in result.values():
+                v.record_stream(current_stream)
+        result.update({k: v.to(self.device, non_blocking=True) for k, v in self.passthrough.items()})
+        return result
+
+    def close(self):
+        """
+        Cancels any micro-batches not yet started, and waits for those in progress.
+        """
+        for future in self.pending.values():
+            future.cancel()
+        concurrent.futures.wait(self.pending.values())
+        self.pending.clear()
+        if self.owns_pool:
+            self.pool.shutdown(wait=True)
+
+
+def no_compile(fn):
+    """
+    Excludes fn from tracing by torch.compile (fn runs eagerly, with a graph break).
+    Does nothing on versions of torch without torch.compile.
+    """
+    if not hasattr(torch, "compile"):
+        return fn
+    return torch._dynamo.disable(fn)
+
+
+class BatchSizeCompiledFunction(object):
+    """
+    Wraps a function with torch.compile. Only the first few batch sizes it is called with are compiled, calls with
+    other batch sizes run eagerly, so that changing shapes (e.g. thinning, or async rollouts) do not keep triggering
+    recompiles.
+
+    Calls are not traced by an enclosing compiled function, so compiled functions can call each other.
+    """
+
+    def __init__(self, fn, get_batch_size, mode: str = "default", max_batch_sizes: int = 4):
+        """
+        @param get_batch_size: function taking the same arguments as fn and returning the batch size.
+        @param mode: torch.compile mode [default|reduce-overhead|max-autotune], reduce-overhead uses CUDA graphs.
+        """
+        assert hasattr(torch, "compile"), "torch.compile requires torch 2.0 or later."
+        self.fn = fn
+        self.get_batch_size = get_batch_size
+        self.max_batch_sizes = max_batch_sizes
+        self.batch_sizes = set()
+        self.compiled_fn = torch.compile(fn, mode=mode)
+
+    @no_compile
+    def __call__(self, *args, **kwargs):
+        batch_size = self.get_batch_size(*args, **kwargs)
+        if batch_size not in self.batch_sizes:
+            if len(self.batch_sizes) >= self.max_batch_sizes:
+                return self.fn(*args, **kwargs)
+            self.batch_sizes.add(batch_size)
+        return self.compiled_fn(*args, **kwargs)
+
+
 # -------------------------------------------------------------
 # Rollouts
 # -------------------------------------------------------------
@@ -981,20 +1250,33 @@ def restore_env_state(env, save_state:dict):
 
     # print(f"Restoring state on env: {env} with dict:{save_state.keys()}")
 
+    vec_wrappers = []
+
     while True:
 
         if issubclass(type(env), gym.vector.SyncVectorEnv):
             # process each sub-child
             # print("Enumerating environments...")
             for i, sub_env, in enumerate(env.envs):
-                restore_env_state(sub_env, save_state[f"vec_{i:03d}"])
+                sub_state = save_state[f"vec_{i:03d}"]
+                restore_env_state(sub_env, sub_state)
+                for vec_wrapper in vec_wrappers:
+                    key = type(vec_wrapper).__name__
+                    if key in sub_state:
+                        vec_wrapper.restore_sub_state(i, sub_state[key])
             return
 
         # otherwise process wrapper and move down the chain
         key = type(env).__name__
-        if key in save_state:
+        if "restore_sub_state" in dir(env):
+            # vector wrapper with per environment state, which is stored with each environment
+            vec_wrappers.append(env)
+        elif key in save_state:
             # print(f"Restoring {key} with {save_state}")
             env.restore_state(save_state[key])
+        elif getattr(type(env), "LEGACY_STATE_KEY", None) in save_state:
+            # state saved by the wrapper this one replaced.
+            env.restore_state(save_state[type(env).LEGACY_STATE_KEY])
 
         # end of chain
         if not hasattr(env, "env") or env.env == env:
@@ -1006,24 +1288,33 @@ def restore_env_state(env, save_state:dict):
 def save_env_state(env):
     """
     Produces a dictionary containing state of all wrappers for this environment.
+    Vector wrappers that implement save_sub_state have their state stored with each of their environments.
 
     Does not support async_vec_env, but does support hybrid_vec_env
     """
 
     save_data = {}
+    vec_wrappers = []
 
     while True:
 
         if issubclass(type(env), gym.vector.SyncVectorEnv):
             # process each sub-child
-            for i, env, in enumerate(env.envs):
-                save_data[f"vec_{i:03d}"] = save_env_state(env)
+            for i, sub_env, in enumerate(env.envs):
+                save_data[f"vec_{i:03d}"] = save_env_state(sub_env)
+                for vec_wrapper in vec_wrappers:
+                    sub_state = {}
+                    vec_wrapper.save_sub_state(i, sub_state)
+                    save_data[f"vec_{i:03d}"][type(vec_wrapper).__name__] = sub_state
             return save_data
 
         # otherwise process wrapper and move down the chain
         # note: silly wrappers override __get_attr__ so we can't use get_attr(env, "save_state, None)
         key = type(env).__name__
-        if "save_state" in dir(env):
+        if "save_sub_state" in dir(env):
+            # vector wrapper with per environment state, which is stored with each environment
+            vec_wrappers.append(env)
+        elif "save_state" in dir(env):
             save_dict = {}
             env.save_state(save_dict)
             if len(save_dict) > 0:
@@ -1049,6 +1340,26 @@ def merge_down(x:Union[np.ndarray, torch.Tensor]) -> Union[np.ndarray, torch.Ten
     a, b, *remainder = x.shape
     return x.reshape([a * b, *remainder])
 
+
+def pin_memory(x: np.ndarray) -> bool:
+    """
+    Page locks the memory of an existing numpy array (e.g. one in shared memory), so that uploads to the GPU are
+    faster. Returns if the memory was pinned.
+    """
+    if not torch.cuda.is_available():
+        return False
+    result = torch.cuda.cudart().cudaHostRegister(x.ctypes.data, x.nbytes, 0)
+    return int(result) == 0
+
+
+def unpin_memory(x: np.ndarray) -> bool:
+    """
+    Unregisters memory pinned by pin_memory. This must be done before the memory is released.
+    Returns if the memory was unpinned.
+    """
+    result = torch.cuda.cudart().cudaHostUnregister(x.ctypes.data)
+    return int(result) == 0
+
 # -------------------------------------------------------------
 # Timer
 # -------------------------------------------------------------
@@ -755,7 +755,48 @@ class ReturnTracker():
         self.ret_rms.update(self.current_returns[mask])
 
 
-class VecRepeatedActionPenalty(gym.Wrapper):
+class VecWrapper(gym.Wrapper):
+    """
+    Base class for vector wrappers that post-process the results of a vectorized step.
+    Supports partial steps (see HybridAsyncVectorEnv.step_partial), where actions are sent to groups of environments
+    as they become available, and the results are then collected (and processed) together with step_wait.
+    Also supports async steps (see HybridAsyncVectorEnv.send / recv), where results are processed for only the
+    environments given by env_ids.
+    """
+
+    def __init__(self, env: VectorEnv):
+        super().__init__(env)
+        self._pending_actions = None
+
+    def process_step(self, actions, obs, rewards, dones, infos, env_ids=None):
+        return obs, rewards, dones, infos
+
+    def step(self, actions):
+        return self.process_step(actions, *self.env.step(actions))
+
+    def _store_pending_actions(self, actions, index):
+        if self._pending_actions is None:
+            actions = np.asarray(actions)
+            self._pending_actions = np.zeros([self.env.num_envs, *actions.shape[1:]], dtype=actions.dtype)
+        self._pending_actions[index] = actions
+
+    def step_partial(self, actions, start: int, end: int):
+        self._store_pending_actions(actions, slice(start, end))
+        self.env.step_partial(actions, start, end)
+
+    def step_wait(self):
+        return self.process_step(self._pending_actions.copy(), *self.env.step_wait())
+
+    def send(self, actions, env_ids=None):
+        self._store_pending_actions(actions, slice(None) if env_ids is None else env_ids)
+        self.env.send(actions, env_ids)
+
+    def recv(self, min_envs: int = 1, timeout=None):
+        obs, rewards, dones, infos, env_ids = self.env.recv(min_envs, timeout)
+        return (*self.process_step(self._pending_actions[env_ids], obs, rewards, dones, infos, env_ids=env_ids), env_ids)
+
+
+class VecRepeatedActionPenalty(VecWrapper):
 
     def __init__(self, env: VectorEnv, max_repeated_actions: int, penalty: float = 1):
         super().__init__(env)
@@ -769,30 +810,30 @@ class VecRepeatedActionPenalty(gym.Wrapper):
         self.duplicate_counter *= 0
         return self.env.reset()
 
-    def step(self, actions):
+    def process_step(self, actions, obs, rewards, dones, infos, env_ids=None):
 
-        obs, rewards, dones, infos = self.env.step(actions)
+        ids = slice(None) if env_ids is None else env_ids
 
         no_action_mask = (actions >= 0) # action=-1 means we ignored that environment
-        mask = (actions == self.prev_actions) * no_action_mask
-        self.duplicate_counter += mask
-        self.duplicate_counter *= mask
+        mask = (actions == self.prev_actions[ids]) * no_action_mask
+        self.duplicate_counter[ids] = (self.duplicate_counter[ids] + mask) * mask
 
-        too_many_repeated_actions = (self.duplicate_counter > self.max_repeated_actions)
+        too_many_repeated_actions = (self.duplicate_counter[ids] > self.max_repeated_actions)
 
         infos[0]['max_repeats'] = np.max(self.duplicate_counter)
         infos[0]['mean_repeats'] = np.mean(self.duplicate_counter)
+        infos[0]['repeated_actions'] = np.sum(too_many_repeated_actions)
 
         if np.sum(too_many_repeated_actions) > 0:
             for i, repeated_action in enumerate(too_many_repeated_actions):
                 if repeated_action:
                     infos[i]['repeated_action'] = actions[i]
 
-        self.prev_actions[:] = actions[:]
+        self.prev_actions[ids] = actions[:]
 
         return obs, rewards - (too_many_repeated_actions * self.penalty), dones, infos
 
-class VecNormalizeRewardWrapper(gym.Wrapper):
+class VecNormalizeRewardWrapper(VecWrapper):
     """
     Normalizes rewards such that returns are roughly unit variance.
     Vectorized version.
@@ -840,8 +881,7 @@ class VecNormalizeRewardWrapper(gym.Wrapper):
         self.current_returns *= 0
         return self.env.reset()
 
-    def step(self, actions):
-        obs, rewards, dones, infos = self.env.step(actions)
+    def process_step(self, actions, obs, rewards, dones, infos, env_ids=None):
 
         # note:
         # we used to do this with:
@@ -864,21 +904,30 @@ class VecNormalizeRewardWrapper(gym.Wrapper):
 
         # the self.gamma here doesn't make sense to me as we are discounting into the future rather than from the past
         # but it is what OpenAI does...
-        self.current_returns = rewards + self.gamma * self.current_returns * (1-dones)
+        if env_ids is None:
+            self.current_returns = rewards + self.gamma * self.current_returns * (1-dones)
+            current_returns = self.current_returns
+        else:
+            current_returns = rewards + self.gamma * self.current_returns[env_ids] * (1-dones)
+            self.current_returns[env_ids] = current_returns
 
         # episodic discounting return normalization
         if self.ed_type is not None:
-            times = np.asarray([info.get('time', 0) for info in infos]) # during warmup we occasionally get some empty infos
+            info_arrays = getattr(self.env, "info_arrays", None)
+            if info_arrays is not None:
+                times = info_arrays['time']
+            else:
+                times = np.asarray([info.get('time', 0) for info in infos]) # during warmup we occasionally get some empty infos
             norms = EpisodicDiscounting.get_normalization_constant(times, self.ed_type, discount_bias=self.ed_bias)
         else:
             norms = 1
 
-        self.ret_rms.update(self.returns_transform(self.current_returns/norms)) # stub /norms
+        self.ret_rms.update(self.returns_transform(current_returns/norms)) # stub /norms
 
         if self.mode == "ema":
             # note: we move EMA a bit faster at the beginning
             alpha = 1 - (len(dones) / min(self.ret_rms.count, self.ema_horizon))
-            self.ret_var = alpha * self.ret_var + (1 - alpha) * np.var(self.current_returns)
+            self.ret_var = alpha * self.ret_var + (1 - alpha) * np.var(current_returns)
 
         scaled_rewards = rewards / self.std
         # print(self.current_returns.max())
@@ -919,6 +968,184 @@ class VecNormalizeRewardWrapper(gym.Wrapper):
         self.current_returns = buffer["current_returns"]
 
 
+class VecAtariPreprocessing(VecWrapper):
+    """
+    Vectorized version of the frame processing wrappers used by atari.make, that is AtariWrapper, ZeroObsWrapper,
+    ColorTransformWrapper, ActionAwareWrapper, FrameStack, TimeChannelWrapper and ChannelsFirstWrapper.
+
+    Input should be a vector env with raw (210, 160, 3) RGB frames (see atari.make with vector_preprocessing).
+    Frames are processed for all environments at once, and written into a preallocated channels first observation
+    buffer, where the frame stack is shifted in place and the time channel is the final slot.
+    Output is identical to the per environment wrappers.
+
+    Observations returned by step and reset are a buffer that is overwritten on the next step.
+    Negative actions leave the environment's observation as it was (see NullActionWrapper).
+    """
+
+    ACTION_BLOCK_SIZE = 4
+
+    def __init__(self, env: VectorEnv, width=84, height=84, color_mode="bw", n_stacks=4, embed_action=False,
+                 embed_time=False, zero_obs=False, interpolation=None):
+        super().__init__(env)
+
+        input_shape = env.single_observation_space.shape
+        assert input_shape == (210, 160, 3), f"Invalid shape {input_shape}"
+        assert color_mode in ["bw", "rgb", "yuv", "hsv"], f'Color mode should be one of ["bw", "rgb", "yuv", "hsv"] but was {color_mode}'
+
+        if interpolation is None:
+            # same defaults as AtariWrapper
+            if (width, height) == (210, 160):
+                interpolation = cv2.INTER_NEAREST
+            elif (width, height) == (105, 80):
+                interpolation = cv2.INTER_LINEAR
+            else:
+                interpolation = cv2.INTER_AREA
+
+        self._width, self._height = width, height
+        self.interpolation = interpolation
+        self.color_mode = color_mode
+        self.n_stacks = n_stacks
+        self.embed_action = embed_action
+        self.embed_time = embed_time
+        self.zero_obs = zero_obs
+
+        # AtariWrapper outputs frames of shape (width, height, C)
+        N = env.num_envs
+        H, W = width, height
+        C = 1 if color_mode == "bw" else 3
+        self.frame_channels = C
+        obs_channels = C * n_stacks + (1 if embed_time else 0)
+
+        self.single_observation_space = gym.spaces.Box(0, 255, (obs_channels, H, W), dtype=np.uint8)
+        self.observation_space = gym.vector.utils.batch_space(self.single_observation_space, N)
+
+        self.info_channels = {
+            "bw": ["Gray"],
+            "rgb": ["ColorR", "ColorG", "ColorB"],
+            "yuv": ["ColorY", "ColorU", "ColorV"],
+            "hsv": ["ColorH", "ColorS", "ColorV"],
+        }[color_mode] * n_stacks + (["Gray"] if embed_time else [])
+
+        self._resized = np.zeros([N, H, W, 3], dtype=np.uint8)
+        self._colored = np.zeros([N, H, W, C], dtype=np.uint8)
+        self.obs = np.zeros([N, obs_channels, H, W], dtype=np.uint8)
+
+    def _process_frames(self, frames, env_ids):
+        """
+        Resizes and color transforms frames for given environments, returns frames of dims [len(env_ids), H, W, C]
+        """
+        n = len(env_ids)
+        resized = self._resized[:n]
+        if frames.shape[1:3] != (self._width, self._height):
+            for i, env_id in enumerate(env_ids):
+                cv2.resize(frames[env_id], (self._height, self._width), dst=resized[i], interpolation=self.interpolation)
+        else:
+            resized[:] = frames[env_ids]
+
+        if self.zero_obs:
+            resized *= 0
+
+        if self.color_mode == "rgb":
+            return resized
+
+        # stack environments vertically so that opencv can process them in one call.
+        conversion = {
+            "bw": cv2.COLOR_RGB2GRAY,
+            "yuv": cv2.COLOR_RGB2YUV,
+            "hsv": cv2.COLOR_RGB2HSV,
+        }[self.color_mode]
+        colored = self._colored[:n]
+        stacked = resized.reshape(n * self._width, self._height, 3)
+        cv2.cvtColor(stacked, conversion, dst=colored.reshape(n * self._width, self._height, -1))
+        return colored
+
+    def _mark_actions(self, frames, actions):
+        """
+        Marks actions onto frames of dims [N, H, W, C] in place, matching ActionAwareWrapper.
+        """
+        B = self.ACTION_BLOCK_SIZE
+        H, W = frames.shape[1:3]
+        for i, action in enumerate(actions):
+            if action < 0:
+                continue
+            x = action * B
+            if H < W:
+                # ActionAwareWrapper treats these frames as channels first.
+                frames[i, :, x:x + B, 0:B] = 255
+            else:
+                frames[i, x:x + B, 0:B, :] = 255
+
+    def _write_obs(self, env_ids, frames, actions, time_frac, reset_mask):
+        """
+        Pushes frames (of dims [len(env_ids), H, W, C]) onto the frame stack of given environments.
+        Environments in reset_mask have their stack filled with the given frame, and do not have an action marked.
+        """
+        C = self.frame_channels
+        S = self.n_stacks
+
+        if self.embed_action:
+            self._mark_actions(frames, np.where(reset_mask, -1, actions))
+
+        frames = frames.transpose(0, 3, 1, 2)
+
+        all_envs = len(env_ids) == self.num_envs
+        # this is a view when all environments are processed, otherwise a copy that we write back.
+        stack = self.obs[:, :C * S] if all_envs else self.obs[env_ids, :C * S]
+
+        # newest frame goes first (numpy handles the overlapping copy).
+        stack[:, C:] = stack[:, :-C]
+        stack[:, :C] = frames
+        if np.any(reset_mask):
+            for k in range(1, S):
+                stack[reset_mask, k * C:(k + 1) * C] = frames[reset_mask]
+
+        if not all_envs:
+            self.obs[env_ids, :C * S] = stack
+
+        if self.embed_time:
+            self.obs[env_ids, -1] = (time_frac * 255).astype(np.uint8)[:, None, None]
+
+    def reset(self, **kwargs):
+        frames = self.env.reset(**kwargs)
+        env_ids = np.arange(self.num_envs)
+        self._write_obs(
+            env_ids,
+            self._process_frames(frames, env_ids),
+            np.full([self.num_envs], -1),
+            np.zeros([self.num_envs]),
+            np.ones([self.num_envs], dtype=bool),
+        )
+        return self.obs
+
+    def process_step(self, actions, obs, rewards, dones, infos, env_ids=None):
+        assert env_ids is None, "VecAtariPreprocessing should be applied before async stepping."
+        actions = np.asarray(actions)
+
+        # environments given a null action keep their previous observation.
+        env_ids = np.flatnonzero(actions >= 0)
+        if len(env_ids) > 0:
+            if self.embed_time:
+                for i in env_ids:
+                    assert 'time_frac' in infos[i], "must include timelimit wrapper before VecAtariPreprocessing"
+                time_frac = np.asarray([0 if dones[i] else infos[i]['time_frac'] for i in env_ids])
+            else:
+                time_frac = None
+            self._write_obs(env_ids, self._process_frames(obs, env_ids), actions[env_ids], time_frac, dones[env_ids])
+
+        for info in infos:
+            info["channels"] = list(self.info_channels)
+
+        return self.obs, rewards, dones, infos
+
+    def save_sub_state(self, index: int, buffer):
+        """
+        Saves state for environment at given index (see utils.save_env_state).
+        """
+        buffer["obs"] = self.obs[index].copy()
+
+    def restore_sub_state(self, index: int, buffer):
+        self.obs[index] = buffer["obs"]
+
 
 class MultiEnvVecNormalizeRewardWrapper(gym.Wrapper):
     """
@@ -1560,6 +1787,107 @@ class FrameStack(gym.Wrapper):
         self.stack = buffer["stack"]
 
 
+class RingFrameStack(gym.Wrapper):
+    """
+    Frame stacker that keeps frames in a preallocated circular buffer, in channels first order.
+    Equivalent to FrameStack, (optionally) TimeChannelWrapper, then ChannelsFirstWrapper.
+
+    Each frame is written twice, at head and head+n_stacks, so that the most recent n_stacks frames are always a
+    contiguous block in stack order (newest first). Without the time channel the observation returned is a view of
+    this block, which is only valid until the next step. With the time channel it is copied into a reused buffer.
+
+    Input should be h,w,c order, output is c,h,w
+    """
+
+    # checkpoints from before this replaced FrameStack store the stack under FrameStack (see utils.restore_env_state)
+    LEGACY_STATE_KEY = "FrameStack"
+
+    def __init__(self, env, n_stacks=4, embed_time=False):
+
+        super().__init__(env)
+
+        assert len(env.observation_space.shape) == 3, "Invalid shape {}".format(env.observation_space.shape)
+        assert env.observation_space.dtype == np.uint8, "Invalid dtype {}".format(env.observation_space.dtype)
+
+        h, w, c = env.observation_space.shape
+
+        assert c < h, "Input should be in HWC format."
+
+        self.n_stacks = n_stacks
+        self.original_channels = c
+        self.embed_time = embed_time
+        self.n_channels = self.n_stacks * self.original_channels + (1 if embed_time else 0)
+
+        self._frames = np.zeros((2 * n_stacks, c, h, w), dtype=np.uint8)
+        self._head = 0
+        self._obs = np.zeros((self.n_channels, h, w), dtype=np.uint8) if embed_time else None
+
+        self.observation_space = gym.spaces.Box(
+            low=0,
+            high=255,
+            shape=(self.n_channels, h, w),
+            dtype=np.uint8,
+        )
+
+    def _push_obs(self, obs):
+        self._head = (self._head - 1) % self.n_stacks
+        frame = obs.transpose(2, 0, 1)
+        self._frames[self._head] = frame
+        self._frames[self._head + self.n_stacks] = frame
+
+    def _fill_obs(self, obs):
+        self._head = 0
+        self._frames[:] = obs.transpose(2, 0, 1)[None]
+
+    def get_stack(self):
+        """
+        Returns view of the stacked frames of dims [n_stacks * c, h, w], newest first.
+        """
+        h, w = self._frames.shape[2:]
+        return self._frames[self._head:self._head + self.n_stacks].reshape(-1, h, w)
+
+    def get_obs(self, time: float = 0):
+        """
+        Returns current observation.
+        """
+        if not self.embed_time:
+            return self.get_stack()
+        self._obs[:-1] = self.get_stack()
+        self._obs[-1] = time * 255
+        return self._obs
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        self._push_obs(obs)
+        if "channels" in info:
+            info["channels"] = info["channels"] * self.n_stacks
+        if self.embed_time:
+            assert 'time_frac' in info, "must include timelimit wrapper before RingFrameStack"
+            if "channels" in info:
+                info["channels"] += ["Gray"]
+            return self.get_obs(info['time_frac']), reward, done, info
+        return self.get_obs(), reward, done, info
+
+    def reset(self):
+        obs = self.env.reset()
+        self._fill_obs(obs)
+        return self.get_obs()
+
+    def save_state(self, buffer):
+        buffer["stack"] = self._frames[self._head:self._head + self.n_stacks].copy()
+
+    def restore_state(self, buffer):
+        stack = buffer["stack"]
+        if isinstance(stack, collections.deque):
+            # FrameStack state, which is a deque of h,w,c frames, newest first.
+            stack = np.stack([frame.transpose(2, 0, 1) for frame in stack])
+        expected_shape = (self.n_stacks, *self._frames.shape[1:])
+        assert stack.shape == expected_shape, f"Saved frame stack has shape {stack.shape}, expected {expected_shape}."
+        self._head = 0
+        self._frames[:self.n_stacks] = stack
+        self._frames[self.n_stacks:] = stack
+
+
 class MontezumaInfoWrapper(gym.Wrapper):
     """
     From https://github.com/openai/random-network-distillation/blob/master/atari_wrappers.py
@@ -233,29 +233,17 @@ def discount_rewards(rewards, gamma):
         reward_sum += reward * (gamma**k)
     return reward_sum
 
-def rediscount_TVF(values, new_gamma):
+def rediscount_TVF(values, new_gamma, horizons, device=None):
     """
     Uses truncated value function to estimate value for given states.
     Rewards will be undiscounted, then rediscounted to the correct gamma.
+    Uses the same rediscount matrix as training.
 
-    values: np array of shape [H]
-    returns: rediscounted value estimates of shale [H]
+    values: np array or tensor of shape [*, K]
+    horizons: horizon for each value estimate, of shape [K]
+    returns: rediscounted value estimates of shape [*, K]
     """
-    H = len(values)
-    rediscounted_values = np.zeros_like(values)
-    prev = 0
-    discounted_reward_sum = 0
-    old_discount = 1
-    discount = 1
-
-    for h in range(H):
-        reward = (values[h] - prev) / old_discount
-        prev = values[h]
-        discounted_reward_sum += reward * discount
-        old_discount *= args.tvf.gamma
-        discount *= new_gamma
-        rediscounted_values[h] = discounted_reward_sum
-    return rediscounted_values
+    return rl.tvf.rediscount_value_curves(values, args.tvf.gamma, new_gamma, horizons, device=device)
 
 def rediscount_TVF_minimize_error(value_mu, value_std, new_gamma):
     """
@@ -667,6 +655,12 @@ def generate_rollouts(
             else:
                 pass
 
+        # rediscount the value curves for all agents at once, on the model's device.
+        if horizons is not None and args.tvf.enabled and needs_rediscount() and "tvf_value" in model_out:
+            rediscounted_values = rediscount_TVF(
+                model_out["tvf_value"][..., 0], args.gamma, model.tvf_fixed_head_horizons
+            ).detach().cpu().numpy()
+
         # go though each agent...
         for i in range(len(states)):
 
@@ -716,10 +710,10 @@ def generate_rollouts(
                 else:
                     raise ValueError(f"Invalid venv type {type(venvs)}")
 
-                buffer = {}
-                for j in range(multi_envs.n_sequential):
-                    buffer[f"vec_{j:03d}"] = root_env_state
                 for j in range(multi_envs.n_parallel):
+                    buffer = {}
+                    for k in range(multi_envs.worker_sizes[j]):
+                        buffer[f"vec_{k:03d}"] = root_env_state
                     pipe = multi_envs.parent_pipes[j]
                     pipe.send(('load', buffer))
                     error, ok = pipe.recv()
@@ -805,7 +799,7 @@ def generate_rollouts(
                 values = model_out["tvf_value"][i, :, 0].detach().cpu().numpy()
                 if needs_rediscount():
                     append_buffer('tvf_discounted_values', values)
-                    values = rediscount_TVF(values, args.gamma)
+                    values = rediscounted_values[i]
 
                 append_buffer('values', values)
                 if "tvf_raw_value" in model_out:
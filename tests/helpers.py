@@ -0,0 +1,42 @@
+"""
+Helpers shared between tests.
+"""
+
+import argparse
+import copy
+import sys
+from unittest import mock
+
+
+def save_config(config) -> list:
+    """
+    Returns a copy of the values of config and all its child configs, for restore_config.
+    Parameters are stored as class variables (see BaseConfig.update), so these are saved as well.
+    """
+    from rl.config import BaseConfig
+    class_vars = {k: v for k, v in vars(type(config)).items() if k in vars(type(config)).get('__annotations__', {})}
+    saved = [(config, dict(vars(config)), class_vars)]
+    for value in vars(config).values():
+        if isinstance(value, BaseConfig):
+            saved.extend(save_config(value))
+    return saved
+
+
+def restore_config(saved: list):
+    for config, values, class_vars in saved:
+        vars(config).clear()
+        # setup adds arguments to the parser, so it needs to be copied each time.
+        vars(config).update({k: copy.deepcopy(v) if isinstance(v, argparse.ArgumentParser) else v for k, v in values.items()})
+        for k, v in class_vars.items():
+            setattr(type(config), k, v)
+
+
+def setup_args(*params):
+    """
+    Sets up the global args from the given command line parameters, and returns them.
+    args should be restored with restore_config afterwards.
+    """
+    from rl.config import args
+    with mock.patch.object(sys, 'argv', ["test", *params]):
+        args.setup()
+    return args
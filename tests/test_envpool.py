@@ -0,0 +1,181 @@
+import unittest
+import importlib.util
+
+import numpy as np
+
+from helpers import save_config, restore_config, setup_args
+
+HAS_ENVPOOL = importlib.util.find_spec("envpool") is not None and importlib.util.find_spec("ale_py") is not None
+
+
+@unittest.skipUnless(HAS_ENVPOOL, "envpool and ale_py are required.")
+class TestEnvPool(unittest.TestCase):
+
+    def setUp(self):
+        from rl.config import args
+        # args is global, so restore it once we are done.
+        self.saved_args = save_config(args)
+
+    def tearDown(self):
+        restore_config(self.saved_args)
+
+    def setup_env_args(self, *params):
+        """
+        Sets up the global args with the given command line parameters, and returns them.
+        """
+        restore_config(self.saved_args)
+        # noop starts and sticky actions are random, and do not share random number generators between backends.
+        args = setup_args(
+            "--env_noop_duration=0", "--env_repeat_action_probability=0", "--seed=1", "--sync_envs=True", *params
+        )
+        args.env.max_repeated_actions = 0
+        args.env.reward_normalization = "off"
+        return args
+
+    def create_envs(self, N: int):
+        """
+        Returns classic and envpool vector envs for the current args.
+        """
+        from rl import envs
+        from rl.config import args
+        args.env.backend = "classic"
+        classic = envs.create_envs(N)
+        args.env.backend = "envpool"
+        try:
+            pool = envs.create_envs(N)
+        except Exception:
+            classic.close()
+            raise
+        return classic, pool
+
+    def check_parity(self, steps: int = 500, N: int = 4, info_keys=("time", "raw_reward", "ep_score", "ep_length")):
+        """
+        Checks that envpool produces the same observations and infos as the classic backend, using random actions.
+        Returns the info arrays for each step.
+        """
+        from rl import hybridVecEnv
+
+        classic, pool = self.create_envs(N)
+        history = []
+        try:
+            obs_classic = classic.reset()
+            obs_pool = pool.reset()
+            self.assertEqual(obs_classic.shape, obs_pool.shape)
+            self.assertEqual(obs_classic.dtype, obs_pool.dtype)
+            self.assertLessEqual(np.abs(obs_classic.astype(np.int32) - obs_pool.astype(np.int32)).max(), 1)
+
+            rng = np.random.RandomState(0)
+            for t in range(steps):
+                actions = rng.randint(0, pool.single_action_space.n, size=[N])
+                obs_classic, rewards_classic, dones_classic, infos_classic = classic.step(actions)
+                obs_pool, rewards_pool, dones_pool, infos_pool = pool.step(actions)
+
+                info_classic = hybridVecEnv.get_info_arrays(classic, rewards_classic, dones_classic, infos_classic)
+                info_pool = hybridVecEnv.get_info_arrays(pool, rewards_pool, dones_pool, infos_pool)
+                history.append(info_pool.copy())
+
+                np.testing.assert_array_equal(dones_classic, dones_pool, err_msg=f"dones at step {t}")
+                np.testing.assert_allclose(rewards_classic, rewards_pool, err_msg=f"rewards at step {t}")
+                for key in info_keys:
+                    np.testing.assert_allclose(info_classic[key], info_pool[key], err_msg=f"{key} at step {t}")
+                # both backends max pool the last two frames, then resize (INTER_AREA) and color transform, so
+                # frames should match, up to rounding differences between OpenCV builds. Frames on episode ends
+                # are skipped, as the classic backend blanks them before they are replaced by the reset frame.
+                if np.any(dones_classic):
+                    continue
+                delta = np.abs(obs_classic.astype(np.int32) - obs_pool.astype(np.int32))
+                self.assertLessEqual(delta.max(), 1, f"observations differ at step {t}")
+        finally:
+            classic.close()
+            pool.close()
+        return history
+
+    def test_parity(self):
+        """
+        Checks that envpool produces the same observations and infos as the classic backend.
+        """
+        self.setup_env_args("--env_name=Pong")
+        self.check_parity()
+
+    def test_color_modes(self):
+        for color_mode in ["rgb", "yuv", "hsv"]:
+            with self.subTest(color_mode=color_mode):
+                self.setup_env_args("--env_name=Pong", f"--env_color_mode={color_mode}")
+                self.check_parity(steps=200)
+
+    def test_embed_action(self):
+        self.setup_env_args("--env_name=Pong", "--env_embed_action=True")
+        self.check_parity(steps=200)
+
+    def test_terminal_on_loss_of_life(self):
+        """
+        Checks loss of life parity, including games that end during the noop step that follows a loss of life.
+        """
+        self.setup_env_args("--env_name=Breakout", "--env_atari_terminal_on_loss_of_life=True")
+        history = self.check_parity(steps=2000, info_keys=("time", "raw_reward", "ep_score", "ep_length", "lives", "fake_done"))
+        fake_dones = np.asarray([info['fake_done'] for info in history])
+        dones = np.asarray([info['done'] for info in history])
+        self.assertTrue(np.any(fake_dones), "no lives were lost.")
+        self.assertTrue(np.any(dones & ~fake_dones), "no games were completed.")
+
+    @unittest.skipUnless(importlib.util.find_spec("procgen") is not None, "procgen is required.")
+    def test_procgen(self):
+        """
+        Checks that procgen observations are laid out as for the classic backend, and that time keeping matches.
+        Levels are generated from each backend's own seeds, so frames are not compared.
+        """
+        from rl import hybridVecEnv
+        args = self.setup_env_args(
+            "--env_type=procgen", "--env_name=starpilot", "--env_embed_time=True", "--env_embed_action=True",
+        )
+        N = 4
+        classic, pool = self.create_envs(N)
+        try:
+            obs_classic = classic.reset()
+            obs_pool = pool.reset()
+            self.assertEqual(obs_classic.shape, obs_pool.shape)
+            self.assertEqual(obs_classic.dtype, obs_pool.dtype)
+            self.assertEqual(classic.single_action_space, pool.single_action_space)
+            np.testing.assert_array_equal(obs_pool[:, -1], 0)
+
+            rng = np.random.RandomState(0)
+            time = np.zeros([N], dtype=np.int64)
+            for t in range(500):
+                actions = rng.randint(0, pool.single_action_space.n, size=[N])
+                obs_pool, rewards_pool, dones_pool, infos_pool = pool.step(actions)
+                info = hybridVecEnv.get_info_arrays(pool, rewards_pool, dones_pool, infos_pool)
+                time = np.where(dones_pool, 0, time + 1)
+                np.testing.assert_array_equal(info['time'], time, err_msg=f"time at step {t}")
+                expected_time_channel = (np.where(dones_pool, 0, time / args.env.timeout) * 255).astype(np.uint8)
+                # actions are marked in the top left corner, so check the bottom right.
+                np.testing.assert_array_equal(obs_pool[:, -1, -1, -1], expected_time_channel, err_msg=f"step {t}")
+        finally:
+            classic.close()
+            pool.close()
+
+    def test_checkpoint_state(self):
+        """
+        Checks that envpool's (unsaveable) emulator state is left out of the saved environment state, so that
+        restoring it does not fail.
+        """
+        from rl import envs, utils
+        args = self.setup_env_args("--env_name=Pong")
+        # reward normalization is a vector wrapper with state of its own, which should still be saved.
+        args.env.reward_normalization = "rms"
+        args.env.backend = "envpool"
+        pool = envs.create_envs(4)
+        try:
+            pool.reset()
+            for _ in range(10):
+                pool.step(np.zeros([4], dtype=np.int64))
+            state = utils.save_env_state(pool)
+            self.assertNotIn("EnvPoolVecEnv", state)
+            self.assertIn("VecNormalizeRewardWrapper", state)
+            utils.restore_env_state(pool, state)
+            pool.reset()
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import unittest
+import multiprocessing
+import time
+import functools
+from unittest import mock
+
+import gym
+import numpy as np
+
+from rl import hybridVecEnv
+
+
+class SlowEnv(gym.Wrapper):
+    """
+    CartPole where action 1 takes a while to step.
+    """
+
+    def step(self, action):
+        if action == 1:
+            time.sleep(0.2)
+        return self.env.step(action)
+
+
+def make_env():
+    return SlowEnv(gym.make("CartPole-v1"))
+
+
+def make_cartpole():
+    return gym.make("CartPole-v1")
+
+
+class InfoEnv(gym.Env):
+    """
+    Environment that returns the typed info fields, the keys dropped by compact infos, and some rare keys.
+    """
+
+    def __init__(self, seed: int):
+        self.rng = np.random.RandomState(seed)
+        self.observation_space = gym.spaces.Box(-1, 1, (3,), dtype=np.float32)
+        self.action_space = gym.spaces.Discrete(2)
+        self.t = 0
+        self.score = 0
+
+    def _obs(self):
+        return self.rng.uniform(-1, 1, size=[3]).astype(np.float32)
+
+    def reset(self):
+        self.t = 0
+        self.score = 0
+        return self._obs()
+
+    def step(self, action):
+        self.t += 1
+        reward = float(self.rng.randint(-1, 3))
+        self.score += reward
+        done = self.rng.rand() < 0.1
+        info = {'time': self.t, 'raw_reward': reward * 2, 'time_frac': self.t / 100, 'channels': ['Gray']}
+        if self.rng.rand() < 0.5:
+            info['room_count'] = self.rng.randint(1, 5)
+            info['ale.lives'] = self.rng.randint(0, 3)
+        if self.rng.rand() < 0.1:
+            info['fake_done'] = True
+        if done:
+            info.update(ep_score=self.score, ep_length=self.t, episode={'visited_rooms': {1, 2}})
+        if self.rng.rand() < 0.05:
+            info['rare'] = action
+        return self._obs(), reward, done, info
+
+
+class TestHybridVecEnv(unittest.TestCase):
+
+    def test_compact_infos(self):
+        """
+        Checks that compact infos give the same info fields and rare keys as sending the full info dictionaries.
+        """
+        N = 5
+        dropped_keys = hybridVecEnv._INFO_FIELD_KEYS | hybridVecEnv.INFO_DROP_KEYS
+        for shared_actions in [False, True]:
+            vec_envs = [
+                hybridVecEnv.HybridAsyncVectorEnv(
+                    [functools.partial(InfoEnv, i) for i in range(N)], max_cpus=2, compact_infos=compact_infos,
+                    shared_actions=shared_actions,
+                ) for compact_infos in [False, True]
+            ]
+            try:
+                full_env, compact_env = vec_envs
+                np.testing.assert_array_equal(full_env.reset(), compact_env.reset())
+                rng = np.random.RandomState(0)
+                rare_keys = set()
+                for t in range(100):
+                    actions = rng.randint(0, 2, size=[N])
+                    obs, rewards, dones, infos = full_env.step(actions)
+                    compact_obs, compact_rewards, compact_dones, compact_infos = compact_env.step(actions)
+                    np.testing.assert_array_equal(obs, compact_obs)
+                    np.testing.assert_array_equal(rewards, compact_rewards)
+                    np.testing.assert_array_equal(dones, compact_dones)
+                    expected_arrays = hybridVecEnv.info_arrays_from_infos(rewards, dones, infos)
+                    for field in hybridVecEnv.INFO_DTYPE.names:
+                        np.testing.assert_array_equal(full_env.info_arrays[field], expected_arrays[field], err_msg=field)
+                        np.testing.assert_array_equal(compact_env.info_arrays[field], expected_arrays[field], err_msg=field)
+                    self.assertEqual(
+                        compact_infos, [{k: v for k, v in info.items() if k not in dropped_keys} for info in infos]
+                    )
+                    for info in compact_infos:
+                        rare_keys.update(info.keys())
+                self.assertEqual(rare_keys, {'episode', 'rare'})
+            finally:
+                for vec_env in vec_envs:
+                    vec_env.close()
+
+    def test_split_envs(self):
+        self.assertEqual(hybridVecEnv.split_envs(8, 4), [2, 2, 2, 2])
+        # extra environments go to the first workers
+        self.assertEqual(hybridVecEnv.split_envs(7, 3), [3, 2, 2])
+        self.assertEqual(hybridVecEnv.split_envs(11, 4), [3, 3, 3, 2])
+        self.assertEqual(hybridVecEnv.split_envs(5, 5), [1] * 5)
+        with self.assertRaises(AssertionError):
+            hybridVecEnv.split_envs(2, 3)
+
+    def test_select_topology(self):
+        """
+        Checks that only the selected vector env allocates the requested observation slots.
+        """
+        with mock.patch.object(hybridVecEnv, "benchmark_topology", wraps=hybridVecEnv.benchmark_topology) as benchmark:
+            vec_env = hybridVecEnv.select_topology([make_cartpole] * 5, max_cpus=2, steps=2, obs_slots=3)
+        try:
+            self.assertEqual(benchmark.call_count, 6)
+            for call in benchmark.call_args_list:
+                self.assertNotIn('obs_slots', call.kwargs)
+            self.assertIn(vec_env.topology['workers'], [1, 2, 4])
+            self.assertEqual(sum(vec_env.worker_sizes), 5)
+            self.assertEqual(vec_env.obs_buffer.shape, (3, 5, 4))
+        finally:
+            vec_env.close()
+
+    def test_split_groups(self):
+        self.assertEqual(hybridVecEnv.split_groups([0, 2, 4, 6, 8], 2), [0, 4, 8])
+        self.assertEqual(hybridVecEnv.split_groups([0, 2, 4, 6, 8], 4), [0, 2, 4, 6, 8])
+        # uneven workers
+        self.assertEqual(hybridVecEnv.split_groups([0, 3, 5, 7], 2), [0, 3, 7])
+        # more groups than workers
+        self.assertEqual(hybridVecEnv.split_groups([0, 64, 128], 8), [0, 64, 128])
+        self.assertEqual(hybridVecEnv.split_groups([0, 10], 1), [0, 10])
+
+    def test_interrupted_step(self):
+        """
+        Checks that the results of a step that timed out are not returned by the steps that follow it.
+        """
+        for shared_actions in [False, True]:
+            vec_env = hybridVecEnv.HybridAsyncVectorEnv(
+                [make_env] * 4, max_cpus=2, compact_infos=True, shared_actions=shared_actions
+            )
+            try:
+                self.assertEqual(vec_env.single_action_space, gym.spaces.Discrete(2))
+                self.assertEqual(vec_env.reset().shape, (4, 4))
+                for _ in range(2):
+                    with self.assertRaises(multiprocessing.TimeoutError):
+                        vec_env.step_partial(np.ones([4], dtype=np.int64), 0, 4)
+                        vec_env.step_wait(timeout=0.01)
+                    vec_env.reset()
+                    vec_env.step(np.zeros([4], dtype=np.int64))
+
+                # the same applies to async steps.
+                vec_env.send(np.ones([4], dtype=np.int64))
+                with self.assertRaises(multiprocessing.TimeoutError):
+                    vec_env.recv(min_envs=4, timeout=0.01)
+                vec_env.reset()
+                vec_env.send(np.zeros([4], dtype=np.int64))
+                self.assertEqual(list(vec_env.recv(min_envs=4)[-1]), [0, 1, 2, 3])
+
+                # close should not be held up by a partial step.
+                vec_env.step_partial(np.zeros([2], dtype=np.int64), 0, 2)
+            finally:
+                vec_env.close()
+            if shared_actions:
+                self.assertEqual([x.get_value() for x in vec_env._step_ready + vec_env._step_done], [0] * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
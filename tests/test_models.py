@@ -0,0 +1,93 @@
+import unittest
+
+import numpy as np
+import torch
+
+from rl import models
+
+
+class TestModels(unittest.TestCase):
+
+    def test_fused_forward(self):
+        """
+        Checks that evaluating the policy and value encoders in one pass matches evaluating them separately.
+        """
+        for encoder, input_dims in [("nature", (4, 84, 84)), ("mlp", (17,))]:
+            torch.manual_seed(0)
+            model = models.TVFModel(
+                encoder=encoder,
+                encoder_args=None,
+                input_dims=input_dims,
+                actions=6,
+                device="cpu",
+                architecture="dual",
+                hidden_units=64,
+                observation_normalization=True,
+                tvf_fixed_head_horizons=np.asarray([0, 10, 100]),
+                fused_forward=True,
+            )
+            self.assertTrue(model.fused_forward)
+            x = torch.randint(0, 255, size=[8, *input_dims], dtype=torch.uint8)
+            if encoder == "mlp":
+                x = x.float()
+            optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+
+            for _ in range(2):
+                for output in ["default", "full"]:
+                    with torch.no_grad():
+                        fused = model(x, output=output)
+                        model.fused_forward = False
+                        separate = model(x, output=output)
+                        model.fused_forward = True
+                    self.assertEqual(fused.keys(), separate.keys())
+                    for k in fused.keys():
+                        np.testing.assert_allclose(fused[k], separate[k], rtol=1e-4, atol=1e-5, err_msg=f"{encoder}:{k}")
+
+                # stacked weights should be refreshed after an update
+                optimizer.zero_grad()
+                model(x)["value"].sum().backward()
+                optimizer.step()
+
+    def test_autocast(self):
+        """
+        Checks that running the encoders in bfloat16 keeps outputs in float32, and close to the float32 model.
+        """
+        def make_model(amp):
+            torch.manual_seed(0)
+            return models.TVFModel(
+                encoder="nature",
+                encoder_args=None,
+                input_dims=(4, 84, 84),
+                actions=6,
+                device="cpu",
+                architecture="dual",
+                hidden_units=64,
+                observation_normalization=True,
+                tvf_fixed_head_horizons=np.asarray([0, 10, 100]),
+                head_scale=1.0,
+                amp=amp,
+            )
+
+        model = make_model("off")
+        amp_model = make_model("bf16")
+        x = torch.randint(0, 255, size=[32, 4, 84, 84], dtype=torch.uint8)
+
+        with torch.no_grad():
+            for fused_forward in [False, True]:
+                model.fused_forward = amp_model.fused_forward = fused_forward
+                expected = model(x, output="full")
+                result = amp_model(x, output="full", include_features=True)
+                for k in expected.keys():
+                    self.assertEqual(result[k].dtype, torch.float32, k)
+                    scale = expected[k].abs().max().item()
+                    np.testing.assert_allclose(result[k], expected[k], atol=0.05 * scale, err_msg=k)
+
+        # gradients should also be float32
+        amp_model(x)["tvf_value"].sum().backward()
+        for name, p in amp_model.named_parameters():
+            if p.grad is not None:
+                self.assertEqual(p.grad.dtype, torch.float32, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import unittest
+import importlib.util
+import functools
+import copy
+
+import numpy as np
+import gym
+
+from helpers import save_config, restore_config, setup_args
+
+HAS_ALE = importlib.util.find_spec("ale_py") is not None
+
+
+class RandomFrames(gym.Env):
+    """
+    Environment with random 210x160 RGB frames, and random episode lengths.
+    Lives are lost at random (see EpisodicLifeEnv), which uses the env itself as the ale interface.
+    """
+
+    def __init__(self, seed: int):
+        self.rng = np.random.RandomState(seed)
+        self.observation_space = gym.spaces.Box(0, 255, (210, 160, 3), dtype=np.uint8)
+        self.action_space = gym.spaces.Discrete(6)
+        self.t = 0
+        self.ale = self
+        self._lives = 3
+
+    def lives(self):
+        return self._lives
+
+    def _frame(self):
+        frame = self.rng.randint(0, 256, size=(210, 160, 3)).astype(np.uint8)
+        frame[50:120, 40:100] = self.rng.randint(0, 256, size=3)
+        return frame
+
+    def reset(self):
+        self.t = 0
+        self._lives = 3
+        return self._frame()
+
+    def step(self, action):
+        self.t += 1
+        if self.rng.rand() < 0.05:
+            self._lives -= 1
+        return self._frame(), 1.0, self._lives == 0 or self.rng.rand() < 0.02, {}
+
+
+def make_classic(i, width=84, height=84, color_mode="bw", n_stacks=4, embed_action=True, embed_time=True,
+                 zero_obs=False, loss_of_life=False):
+    """
+    Per environment frame processing, in the same order as atari.make.
+    """
+    from rl import wrappers
+    env = wrappers.TimeLimitWrapper(RandomFrames(i), 50)
+    env = wrappers.AtariWrapper(env, width=width, height=height)
+    if zero_obs:
+        env = wrappers.ZeroObsWrapper(env)
+    env = wrappers.ColorTransformWrapper(env, color_mode)
+    if loss_of_life:
+        env = wrappers.EpisodicLifeEnv(env)
+    if embed_action:
+        env = wrappers.ActionAwareWrapper(env)
+    env = wrappers.FrameStack(env, n_stacks=n_stacks)
+    if embed_time:
+        env = wrappers.TimeChannelWrapper(env)
+    env = wrappers.ChannelsFirstWrapper(env)
+    return wrappers.NullActionWrapper(env)
+
+
+def make_raw(i, loss_of_life=False):
+    """
+    Environment returning raw frames, for VecAtariPreprocessing (as atari.make with vector_preprocessing).
+    """
+    from rl import wrappers
+    env = wrappers.TimeLimitWrapper(RandomFrames(i), 50)
+    if loss_of_life:
+        env = wrappers.EpisodicLifeEnv(env)
+    return wrappers.NullActionWrapper(env)
+
+
+class TestPreprocessing(unittest.TestCase):
+
+    def check_parity(self, classic, vector, N, steps=100, label=""):
+        """
+        Steps both vector envs with the same random (including null) actions, and checks observations match.
+        """
+        np.testing.assert_array_equal(classic.reset(), vector.reset(), err_msg=label)
+        rng = np.random.RandomState(0)
+        for t in range(steps):
+            actions = rng.randint(-1, classic.single_action_space.n, size=[N]).astype(np.int32)
+            obs_classic, rewards_classic, dones_classic, _ = classic.step(actions)
+            obs_vector, rewards_vector, dones_vector, _ = vector.step(actions)
+            np.testing.assert_array_equal(dones_classic, dones_vector, err_msg=label)
+            np.testing.assert_array_equal(obs_classic, obs_vector, err_msg=f"{label} at step {t}")
+
+    def test_ring_frame_stack(self):
+        """
+        Checks that RingFrameStack matches FrameStack, TimeChannelWrapper and ChannelsFirstWrapper, including after
+        restoring a saved state, or a FrameStack state from an older checkpoint.
+        """
+        from rl import wrappers, utils
+
+        for n_stacks, embed_time in [(4, True), (3, False), (1, True)]:
+
+            def make(stack_fn):
+                env = wrappers.TimeLimitWrapper(RandomFrames(0), 50)
+                env = wrappers.AtariWrapper(env, width=84, height=84)
+                env = wrappers.ColorTransformWrapper(env, "bw")
+                return stack_fn(env)
+
+            def classic_stack(env):
+                env = wrappers.FrameStack(env, n_stacks=n_stacks)
+                if embed_time:
+                    env = wrappers.TimeChannelWrapper(env)
+                return wrappers.ChannelsFirstWrapper(env)
+
+            classic = make(classic_stack)
+            ring = make(lambda env: wrappers.RingFrameStack(env, n_stacks=n_stacks, embed_time=embed_time))
+            self.assertEqual(classic.observation_space, ring.observation_space)
+
+            np.testing.assert_array_equal(classic.reset(), ring.reset())
+            saved, saved_obs = None, None
+            for t in range(100):
+                obs_classic, _, done_classic, _ = classic.step(0)
+                obs_ring, _, done_ring, _ = ring.step(0)
+                self.assertEqual(done_classic, done_ring)
+                np.testing.assert_array_equal(obs_classic, obs_ring, err_msg=f"step {t}")
+                if done_classic:
+                    np.testing.assert_array_equal(classic.reset(), ring.reset())
+                if t == 50:
+                    saved = {}
+                    ring.save_state(saved)
+                    saved_obs = obs_ring.copy()
+                    # FrameStack saves its (live) deque, so copy it.
+                    legacy_saved = copy.deepcopy(utils.save_env_state(classic))
+
+            ring.restore_state(saved)
+            np.testing.assert_array_equal(ring.get_stack(), saved_obs[:n_stacks])
+
+            ring.reset()
+            self.assertIn("FrameStack", legacy_saved)
+            utils.restore_env_state(ring, legacy_saved)
+            np.testing.assert_array_equal(ring.get_stack(), saved_obs[:n_stacks])
+
+    def test_parity(self):
+        """
+        Checks that VecAtariPreprocessing matches the per environment wrappers exactly.
+        """
+        from rl import wrappers
+
+        N = 4
+
+        for kwargs in [
+            dict(color_mode="bw", width=84, height=84, n_stacks=4),
+            dict(color_mode="yuv", width=105, height=105, n_stacks=2),
+            dict(color_mode="rgb", width=96, height=96, n_stacks=1),
+            dict(color_mode="hsv", width=84, height=84, n_stacks=2),
+            dict(color_mode="bw", width=84, height=84, n_stacks=4, embed_action=False, embed_time=False),
+            dict(color_mode="rgb", width=84, height=84, n_stacks=2, zero_obs=True),
+            dict(color_mode="bw", width=84, height=84, n_stacks=4, loss_of_life=True),
+        ]:
+            kwargs = {'embed_action': True, 'embed_time': True, **kwargs}
+            loss_of_life = kwargs.pop('loss_of_life', False)
+            classic = gym.vector.SyncVectorEnv([
+                lambda i=i: make_classic(i, loss_of_life=loss_of_life, **kwargs) for i in range(N)
+            ])
+            vector = wrappers.VecAtariPreprocessing(
+                gym.vector.SyncVectorEnv([lambda i=i: make_raw(i, loss_of_life=loss_of_life) for i in range(N)]),
+                **kwargs,
+            )
+            self.check_parity(classic, vector, N, label=f"{kwargs} loss_of_life={loss_of_life}")
+
+    def test_hybrid_vec_env(self):
+        """
+        Checks that VecAtariPreprocessing applied to each worker's environments (as done by envs.create_envs with
+        vector_preprocessing) matches the per environment wrappers, including with uneven workers.
+        """
+        from rl import wrappers, hybridVecEnv
+
+        N = 5
+        classic = gym.vector.SyncVectorEnv([functools.partial(make_classic, i) for i in range(N)])
+        vector = hybridVecEnv.HybridAsyncVectorEnv(
+            [functools.partial(make_raw, i) for i in range(N)],
+            max_cpus=2,
+            copy=False,
+            compact_infos=True,
+            vec_wrapper=functools.partial(wrappers.VecAtariPreprocessing, embed_action=True, embed_time=True),
+        )
+        try:
+            self.check_parity(classic, vector, N)
+        finally:
+            vector.close()
+
+    @unittest.skipUnless(HAS_ALE, "ale_py is required.")
+    def test_atari_make(self):
+        """
+        Checks that atari.make with vector_preprocessing, processed by make_vec_preprocessing in HybridAsyncVectorEnv
+        workers, matches atari.make with the per environment wrappers.
+        """
+        from rl import atari, hybridVecEnv
+        from rl.config import args
+
+        saved_args = save_config(args)
+        try:
+            setup_args(
+                "--env_type=atari", "--env_name=Breakout", "--env_noop_duration=0",
+                "--env_repeat_action_probability=0", "--env_atari_terminal_on_loss_of_life=True",
+            )
+            N = 4
+
+            def make_envs(vector_preprocessing: bool):
+                return hybridVecEnv.HybridAsyncVectorEnv(
+                    [functools.partial(atari.make, args.env.name, seed=i, args=args,
+                                       vector_preprocessing=vector_preprocessing) for i in range(N)],
+                    max_cpus=2,
+                    copy=False,
+                    compact_infos=True,
+                    vec_wrapper=atari.make_vec_preprocessing(args) if vector_preprocessing else None,
+                )
+
+            classic, vector = make_envs(False), make_envs(True)
+            try:
+                self.check_parity(classic, vector, N, steps=500)
+            finally:
+                classic.close()
+                vector.close()
+        finally:
+            restore_config(saved_args)
+
+
+if __name__ == '__main__':
+    unittest.main()
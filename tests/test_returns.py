@@ -0,0 +1,109 @@
+import unittest
+
+import numpy as np
+import torch
+
+from rl import returns
+from rl.returns_truncated import TorchReturnContext
+
+
+def reference_gae(rewards, values, final_value, terminals, gamma, lamb):
+    N, A = rewards.shape
+    advantages = np.zeros([N, A], dtype=np.float32)
+    prev_adv = np.zeros([A], dtype=np.float32)
+    for t in reversed(range(N)):
+        value_next_t = values[t + 1] if t != N - 1 else final_value
+        delta = rewards[t] + gamma * value_next_t * (1.0 - terminals[t]) - values[t]
+        advantages[t] = prev_adv = delta + gamma * lamb * (1.0 - terminals[t]) * prev_adv
+    return advantages
+
+
+class TestReturns(unittest.TestCase):
+
+    def test_gae_multi(self):
+        """
+        Checks that the batched GAE matches per head GAE for each backend.
+        """
+        N, A = 64, 8
+        rewards = np.random.normal(size=[N, A, 3]).astype(np.float32)
+        values = np.random.normal(size=[N + 1, A, 3]).astype(np.float32)
+        terminals = np.random.random(size=[N, A, 3]) < 0.05
+        gammas = [0.99, 0.99, 0.9]
+        lambdas = [0.95, 0.97, 0.5]
+
+        ref = np.stack([
+            reference_gae(rewards[..., h], values[:N, :, h], values[N, :, h], terminals[..., h], gammas[h], lambdas[h])
+            for h in range(3)
+        ], axis=-1)
+
+        backends = ["numpy", "torch"]
+        try:
+            import numba
+            backends.append("numba")
+        except ImportError:
+            pass
+
+        for backend in backends:
+            m = returns.gae_multi(rewards, values[:N], values[N], terminals, gammas, lambdas, backend=backend)
+            self.assertEqual(m.shape, (N, A, 3))
+            np.testing.assert_allclose(m, ref, rtol=1e-4, atol=1e-4, err_msg=backend)
+
+        # tensors stay as tensors
+        m = returns.gae_multi(*[torch.from_numpy(x) for x in (rewards, values[:N], values[N], terminals)],
+                              gammas, lambdas, backend="torch")
+        self.assertTrue(torch.is_tensor(m))
+        np.testing.assert_allclose(m.numpy(), ref, rtol=1e-4, atol=1e-4)
+
+        # single head version
+        np.testing.assert_allclose(
+            returns.gae(rewards[..., 0], values[:N, :, 0], values[N, :, 0], terminals[..., 0], gammas[0], lambdas[0]),
+            ref[..., 0], rtol=1e-4, atol=1e-4,
+        )
+
+    def test_return_context(self):
+        """
+        Checks n_step reward sums and discounts from the return context against a direct calculation.
+        """
+        N, A, gamma = 32, 4, 0.9
+        rewards = np.random.normal(size=[N, A]).astype(np.float32)
+        dones = np.random.random(size=[N, A]) < 0.1
+        final_value = np.random.normal(size=[A]).astype(np.float32)
+        context = returns.ReturnContext(rewards, dones, gamma)
+
+        for n in [1, 2, 7, N - 1, N, N + 5]:
+            reward_sum = np.zeros([N, A], dtype=np.float32)
+            discount = np.ones([N, A], dtype=np.float32)
+            for t in range(N):
+                for i in range(t, min(t + n, N)):
+                    reward_sum[t] += discount[t] * rewards[i]
+                    discount[t] *= gamma * (1 - dones[i])
+            np.testing.assert_allclose(context.reward_sum(n), reward_sum, rtol=1e-5, atol=1e-5, err_msg=str(n))
+            np.testing.assert_allclose(context.discount(n), discount, rtol=1e-5, atol=1e-5, err_msg=str(n))
+
+        np.testing.assert_allclose(
+            returns.calculate_bootstrapped_returns(rewards, dones, final_value, gamma, context=context),
+            returns.calculate_bootstrapped_returns(rewards, dones, final_value, gamma),
+            rtol=1e-5, atol=1e-5,
+        )
+
+    def test_torch_return_context(self):
+        """
+        Checks that the torch return context matches the numpy one, whether calculated on device or uploaded.
+        """
+        N, A, gamma = 32, 4, 0.9
+        rewards = np.random.normal(size=[N, A]).astype(np.float32)
+        dones = np.random.random(size=[N, A]) < 0.1
+        context = returns.ReturnContext(rewards, dones, gamma)
+        torch_contexts = [
+            TorchReturnContext.from_rollout(torch.from_numpy(rewards), torch.from_numpy(dones), gamma, "cpu"),
+            TorchReturnContext.from_context(context, "cpu"),
+        ]
+        for torch_context in torch_contexts:
+            np.testing.assert_array_equal(torch_context.next_terminal.numpy(), context.next_terminal)
+            for n in [1, 2, 7, N - 1, N, N + 5]:
+                np.testing.assert_allclose(torch_context.reward_sum(n).numpy(), context.reward_sum(n), atol=1e-6)
+                np.testing.assert_allclose(torch_context.discount(n).numpy(), context.discount(n), atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
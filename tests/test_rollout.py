@@ -0,0 +1,185 @@
+import unittest
+from unittest import mock
+
+import gym
+import numpy as np
+import torch
+
+from rl import rollout
+from rl.config import args
+
+from helpers import save_config, restore_config, setup_args
+
+
+class FakeAsyncVecEnv:
+    """
+    Async vector env where every environment in flight is ready on the next recv.
+    """
+
+    def __init__(self, n_envs, obs_shape):
+        self.n_envs = n_envs
+        self.obs_shape = obs_shape
+        self.in_flight = []
+
+    def send(self, actions, agents):
+        self.in_flight.extend(agents)
+
+    def recv(self, min_envs):
+        agents = np.asarray(sorted(self.in_flight), dtype=np.int64)
+        self.in_flight = []
+        n = len(agents)
+        return np.zeros([n, *self.obs_shape], dtype=np.uint8), np.zeros([n]), np.zeros([n], dtype=bool), [{}] * n, agents
+
+
+class FloatObs(gym.ObservationWrapper):
+
+    def observation(self, obs):
+        return obs.astype(np.float32)
+
+
+def make_cartpole(seed: int):
+    env = FloatObs(gym.make("CartPole-v1"))
+    env.seed(seed)
+    return env
+
+
+class TestRollout(unittest.TestCase):
+
+    def setUp(self):
+        # args is global, so restore it once we are done.
+        self.saved_args = save_config(args)
+
+    def tearDown(self):
+        restore_config(self.saved_args)
+
+    def make_runner(self, n_envs: int, workers: int, *params):
+        """
+        Returns a runner for CartPole, with a fixed seed, using args given by params.
+        The runner should be closed once done.
+        """
+        from rl import hybridVecEnv, models
+        from rl.logger import Logger
+
+        restore_config(self.saved_args)
+        setup_args(
+            "--env_type=mujoco", f"--agents={n_envs}", "--n_steps=16", "--device=cpu", "--tvf_enabled=False",
+            "--env_reward_normalization=off", "--max_micro_batch_size=3", *params,
+        )
+
+        torch.manual_seed(0)
+        np.random.seed(0)
+        model = models.TVFModel(
+            encoder="mlp",
+            encoder_args=None,
+            input_dims=(4,),
+            actions=2,
+            device="cpu",
+            architecture="dual",
+            hidden_units=32,
+            observation_normalization=True,
+            tvf_fixed_head_horizons=None,
+        )
+        runner = rollout.Runner(model, Logger(), action_dist="discrete")
+        runner.vec_env = hybridVecEnv.HybridAsyncVectorEnv(
+            [lambda i=i: make_cartpole(i) for i in range(n_envs)], max_cpus=workers, copy=False, compact_infos=True,
+            obs_slots=args.n_steps + 1 if args.direct_obs else 1,
+        )
+        return runner
+
+    def generate_rollout(self, n_envs: int, workers: int, rollout_groups: int):
+        """
+        Returns a runner that has generated a rollout on CartPole, from a fixed seed.
+        """
+        runner = self.make_runner(n_envs, workers, f"--rollout_groups={rollout_groups}")
+        try:
+            runner.reset()
+            runner.generate_rollout()
+        finally:
+            runner.close()
+        return runner
+
+    def test_rollout_groups(self):
+        """
+        Checks that pipelined rollouts match non-pipelined ones, including when workers have different numbers of
+        environments, and the groups can not be the same size.
+        """
+        # micro-batches are 3 agents, so only the (7, 3, 2) groups [0, 3), [3, 7) do not split a micro-batch, which
+        # makes the model outputs bit identical.
+        for n_envs, workers, groups, exact in [(6, 3, 2, False), (7, 3, 2, True), (7, 3, 3, False)]:
+            with self.subTest(n_envs=n_envs, workers=workers, groups=groups):
+                expected = self.generate_rollout(n_envs, workers, rollout_groups=1)
+                result = self.generate_rollout(n_envs, workers, rollout_groups=groups)
+                for key in ["all_obs", "actions", "ext_rewards", "terminals"]:
+                    np.testing.assert_array_equal(getattr(result, key), getattr(expected, key), err_msg=key)
+                for key in ["log_policy", "value"]:
+                    if exact:
+                        np.testing.assert_array_equal(getattr(result, key), getattr(expected, key), err_msg=key)
+                    else:
+                        np.testing.assert_allclose(getattr(result, key), getattr(expected, key), atol=1e-6, err_msg=key)
+                np.testing.assert_array_equal(result.model.obs_rms.mean, expected.model.obs_rms.mean)
+
+    def test_fp16_requires_cuda(self):
+        with self.assertRaisesRegex(AssertionError, "fp16 requires a cuda device"):
+            self.make_runner(2, 1, "--amp=fp16")
+
+    def test_direct_obs(self):
+        """
+        Checks that rollouts written directly into the vector env's observation buffer match those that copy
+        observations, over consecutive rollouts (where the final observations move to the first slot).
+        """
+        # async rollouts wait for all agents, otherwise the order environments finish in changes the actions.
+        for params in [[], ["--async_batch_size=6"], ["--rollout_groups=2"]]:
+            with self.subTest(params=params):
+                rollouts = {}
+                for direct_obs in [False, True]:
+                    runner = self.make_runner(6, 2, f"--direct_obs={direct_obs}", *params)
+                    try:
+                        runner.reset()
+                        self.assertEqual(runner.direct_obs, direct_obs)
+                        self.assertEqual(runner.all_obs is runner.vec_env.obs_buffer, direct_obs)
+                        rollouts[direct_obs] = []
+                        for _ in range(3):
+                            runner.generate_rollout()
+                            rollouts[direct_obs].append((runner.all_obs.copy(), runner.actions.copy()))
+                    finally:
+                        runner.close()
+                for i, ((obs, actions), (direct_obs, direct_actions)) in enumerate(zip(rollouts[False], rollouts[True])):
+                    np.testing.assert_array_equal(obs, direct_obs, err_msg=f"rollout {i}")
+                    np.testing.assert_array_equal(actions, direct_actions, err_msg=f"rollout {i}")
+
+    def test_async_forward_device(self):
+        """
+        Checks that async rollouts keep model outputs on the model's device (e.g. cuda), as detached_batch_forward
+        does not move them to the cpu.
+        """
+        A, N = 4, 3
+        # meta tensors stand in for outputs on a non-cpu device.
+        device = torch.device("meta")
+
+        runner = mock.MagicMock()
+        runner.A, runner.N = A, N
+        runner.direct_obs = False
+        runner.obs = np.zeros([A, 2], dtype=np.uint8)
+        runner.time = np.zeros([A], dtype=np.float32)
+        runner.vec_env = FakeAsyncVecEnv(A, (2,))
+        runner.detached_batch_forward.side_effect = lambda obs, **kwargs: {
+            'log_policy': torch.zeros([len(obs), 5], device=device),
+            'value': torch.zeros([len(obs), 1], device=device),
+        }
+        runner.sample_actions.side_effect = lambda model_out: np.zeros([len(model_out['value'])], dtype=np.int64)
+
+        recorded = []
+        runner._record_step.side_effect = lambda steps, agents, prev_obs, prev_time, model_out, *_: recorded.append(model_out)
+
+        with mock.patch.object(args, "rollout_groups", 1), mock.patch.object(args, "async_batch_size", 2), \
+                mock.patch.object(rollout.hybridVecEnv, "get_info_arrays", lambda env, r, d, i: {"time": np.zeros([len(r)])}):
+            rollout.Runner.async_forward_and_step(runner, None, None)
+
+        self.assertEqual(len(recorded), N)
+        for model_out in recorded:
+            for k, v in model_out.items():
+                self.assertEqual(v.device, device, k)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,63 @@ import unittest
 import rl.returns_truncated as returns
 import rl.tvf as tvf
 import numpy as np
+import torch
 import time as clock
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+
+def random_return_args(N=64, A=8, K=33, V=20, gamma=0.997, include_zero_horizon=True):
+    """
+    Returns random rollout data (rewards, dones and value samples) as keyword arguments for the return estimators.
+    """
+    required_horizons = np.geomspace(1, 1024, num=K).astype('int32')
+    if include_zero_horizon:
+        required_horizons[0] = 0
+    return {
+        'gamma': gamma,
+        'rewards': np.random.randint(-1, 3, [N, A]).astype('float32'),
+        'dones': (np.random.randint(0, 101, [N, A]) >= 98),
+        'required_horizons': required_horizons,
+        'value_sample_horizons': np.geomspace(1, 1024, num=V).astype('int32') - 1,
+        'value_samples': np.random.normal(0.1, 0.4, [N + 1, A, V]).astype('float32'),
+    }
+
+
+def trim_horizons_reference(module, value_estimates, time_till_termination, mode):
+    """
+    Per agent version of TVFRunnerModule.trim_horizons, without clipping.
+    """
+    value_estimates = value_estimates.copy()
+    value_estimates[:, 0, :] = 0
+    old_value_estimates = value_estimates.copy()
+    A, K, VH = value_estimates.shape
+    trimmed_ks = np.searchsorted(module.runner.tvf_horizons, time_till_termination)
+    if mode == "interpolate":
+        trimmed_value_estimate = module.interpolators[True](old_value_estimates[..., 0], time_till_termination)
+        for a in range(A):
+            value_estimates[a, trimmed_ks[a]:, 0] = trimmed_value_estimate[a]
+    elif mode == "average":
+        for a, trimmed_k in enumerate(trimmed_ks):
+            if trimmed_k >= K - 1:
+                continue
+            acc = 0
+            for counter, k in enumerate(range(trimmed_k, K), start=1):
+                acc += old_value_estimates[a, k, :]
+                value_estimates[a, k, :] = acc / counter
+    elif mode == "random":
+        for a, trimmed_k in enumerate(trimmed_ks):
+            new_ks = np.arange(K)
+            for k in range(trimmed_k, K):
+                new_ks[k] = np.random.randint(trimmed_k, k + 1)
+            value_estimates[a] = old_value_estimates[a, new_ks]
+    final_value_estimates = np.zeros([A], dtype=np.float32)
+    for a, trimmed_k in enumerate(trimmed_ks):
+        final_value_estimates[a] = old_value_estimates[a, min(trimmed_k, K - 1):, 0].mean()
+    return value_estimates, final_value_estimates
+
 
 class TestTVF(unittest.TestCase):
 
@@ -118,6 +174,174 @@ class TestTVF(unittest.TestCase):
         self.assertTrue(verify("n_step:128", n_step_list=[128]))
         self.assertTrue(verify("exponential:20", n_step_samples=samples))
 
+    def test_batched_return_estimator(self):
+        """
+        Checks the batched return estimator against the per horizon version.
+        """
+        args = random_return_args()
+        N, K = len(args['rewards']), len(args['required_horizons'])
+        args['value_samples'][:, :, 0] *= 0
+
+        for use_log_interpolation in [False, True]:
+            for kwargs in [
+                {'n_step_list': [1]},
+                {'n_step_list': [N]},
+                {'n_step_list': [7, 7, 30]},
+                {'n_step_samples': np.random.randint(1, N + 1, [K, 40])},
+            ]:
+                ref = returns._calculate_sampled_return_multi_per_horizon(
+                    use_log_interpolation=use_log_interpolation, **kwargs, **args)
+                m = returns._calculate_sampled_return_multi_fast(
+                    use_log_interpolation=use_log_interpolation, **kwargs, **args)
+                self.assertEqual(ref.shape, m.shape)
+                self.assertLess(np.abs(ref - m).max(), 1e-5 * np.abs(ref).max(), f"{kwargs} log={use_log_interpolation}")
+
+    def test_return_workers(self):
+        """
+        Checks that splitting horizons between workers does not change the results.
+        """
+        args = random_return_args(include_zero_horizon=False)
+        threads = threading.active_count()
+        for mode in ['standard', 'advanced']:
+            ref = returns.get_return_estimate('exponential', mode, n_step=20, seed=1, workers=0, **args)
+            for workers in [2, 3, 64]:
+                m = returns.get_return_estimate('exponential', mode, n_step=20, seed=1, workers=workers, **args)
+                np.testing.assert_array_equal(ref, m, err_msg=f"{mode} with {workers} workers")
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    m = returns.get_return_estimate('exponential', mode, n_step=20, seed=1, workers=workers,
+                                                    pool=pool, **args)
+                np.testing.assert_array_equal(ref, m, err_msg=f"{mode} with {workers} workers (shared pool)")
+        # pools created for a single call are shut down.
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_return_pool(self):
+        """
+        The runner module owns the return workers' thread pool, which is shut down when the runner closes.
+        """
+        parent = SimpleNamespace(
+            ext_rewards=np.zeros([4, 2], dtype=np.float32), value_heads=["ext"], tvf_horizons=np.asarray([0, 1, 10])
+        )
+        with mock.patch.object(tvf.args.tvf, "return_workers", 0), mock.patch.object(tvf.args.tvf, "max_horizon", 10):
+            self.assertIsNone(tvf.TVFRunnerModule(parent).return_pool)
+        with mock.patch.object(tvf.args.tvf, "return_workers", 2), mock.patch.object(tvf.args.tvf, "max_horizon", 10):
+            module = tvf.TVFRunnerModule(parent)
+        pool = module.return_pool
+        self.assertEqual(pool.submit(int, 2).result(), 2)
+        module.on_close()
+        self.assertIsNone(module.return_pool)
+        with self.assertRaises(RuntimeError):
+            pool.submit(int)
+
+    def test_torch_backend(self):
+        """
+        Checks the torch return estimator against the numpy one for all distributions and modes.
+        """
+        args = random_return_args()
+        torch_args = args.copy()
+        for key in ['rewards', 'dones', 'value_samples']:
+            torch_args[key] = torch.from_numpy(args[key])
+
+        for distribution in ['fixed', 'exponential', 'uniform', 'hyperbolic', 'quadratic']:
+            for mode in ['standard', 'advanced', 'clipped', 'adaptive', 'mcx', 'full']:
+                for use_log_interpolation in [False, True]:
+                    kwargs = dict(n_step=10, max_samples=8, seed=1, use_log_interpolation=use_log_interpolation)
+                    ref = returns.get_return_estimate(distribution, mode, **kwargs, **args)
+                    m = returns.get_return_estimate(distribution, mode, backend="torch", **kwargs, **torch_args)
+                    self.assertTrue(torch.is_tensor(m))
+                    self.assertLess(
+                        np.abs(ref - m.numpy()).max(), 1e-5 * np.abs(ref).max(),
+                        f"{distribution}:{mode} log={use_log_interpolation}"
+                    )
+
+    def test_full_return_estimator(self):
+        """
+        Checks the single pass 'full' estimator against a weighted average of fixed n_step returns.
+        """
+        args = random_return_args()
+        (N, A), K = args['rewards'].shape, len(args['required_horizons'])
+        n_step = 10
+        lamb = 1 - (1 / n_step)
+        for distribution, f in [
+            ('exponential', lambda x: lamb ** x),
+            ('uniform', lambda x: 1),
+            ('hyperbolic', lambda x: 1 / x),
+            ('quadratic', lambda x: 1 / (N + (x * x))),
+        ]:
+            weights = np.asarray([f(n) for n in range(1, N + 1)], dtype=np.float32)
+            weights /= np.sum(weights)
+            ref = np.zeros([N, A, K], dtype=np.float32)
+            for n, weight in zip(range(1, N + 1), weights):
+                ref += returns._calculate_sampled_return_multi_per_horizon(n_step_list=[n], **args) * weight
+            m = returns.get_return_estimate(distribution, 'full', n_step=n_step, **args)
+            self.assertLess(np.abs(ref - m).max(), 1e-5 * np.abs(ref).max(), distribution)
+
+    def test_gae_tvf(self):
+        """
+        Checks the vectorized general discount GAE against the reference version on small inputs.
+        """
+        with mock.patch.object(tvf.args.tvf, "gamma", 1):
+            for N, A, H, lamb, discount_fn in [
+                (6, 3, 10, 0.9, lambda t: 0.99 ** t),
+                (12, 4, 40, 0.95, lambda t: 1 / (1 + 0.1 * t)),
+                (16, 2, 5, 0.5, lambda t: 1.0),
+            ]:
+                rewards = np.random.normal(size=[N, A]).astype(np.float32)
+                values = np.cumsum(np.random.normal(size=[N, A, H]), axis=-1).astype(np.float32)
+                final_values = np.cumsum(np.random.normal(size=[A, H]), axis=-1).astype(np.float32)
+                terminals = (np.random.random(size=[N, A]) < 0.1).astype(np.float32)
+                ref = tvf._calculate_gae_tvf_reference(rewards, values, final_values, terminals, discount_fn, lamb)
+                m = tvf.calculate_gae_tvf(rewards, values, final_values, terminals, discount_fn, lamb)
+                self.assertEqual(m.shape, (N, A))
+                self.assertLess(np.abs(ref - m).max(), 1e-5 * np.abs(ref).max(), f"N={N} H={H}")
+
+    def test_trim_horizons(self):
+        """
+        Checks the vectorized trimming modes against the per agent versions, including random draws.
+        """
+        A, K, VH = 32, 12, 2
+        horizons = np.asarray([0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024])
+        module = SimpleNamespace(
+            runner=SimpleNamespace(tvf_horizons=horizons, K=K, log=mock.Mock()),
+            interpolators={True: returns.HorizonInterpolator(horizons, 1024, use_log_interpolation=True)},
+        )
+        value_estimates = np.random.normal(size=[A, K, VH]).astype(np.float32)
+        # includes agents that are not trimmed at all, and ones that are trimmed to h=0.
+        time = np.concatenate([[0, 1100], np.random.randint(0, 1100, size=[A - 2])])
+        with mock.patch.object(tvf.args.env, "timeout", 1100), mock.patch.object(tvf.args.tvf, "trim_clip", -1):
+            for mode in ["interpolate", "average", "random"]:
+                np.random.seed(1)
+                result, final_values, time_till_termination = tvf.TVFRunnerModule.trim_horizons(
+                    module, value_estimates, time, method="timelimit", mode=mode
+                )
+                np.random.seed(1)
+                ref, ref_final_values = trim_horizons_reference(module, value_estimates, time_till_termination, mode)
+                np.testing.assert_allclose(result, ref, rtol=1e-6, atol=1e-6, err_msg=mode)
+                np.testing.assert_allclose(final_values, ref_final_values, rtol=1e-6, atol=1e-6, err_msg=mode)
+
+    def test_rediscount(self):
+        """
+        With a head at every horizon rediscounting is exact (so long as the ratio is not clipped).
+        """
+        rewards = np.random.normal(size=[4, 50])
+        horizons = np.arange(51)
+
+        def value_curve(gamma):
+            return np.concatenate([np.zeros([4, 1]), np.cumsum(rewards * gamma ** np.arange(50), axis=1)], axis=1)
+
+        for old_gamma, new_gamma in [(0.95, 0.97), (1.0, 0.99), (0.99, 0.9)]:
+            old_values = value_curve(old_gamma).astype(np.float32)
+            expected = value_curve(new_gamma)
+            results = tvf.rediscount_value_curves(old_values, old_gamma, new_gamma, horizons)
+            self.assertEqual(results.shape, old_values.shape)
+            np.testing.assert_allclose(results, expected, rtol=1e-4, atol=1e-4)
+            result = tvf.get_rediscounted_value_estimate(old_values, old_gamma, new_gamma, horizons)
+            np.testing.assert_allclose(result, expected[:, -1], rtol=1e-4, atol=1e-4)
+            # sparse heads only see the values at their horizons
+            sparse = np.asarray([0, 1, 5, 20, 50])
+            results = tvf.rediscount_value_curves(old_values[:, sparse], old_gamma, new_gamma, sparse)
+            np.testing.assert_allclose(results[:, -1], tvf.get_rediscounted_value_estimate(
+                torch.from_numpy(old_values[:, sparse]), old_gamma, new_gamma, sparse).numpy(), rtol=1e-5)
+
     def test_interpolation(self):
 
         horizons = np.asarray([0, 1, 2, 10, 100])
@@ -128,4 +352,21 @@ class TestTVF(unittest.TestCase):
         max_abs_error = np.max(np.abs(np.asarray(expected_results) - results))
         self.assertLess(max_abs_error, 1e-6, f"Expected {expected_results} found {results}")
 
+        # lookup tables give the same results, for both integer and non-integer horizons.
+        interpolator = returns.HorizonInterpolator(horizons, max_horizon=150)
+        for targets in [[-100, -1, 0, 1, 2, 3, 4, 99, 100, 101, 200], [0.5, 1.5, 50.5, 100.0, 150.5]]:
+            targets = np.asarray(targets)
+            expected_results = tvf.horizon_interpolate(horizons, values[:len(targets)], targets)
+            results = interpolator(values[:len(targets)], targets)
+            max_abs_error = np.max(np.abs(expected_results - results))
+            self.assertLess(max_abs_error, 1e-6, f"Expected {expected_results} found {results}")
+
+        log_scale = lambda x: np.log10(10 + x) - 1
+        interpolator = returns.HorizonInterpolator(horizons, max_horizon=150, use_log_interpolation=True)
+        targets = np.arange(-2, 160)
+        values = np.random.normal(size=[len(targets), len(horizons)])
+        expected_results = tvf.horizon_interpolate(log_scale(horizons), values, log_scale(targets))
+        max_abs_error = np.max(np.abs(expected_results - interpolator(values, targets)))
+        self.assertLess(max_abs_error, 1e-6)
+
 
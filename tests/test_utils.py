@@ -0,0 +1,171 @@
+import unittest
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from rl import utils, compression
+
+
+class TestSortedWindow(unittest.TestCase):
+
+    def test_percentile(self):
+        """
+        Checks percentiles, with and without extra values, against np.percentile, including once the window is full.
+        """
+        window = utils.SortedWindow(maxlen=50)
+        for i in range(120):
+            window.append(np.random.randint(0, 1000))
+            if i % 7 != 0:
+                continue
+            values = list(window)
+            extra = np.random.randint(0, 1000, size=[np.random.randint(0, 8)])
+            for q in [0, 1, 37.5, 50, 90, 100]:
+                self.assertAlmostEqual(window.percentile(q), np.percentile(values, q))
+                self.assertAlmostEqual(window.percentile(q, extra), np.percentile(values + list(extra), q))
+        self.assertEqual(len(window), 50)
+
+    def test_mean_std(self):
+        window = utils.SortedWindow(maxlen=100)
+        self.assertTrue(np.isnan(window.mean()) and np.isnan(window.std()))
+        for _ in range(250):
+            window.append(np.random.randint(0, 27000))
+            self.assertAlmostEqual(window.mean(), np.mean(np.asarray(window)), places=6)
+            self.assertAlmostEqual(window.std(), np.std(np.asarray(window)), places=6)
+        window.clear()
+        window.append(5)
+        self.assertEqual((window.mean(), window.std()), (5, 0))
+
+    def test_old_pickle(self):
+        """
+        Windows pickled before the running sums were added restore their sums.
+        """
+        window = utils.SortedWindow(maxlen=10, values=[3, 1, 4, 1, 5])
+        state = window.__dict__.copy()
+        del state['_sum'], state['_sum_sq']
+        restored = utils.SortedWindow.__new__(utils.SortedWindow)
+        restored.__setstate__(state)
+        self.assertAlmostEqual(restored.mean(), np.mean([3, 1, 4, 1, 5]))
+        self.assertAlmostEqual(restored.std(), np.std([3, 1, 4, 1, 5]))
+        restored = pickle.loads(pickle.dumps(window))
+        self.assertEqual(list(restored), [3, 1, 4, 1, 5])
+
+
+class TestDeviceBatchSampler(unittest.TestCase):
+
+    def make_batch(self, batch_size: int):
+        return {
+            'index': torch.arange(batch_size),
+            'obs': torch.arange(batch_size * 6, dtype=torch.float32).reshape(batch_size, 2, 3),
+            '*horizons': torch.tensor([1, 10, 100]),
+            '*label': "passthrough",
+        }
+
+    def test_epoch(self):
+        """
+        Checks that each epoch uses every sample exactly once, and that fields are gathered consistently.
+        """
+        batch = self.make_batch(24)
+        sampler = utils.DeviceBatchSampler(batch, micro_batch_size=6, device="cpu")
+        for epoch in range(3):
+            sampler.shuffle()
+            seen = []
+            for micro_batch in range(4):
+                sample = sampler.sample(micro_batch)
+                self.assertEqual(sample['obs'].shape, (6, 2, 3))
+                torch.testing.assert_close(sample['obs'], batch['obs'][sample['index']])
+                self.assertIs(sample['*horizons'], batch['*horizons'])
+                self.assertIs(sample['*label'], batch['*label'])
+                seen.extend(sample['index'].tolist())
+            self.assertEqual(sorted(seen), list(range(24)), f"epoch {epoch}")
+
+    def test_thinning(self):
+        """
+        Thinning uses the first samples_per_micro_batch samples of each micro-batch of the ordering.
+        """
+        batch = self.make_batch(24)
+        sampler = utils.DeviceBatchSampler(batch, micro_batch_size=8, device="cpu", samples_per_micro_batch=3)
+        for micro_batch in range(3):
+            sample = sampler.sample(micro_batch)
+            self.assertEqual(sample['index'].tolist(), sampler.ordering[micro_batch * 8:micro_batch * 8 + 3].tolist())
+            torch.testing.assert_close(sample['obs'], batch['obs'][sample['index']])
+            self.assertIs(sample['*horizons'], batch['*horizons'])
+
+
+class TestHostBatchPrefetcher(unittest.TestCase):
+
+    def make_batch(self, batch_size: int):
+        obs = np.random.randint(0, 256, size=[batch_size, 2, 8, 8], dtype=np.uint8)
+        compressed_obs = np.empty([batch_size], dtype=object)
+        for i in range(batch_size):
+            compressed_obs[i] = compression.BufferSlot(obs[i])
+        batch = {
+            'index': np.arange(batch_size),
+            'obs': obs,
+            'compressed_obs': compressed_obs,
+            'returns': torch.arange(batch_size, dtype=torch.float32),
+            '*horizons': torch.tensor([1, 10, 100]),
+        }
+        return batch
+
+    def check_sample(self, sample: dict, batch: dict):
+        index = sample['index'].numpy()
+        np.testing.assert_array_equal(sample['obs'].numpy(), batch['obs'][index])
+        # compressed fields are returned decompressed.
+        self.assertEqual(sample['compressed_obs'].dtype, torch.uint8)
+        np.testing.assert_array_equal(sample['compressed_obs'].numpy(), batch['obs'][index])
+        np.testing.assert_array_equal(sample['returns'].numpy(), index.astype(np.float32))
+        self.assertTrue(torch.equal(sample['*horizons'], batch['*horizons']))
+
+    def test_epoch(self):
+        """
+        Checks that every sample is used exactly once, for both compressed and uncompressed fields.
+        """
+        batch = self.make_batch(24)
+        sampler = utils.HostBatchPrefetcher(batch, micro_batch_size=6, device="cpu", prefetch=2)
+        try:
+            seen = []
+            for micro_batch in range(4):
+                sample = sampler.sample(micro_batch)
+                self.check_sample(sample, batch)
+                seen.extend(sample['index'].tolist())
+            self.assertEqual(sorted(seen), list(range(24)))
+        finally:
+            sampler.close()
+
+    def test_thinning(self):
+        batch = self.make_batch(24)
+        sampler = utils.HostBatchPrefetcher(batch, micro_batch_size=8, device="cpu", samples_per_micro_batch=3)
+        try:
+            for micro_batch in range(3):
+                sample = sampler.sample(micro_batch)
+                self.check_sample(sample, batch)
+                self.assertEqual(sample['index'].tolist(), list(sampler.ordering[micro_batch * 8:micro_batch * 8 + 3]))
+        finally:
+            sampler.close()
+
+    def test_close(self):
+        """
+        Closing after an early break cancels pending micro-batches, and only shuts down a pool the sampler created.
+        """
+        batch = self.make_batch(64)
+        shared_pool = ThreadPoolExecutor(max_workers=2)
+        try:
+            for pool in [None, shared_pool]:
+                sampler = utils.HostBatchPrefetcher(batch, micro_batch_size=4, device="cpu", prefetch=3, pool=pool)
+                self.check_sample(sampler.sample(0), batch)
+                self.assertGreater(len(sampler.pending), 0)
+                sampler.close()
+                self.assertEqual(len(sampler.pending), 0)
+                if pool is None:
+                    with self.assertRaises(RuntimeError):
+                        sampler.pool.submit(int)
+            # the shared pool is still usable.
+            self.assertEqual(shared_pool.submit(int, 3).result(), 3)
+        finally:
+            shared_pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -78,6 +78,8 @@ def make_model(args:rl.config.Config, log=None):
         norm_eps=args.observation_normalization_epsilon,
         head_bias=args.model.head_bias,
         observation_scaling=args.observation_scaling,
+        fused_forward=args.model.fused_forward,
+        amp=args.amp,
     )
     return model
 
@@ -131,9 +133,10 @@ def main():
     # calculate number of workers to use.
     if args.workers < 0:
         args.workers = multiprocessing.cpu_count()
-        while args.agents % args.workers != 0:
-            # make sure workers divides number of jobs.
-            args.workers -= 1
+        if args.worker_topology == "fixed":
+            while args.agents % args.workers != 0:
+                # make sure workers divides number of jobs.
+                args.workers -= 1
 
     # check the output folder is valid...
     assert os.path.isdir(args.output_folder), "Can not find path " + args.output_folder